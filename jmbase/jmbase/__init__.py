@@ -3,5 +3,7 @@ from __future__ import print_function
 from .support import (get_log, chunks, debug_silence, debug_dump_object,
                       joinmarket_alert, core_alert, get_password, _byteify,
                       set_logging_level)
+from .metrics import (get_metrics, CoinjoinMetrics, Histogram,
+                      MetricsExporter)
 from commands import *
 
@@ -1,7 +1,3 @@
-try:
-    from cStringIO import StringIO
-except ImportError: #pragma: no cover
-    from StringIO import StringIO #pragma: no cover
 from itertools import count
 from twisted.protocols import amp
 
@@ -19,29 +15,30 @@ class BigString(amp.Argument):
     names by prefixing this Argument's key name to a counter.
     """
     def fromBox(self, name, strings, objects, proto):
-        value = StringIO()
-        value.write(strings.get(name))
+        chunks = [strings.get(name)]
         for counter in count(2):
             chunk = strings.get("%s.%d" % (name, counter))
             if chunk is None:
                 break
-            value.write(chunk)
-        objects[name] = self.buildvalue(value.getvalue())
+            chunks.append(chunk)
+        #(a single chunk is returned by join as is, without a copy)
+        objects[name] = self.buildvalue(b"".join(chunks))
 
     def buildvalue(self, value):
         return value
 
     def toBox(self, name, strings, objects, proto):
-        value = StringIO(self.fromvalue(objects[name]))
-        firstChunk = value.read(CHUNK_MAX)
-        strings[name] = firstChunk
-        counter = 2
-        while True:
-            nextChunk = value.read(CHUNK_MAX)
-            if not nextChunk:
-                break
-            strings["%s.%d" % (name, counter)] = nextChunk
-            counter += 1
+        value = self.fromvalue(objects[name])
+        if len(value) <= CHUNK_MAX:
+            strings[name] = value
+            return
+        #each chunk is copied once, from a view of the value
+        view = memoryview(value)
+        strings[name] = view[:CHUNK_MAX].tobytes()
+        for counter, start in enumerate(xrange(CHUNK_MAX, len(value),
+                                               CHUNK_MAX), 2):
+            strings["%s.%d" % (name, counter)] = view[
+                start:start + CHUNK_MAX].tobytes()
 
     def fromvalue(self, value):
         return value
@@ -4,8 +4,10 @@ Commands defining client-server (daemon)
 messaging protocol (*not* Joinmarket p2p protocol).
 Used for AMP asynchronous messages.
 """
-from twisted.protocols.amp import Boolean, Command, Integer, String
+from twisted.protocols.amp import (AmpList, Boolean, Command, Integer, String,
+                                   MAX_VALUE_LENGTH)
 from bigstring import BigString
+from packing import Packed, HexBytes
 
 class DaemonNotReady(Exception):
     pass
@@ -14,6 +16,29 @@ class JMCommand(Command):
     #a default response type
     response = [('accepted', Boolean())]
 
+def split_amplist(items, max_length=MAX_VALUE_LENGTH):
+    """Splits a list of dicts, to be sent as an AmpList argument,
+    into consecutive lists that each fit in one AMP value. (A single
+    item must fit on its own, as it would as separate arguments.)
+    """
+    batches = []
+    batch = []
+    size = 0
+    for item in items:
+        #each key and value is encoded with a 2 byte length prefix,
+        #and each item is terminated with 2 null bytes.
+        item_size = 2 + sum(4 + len(k) + len(str(v))
+                            for k, v in item.iteritems())
+        if batch and size + item_size > max_length:
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append(item)
+        size += item_size
+    if batch:
+        batches.append(batch)
+    return batches
+
 """COMMANDS FROM CLIENT TO DAEMON
 =================================
 """
@@ -26,12 +51,31 @@ class JMInit(JMCommand):
     configuration.
     Blockchain source is communicated only as a naming
     tag for messagechannels (currently IRC 'realname' field).
+    If verify_nick_sigs is True, the daemon verifies the nick
+    signatures of inbound messages itself, where it can, rather
+    than sending JMRequestMsgSigVerify.
+    If hedge_privmsgs is True, coinjoin negotiation messages are
+    sent over all message channels the counterparty is on.
+    If maker_timeout_min_sec is given, the wait for makers' responses
+    adapts to their past response times, between it and
+    maker_timeout_sec.
+    If accept_commitment_broadcasts is False, a maker does not add
+    commitments broadcast by other makers to its blacklist.
+    max_privmsg_size, max_partial_privmsgs and partial_privmsg_timeout,
+    if given, limit the reassembly of chunked privmsgs received.
     """
     arguments = [('bcsource', String()),
                  ('network', String()),
                  ('irc_configs', String()),
                  ('minmakers', Integer()),
-                 ('maker_timeout_sec', Integer())]
+                 ('maker_timeout_sec', Integer()),
+                 ('verify_nick_sigs', Boolean(optional=True)),
+                 ('hedge_privmsgs', Boolean(optional=True)),
+                 ('maker_timeout_min_sec', Integer(optional=True)),
+                 ('accept_commitment_broadcasts', Boolean(optional=True)),
+                 ('max_privmsg_size', Integer(optional=True)),
+                 ('max_partial_privmsgs', Integer(optional=True)),
+                 ('partial_privmsg_timeout', Integer(optional=True))]
     errors = {DaemonNotReady: 'daemon is not ready'}
 
 class JMStartMC(JMCommand):
@@ -66,13 +110,31 @@ class JMMsgSignatureVerify(JMCommand):
                  ('fullmsg', String()),
                  ('hostid', String())]
 
+class JMMsgSignatureBatch(JMCommand):
+    """Responses to a JMRequestMsgSigBatch, in order.
+    """
+    arguments = [('signatures', AmpList([('nick', String()),
+                                         ('cmd', String()),
+                                         ('msg_to_return', String()),
+                                         ('hostid', String())]))]
+
+class JMMsgSignatureVerifyBatch(JMCommand):
+    """Responses to a JMRequestMsgSigVerifyBatch, in order.
+    """
+    arguments = [('results', AmpList([('verif_result', Boolean()),
+                                      ('nick', String()),
+                                      ('fullmsg', String()),
+                                      ('hostid', String())]))]
+
 """TAKER specific commands
 """
 
 class JMRequestOffers(JMCommand):
-    """Get orderbook from daemon
+    """Get orderbook from daemon; if since is the version
+    of the client's copy of the orderbook (as returned in
+    JMOffers), only the changes since then are sent.
     """
-    arguments = []
+    arguments = [('since', Integer(optional=True))]
 
 class JMFill(JMCommand):
     """Fill an offer/order
@@ -87,14 +149,14 @@ class JMMakeTx(JMCommand):
     to a set of counterparties
     """
     arguments = [('nick_list', String()),
-                 ('txhex', String())]
+                 ('txhex', HexBytes())]
 
 class JMPushTx(JMCommand):
     """Pass a raw hex transaction to a specific
     counterparty (maker) for pushing (anonymity feature in JM)
     """
     arguments = [('nick', String()),
-                 ('txhex', String())]
+                 ('txhex', HexBytes())]
 
 """MAKER specific commands
 """
@@ -176,21 +238,52 @@ class JMRequestMsgSigVerify(JMCommand):
                  ('max_encoded', Integer()),
                  ('hostid', String())]
 
+class JMRequestMsgSigBatch(JMCommand):
+    """As JMRequestMsgSig, for a list of messages;
+    answered with JMMsgSignatureBatch, in the same order.
+    """
+    arguments = [('requests', AmpList([('nick', String()),
+                                       ('cmd', String()),
+                                       ('msg', String()),
+                                       ('msg_to_be_signed', String()),
+                                       ('hostid', String())]))]
+
+class JMRequestMsgSigVerifyBatch(JMCommand):
+    """As JMRequestMsgSigVerify, for a list of messages;
+    answered with JMMsgSignatureVerifyBatch, in the same order.
+    """
+    arguments = [('requests', AmpList([('msg', String()),
+                                       ('fullmsg', String()),
+                                       ('sig', String()),
+                                       ('pubkey', String()),
+                                       ('nick', String()),
+                                       ('hashlen', Integer()),
+                                       ('max_encoded', Integer()),
+                                       ('hostid', String())]))]
+
 """ TAKER-specific commands
 """
 
 class JMOffers(JMCommand):
     """Return the entire contents of the
-    orderbook to TAKER, as a json-ified dict;
-    note uses BigString because can be very large
+    orderbook to TAKER, as a list of offer dicts;
+    note uses Packed because can be very large.
+    If full is False, orderbook is instead the
+    changes {'add': [offers], 'cancel': [[nick, oid],..]}
+    since the version requested; version is the version
+    of the orderbook after applying them.
     """
-    arguments = [('orderbook', BigString())]
+    arguments = [('orderbook', Packed()),
+                 ('version', Integer(optional=True)),
+                 ('full', Boolean(optional=True))]
 
 class JMFillResponse(JMCommand):
-    """Returns ioauth data from MAKER if successful.
+    """Returns ioauth data from MAKER if successful
+    (a dict keyed by nick), else the list of makers
+    who did not respond.
     """
     arguments = [('success', Boolean()),
-                 ('ioauth_data', String())]
+                 ('ioauth_data', Packed())]
 
 class JMSigReceived(JMCommand):
     """Returns an individual bitcoin transaction signature
@@ -217,8 +310,8 @@ class JMAuthReceived(JMCommand):
 
 class JMTXReceived(JMCommand):
     """Send back transaction template provided
-    by TAKER, along with offerdata to verify fees.
+    by TAKER, along with offerdata (a dict) to verify fees.
     """
     arguments = [('nick', String()),
-                 ('txhex', String()),
-                 ('offer', String())]
+                 ('txhex', HexBytes()),
+                 ('offer', Packed())]
@@ -0,0 +1,272 @@
+from __future__ import absolute_import, print_function
+"""Timings of the stages of the coinjoin protocol, in total and per
+counterparty, for finding slow makers and tuning maker_timeout_sec.
+The daemon, Taker and Maker record into the process-wide instance
+returned by get_metrics(); MetricsExporter periodically writes it to a
+JSON or CSV file, and can serve it over HTTP on localhost.
+"""
+import bisect
+import csv
+import json
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from StringIO import StringIO
+
+from twisted.internet import reactor, task
+from twisted.web import resource, server
+
+from .support import get_log
+
+log = get_log()
+
+#upper bounds, in seconds, of the histogram buckets
+DEFAULT_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   20, 30, 60, 120, 300, 600]
+
+CSV_FIELDS = ["name", "counterparty", "count", "sum", "min", "max", "mean",
+              "p50", "p90", "p99"]
+
+
+class Histogram(object):
+    """Counts of observed values in fixed buckets, with their count,
+    sum and extremes; quantiles are estimated as the upper bound of
+    the bucket they fall in.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if c and seen >= rank:
+                if i == len(self.buckets):
+                    return self.max
+                return min(self.buckets[i], self.max)
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'buckets': [[b, c] for b, c in zip(
+                    self.buckets + ["+Inf"], self.counts)]}
+
+
+class CoinjoinMetrics(object):
+    """Histograms and counters, overall and per counterparty nick.
+    Protocol stages are timestamped with mark_stage; the time since
+    the previous stage marked for the same track and nick is added
+    to the histogram "<track> <previous stage>-<stage>", so that e.g.
+    the taker's "fill" followed by a maker's "pubkey" is recorded as
+    "taker fill-pubkey", that maker's latency in responding to !fill.
+    """
+    #counterparties and stage timestamps kept, least recently used
+    #first out
+    max_counterparties = 1000
+    max_stages = 1000
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.started = clock()
+        self.histograms = {}
+        self.counters = {}
+        self.counterparties = OrderedDict()
+        self.stages = OrderedDict()
+
+    def get_counterparty(self, nick):
+        entry = self.counterparties.pop(nick, None)
+        if entry is None:
+            entry = ({}, {})
+        self.counterparties[nick] = entry
+        while len(self.counterparties) > self.max_counterparties:
+            self.counterparties.popitem(last=False)
+        return entry
+
+    def observe(self, name, value, nick=None):
+        """Adds value, in seconds, to the histogram name, and to
+        that of counterparty nick if given.
+        """
+        targets = [self.histograms]
+        if nick:
+            targets.append(self.get_counterparty(nick)[0])
+        for histograms in targets:
+            if name not in histograms:
+                histograms[name] = Histogram()
+            histograms[name].add(value)
+
+    def increment(self, name, nick=None, n=1):
+        targets = [self.counters]
+        if nick:
+            targets.append(self.get_counterparty(nick)[1])
+        for counters in targets:
+            counters[name] = counters.get(name, 0) + n
+
+    def mark_stage(self, track, stage, nick=None, first=False):
+        """Records that stage of the protocol was reached, with nick
+        if given, and returns the seconds since the previous stage;
+        if first, stage starts a new sequence, e.g. a new coinjoin.
+        """
+        now = self.clock()
+        prev = self.stages.pop((track, nick), None)
+        if first:
+            prev = None
+        self.stages[(track, nick)] = (stage, now)
+        while len(self.stages) > self.max_stages:
+            self.stages.popitem(last=False)
+        if prev is None:
+            return None
+        elapsed = now - prev[1]
+        self.observe("{} {}-{}".format(track, prev[0], stage), elapsed, nick)
+        return elapsed
+
+    @contextmanager
+    def timer(self, name, nick=None):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.observe(name, self.clock() - start, nick)
+
+    def to_dict(self):
+        def section(histograms, counters):
+            return {'histograms': dict((k, v.to_dict()) for k, v in
+                                       histograms.items()),
+                    'counters': dict(counters)}
+        d = section(self.histograms, self.counters)
+        d['started'] = self.started
+        d['updated'] = self.clock()
+        d['counterparties'] = dict((nick, section(*entry)) for nick, entry
+                                   in self.counterparties.items())
+        return d
+
+    def to_rows(self):
+        """One dict per histogram, with the fields in CSV_FIELDS;
+        counterparty is empty for the overall histograms.
+        """
+        rows = []
+        sources = [("", self.histograms)] + [
+            (nick, entry[0]) for nick, entry in self.counterparties.items()]
+        for nick, histograms in sources:
+            for name in sorted(histograms):
+                row = histograms[name].to_dict()
+                row.update({'name': name, 'counterparty': nick})
+                rows.append(dict((k, row[k]) for k in CSV_FIELDS))
+        return rows
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def to_csv(self):
+        out = StringIO()
+        writer = csv.DictWriter(out, CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(self.to_rows())
+        return out.getvalue()
+
+
+_metrics = CoinjoinMetrics()
+
+
+def get_metrics():
+    """
+    provides joinmarket metrics instance
+    :return: metrics instance
+    """
+    return _metrics
+
+
+class MetricsResource(resource.Resource):
+    """Serves the metrics as JSON, or as CSV with ?format=csv.
+    """
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        if request.args.get("format") == ["csv"]:
+            request.setHeader("Content-Type", "text/csv")
+            return self.metrics.to_csv()
+        request.setHeader("Content-Type", "application/json")
+        return self.metrics.to_json()
+
+
+class MetricsExporter(object):
+    """Writes metrics to path every interval seconds, as CSV if path
+    ends in .csv, else as JSON; and if port is given, serves them at
+    http://localhost:<port>/.
+    """
+
+    def __init__(self, metrics, path=None, interval=60, port=None,
+                 reactor=reactor):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.port = port
+        self.reactor = reactor
+        self.loop = None
+        self.listener = None
+
+    def start(self):
+        if self.path:
+            self.loop = task.LoopingCall(self.write)
+            self.loop.clock = self.reactor
+            self.loop.start(self.interval, now=False)
+        if self.port:
+            self.listener = self.reactor.listenTCP(
+                self.port, server.Site(MetricsResource(self.metrics)),
+                interface="127.0.0.1")
+            log.info("Serving coinjoin metrics on http://localhost:" +
+                     str(self.port))
+
+    def write(self):
+        if self.path.lower().endswith(".csv"):
+            data = self.metrics.to_csv()
+        else:
+            data = self.metrics.to_json()
+        #write to a temporary file and rename, so that readers never
+        #see a partly written file
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            log.warn("Failed to write metrics to " + self.path + ": " +
+                     repr(e))
+
+    def stop(self):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+            self.write()
+        if self.listener:
+            self.listener.stopListening()
+            self.listener = None
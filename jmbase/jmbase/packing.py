@@ -0,0 +1,268 @@
+from __future__ import print_function
+"""
+Compact binary encoding of the larger values passed between client
+and daemon (orderbooks, ioauth data, offers), used in place of JSON
+by the Packed amp.Argument.
+
+Each value is a one byte type tag followed by its data; lengths and
+counts are 4 byte big-endian unsigned integers, and integers 8 byte
+signed. A list of two or more dicts with the same keys, such as an
+orderbook, is packed as a table: the keys once, then each column,
+with a column of only ints, or only strings, packed in one go.
+Unlike JSON, str and unicode, ints and dict keys that are not strings
+survive the round trip; tuples become lists.
+"""
+import struct
+from binascii import hexlify, unhexlify
+from operator import itemgetter
+
+from .bigstring import BigString
+
+class PackingError(Exception):
+    pass
+
+_length = struct.Struct(">I")
+_int = struct.Struct(">q")
+_float = struct.Struct(">d")
+
+INT64_MIN = -2**63
+INT64_MAX = 2**63 - 1
+
+def pack(obj):
+    """Returns the packed bytes of obj, which may be any combination
+    of dicts, lists, tuples, str, unicode, int, long, float, bool and
+    None.
+    """
+    out = []
+    _pack(obj, out)
+    return b"".join(out)
+
+def _is_table(items):
+    if len(items) < 2 or not isinstance(items[0], dict) or not items[0]:
+        return False
+    keys = items[0].viewkeys()
+    return all(isinstance(x, dict) and x.viewkeys() == keys for x in items)
+
+def _pack(obj, out):
+    if obj is None:
+        out.append(b"N")
+    elif obj is True:
+        out.append(b"T")
+    elif obj is False:
+        out.append(b"F")
+    elif isinstance(obj, str):
+        out.append(b"s" + _length.pack(len(obj)))
+        out.append(obj)
+    elif isinstance(obj, unicode):
+        encoded = obj.encode("utf-8")
+        out.append(b"u" + _length.pack(len(encoded)))
+        out.append(encoded)
+    elif isinstance(obj, (int, long)):
+        if INT64_MIN <= obj <= INT64_MAX:
+            out.append(b"i" + _int.pack(obj))
+        else:
+            digits = str(obj)
+            out.append(b"I" + _length.pack(len(digits)) + digits)
+    elif isinstance(obj, float):
+        out.append(b"d" + _float.pack(obj))
+    elif isinstance(obj, dict):
+        out.append(b"m" + _length.pack(len(obj)))
+        for k, v in obj.iteritems():
+            _pack(k, out)
+            _pack(v, out)
+    elif isinstance(obj, (list, tuple)):
+        if _is_table(obj):
+            _pack_table(obj, out)
+            return
+        out.append(b"l" + _length.pack(len(obj)))
+        for x in obj:
+            _pack(x, out)
+    else:
+        raise PackingError("Cannot pack value of type: " + str(type(obj)))
+
+def _pack_table(rows, out):
+    keys = list(rows[0])
+    n = len(rows)
+    out.append(b"t" + _length.pack(len(keys)))
+    for k in keys:
+        _pack(k, out)
+    out.append(_length.pack(n))
+    for k in keys:
+        column = map(itemgetter(k), rows)
+        #(exact types: bool is an int, and long may not fit)
+        types = set(map(type, column))
+        if types == set([int]):
+            out.append(b"q" + struct.pack(">%dq" % n, *column))
+            continue
+        if types == set([str]):
+            tag, joined = b"S", b"".join(column)
+        elif types == set([unicode]):
+            joined = u"".join(column).encode("utf-8")
+            tag = b"A"
+            if len(joined) != sum(map(len, column)):
+                tag = b"U"
+                column = [x.encode("utf-8") for x in column]
+        else:
+            out.append(b"g")
+            for x in column:
+                _pack(x, out)
+            continue
+        #strings of the same length, such as nicks, need no lengths
+        lengths = map(len, column)
+        if len(set(lengths)) == 1:
+            out.append(tag + b"w" + _length.pack(lengths[0]))
+        else:
+            out.append(tag + b"v" + struct.pack(">%dI" % n, *lengths))
+        out.append(joined)
+
+def unpack(data):
+    """Returns the value packed in data by pack(); raises
+    PackingError if data is not exactly one packed value.
+    """
+    try:
+        obj, pos = _unpack(data, 0)
+    except (struct.error, IndexError, ValueError, TypeError,
+            UnicodeDecodeError) as e:
+        raise PackingError("Invalid packed data: " + repr(e))
+    if pos != len(data):
+        raise PackingError("Invalid packed data: {} trailing bytes".format(
+            len(data) - pos))
+    return obj
+
+def _read_count(data, pos):
+    n = _length.unpack_from(data, pos)[0]
+    #every item takes at least a byte, so a corrupt count cannot
+    #make us allocate more than the data could hold
+    if n > len(data) - pos:
+        raise PackingError("Invalid packed data: count too large")
+    return n, pos + 4
+
+def _read_bytes(data, pos):
+    n, pos = _read_count(data, pos)
+    if pos + n > len(data):
+        raise PackingError("Invalid packed data: truncated")
+    return data[pos:pos + n], pos + n
+
+def _unpack(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == b"N":
+        return None, pos
+    if tag == b"T":
+        return True, pos
+    if tag == b"F":
+        return False, pos
+    if tag == b"s":
+        return _read_bytes(data, pos)
+    if tag == b"u":
+        value, pos = _read_bytes(data, pos)
+        return value.decode("utf-8"), pos
+    if tag == b"i":
+        return _int.unpack_from(data, pos)[0], pos + 8
+    if tag == b"I":
+        value, pos = _read_bytes(data, pos)
+        return int(value), pos
+    if tag == b"d":
+        return _float.unpack_from(data, pos)[0], pos + 8
+    if tag == b"m":
+        n, pos = _read_count(data, pos)
+        obj = {}
+        for _ in xrange(n):
+            k, pos = _unpack(data, pos)
+            obj[k], pos = _unpack(data, pos)
+        return obj, pos
+    if tag == b"l":
+        n, pos = _read_count(data, pos)
+        obj = []
+        for _ in xrange(n):
+            x, pos = _unpack(data, pos)
+            obj.append(x)
+        return obj, pos
+    if tag == b"t":
+        return _unpack_table(data, pos)
+    raise PackingError("Invalid packed data: unknown type " + repr(tag))
+
+def _unpack_strings(data, pos, n):
+    """Returns (the raw strings of a column of n strings, the
+    total length of their data, position after the header)
+    """
+    fmt = data[pos]
+    pos += 1
+    if fmt == b"w":
+        width = _length.unpack_from(data, pos)[0]
+        pos += 4
+        total = width * n
+        return [(i, i + width) for i in xrange(0, total, width)], total, pos
+    if fmt != b"v":
+        raise PackingError("Invalid packed data: unknown string column")
+    lengths = struct.unpack_from(">%dI" % n, data, pos)
+    pos += 4 * n
+    bounds = []
+    end = 0
+    for length in lengths:
+        bounds.append((end, end + length))
+        end += length
+    return bounds, end, pos
+
+def _unpack_table(data, pos):
+    nkeys, pos = _read_count(data, pos)
+    keys = []
+    for _ in xrange(nkeys):
+        k, pos = _unpack(data, pos)
+        keys.append(k)
+    n, pos = _read_count(data, pos)
+    columns = []
+    for _ in xrange(nkeys):
+        tag = data[pos]
+        pos += 1
+        if tag == b"q":
+            columns.append(struct.unpack_from(">%dq" % n, data, pos))
+            pos += 8 * n
+        elif tag in (b"S", b"A", b"U"):
+            bounds, total, pos = _unpack_strings(data, pos, n)
+            if pos + total > len(data):
+                raise PackingError("Invalid packed data: truncated")
+            joined = data[pos:pos + total]
+            pos += total
+            #an all-ascii unicode column is decoded in one go
+            if tag == b"A":
+                joined = joined.decode("ascii")
+            column = [joined[start:end] for start, end in bounds]
+            if tag == b"U":
+                column = [x.decode("utf-8") for x in column]
+            columns.append(column)
+        elif tag == b"g":
+            column = []
+            for _ in xrange(n):
+                x, pos = _unpack(data, pos)
+                column.append(x)
+            columns.append(column)
+        else:
+            raise PackingError("Invalid packed data: unknown column type "
+                               + repr(tag))
+    return [dict(zip(keys, row)) for row in zip(*columns)], pos
+
+
+class Packed(BigString):
+    """
+    An amp.Argument for any value that pack() can encode,
+    sent packed, with no length limit (see BigString).
+    """
+    def buildvalue(self, value):
+        return unpack(value)
+
+    def fromvalue(self, value):
+        return pack(value)
+
+
+class HexBytes(BigString):
+    """
+    An amp.Argument for a hex string, such as a serialized
+    transaction, sent as the bytes it encodes, with no length
+    limit (see BigString).
+    """
+    def buildvalue(self, value):
+        return hexlify(value)
+
+    def fromvalue(self, value):
+        return unhexlify(value)
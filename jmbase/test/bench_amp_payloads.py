@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+from __future__ import print_function
+'''Benchmark of encoding and decoding a large orderbook as a JMOffers
+argument: as JSON in a BigString, as previously, and as Packed.
+Not collected by pytest; run directly:
+
+    python bench_amp_payloads.py [number of runs]
+'''
+import json
+import sys
+import time
+from cStringIO import StringIO
+from itertools import count
+
+from jmbase.bigstring import BigString, CHUNK_MAX
+from jmbase.packing import Packed
+
+
+class OldBigString(BigString):
+    """BigString as it was, copying through StringIO.
+    """
+    def fromBox(self, name, strings, objects, proto):
+        value = StringIO()
+        value.write(strings.get(name))
+        for counter in count(2):
+            chunk = strings.get("%s.%d" % (name, counter))
+            if chunk is None:
+                break
+            value.write(chunk)
+        objects[name] = self.buildvalue(value.getvalue())
+
+    def toBox(self, name, strings, objects, proto):
+        value = StringIO(self.fromvalue(objects[name]))
+        firstChunk = value.read(CHUNK_MAX)
+        strings[name] = firstChunk
+        counter = 2
+        while True:
+            nextChunk = value.read(CHUNK_MAX)
+            if not nextChunk:
+                break
+            strings["%s.%d" % (name, counter)] = nextChunk
+            counter += 1
+
+
+class OldJSONArgument(OldBigString):
+    def fromvalue(self, value):
+        return json.dumps(value)
+
+    def buildvalue(self, value):
+        return json.loads(value)
+
+
+def make_orderbook(json_size):
+    """Offers as sent by the daemon, amounting to about json_size
+    bytes of JSON.
+    """
+    offers = []
+    size = 0
+    for i in count():
+        offer = {'counterparty': u'J5' + unicode(i).rjust(14, u'x'),
+                 'oid': i % 10, 'ordertype': u'swreloffer',
+                 'minsize': 27300 + i, 'maxsize': 10**9 + i, 'txfee': 0,
+                 'cjfee': u'0.00025'}
+        size += len(json.dumps(offer)) + 2
+        if size > json_size:
+            return offers
+        offers.append(offer)
+
+
+def run(arg, orderbook, runs):
+    encode = decode = 0
+    for _ in range(runs):
+        strings = {}
+        objects = {}
+        st = time.time()
+        arg.toBox("orderbook", strings, {"orderbook": orderbook}, None)
+        encode += time.time() - st
+        st = time.time()
+        arg.fromBox("orderbook", strings, objects, None)
+        decode += time.time() - st
+    assert len(objects["orderbook"]) == len(orderbook)
+    return (sum(len(s) for s in strings.values()), encode / runs,
+            decode / runs)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for size in [10**6, 10**7]:
+        orderbook = make_orderbook(size)
+        print("{} offers:".format(len(orderbook)))
+        #the chunking alone, of the JSON
+        as_json = json.dumps(orderbook)
+        for label, arg in [("previous BigString", OldBigString()),
+                           ("BigString", BigString())]:
+            nbytes, encode, decode = run(arg, as_json, runs)
+            print("  {}: {} bytes, encode {:.4f}s, decode {:.4f}s".format(
+                label, nbytes, encode, decode))
+        for label, arg in [("json, previous BigString", OldJSONArgument()),
+                           ("packed", Packed())]:
+            nbytes, encode, decode = run(arg, orderbook, runs)
+            print("  {}: {} bytes, encode {:.3f}s, decode {:.3f}s".format(
+                label, nbytes, encode, decode))
+
+
+if __name__ == "__main__":
+    main()
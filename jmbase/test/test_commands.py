@@ -46,9 +46,11 @@ class JMTestServerProtocol(JMBaseProtocol):
 
     @JMInit.responder
     def on_JM_INIT(self, bcsource, network, irc_configs, minmakers,
-                   maker_timeout_sec):
+                   maker_timeout_sec, verify_nick_sigs=None,
+                   hedge_privmsgs=None, maker_timeout_min_sec=None,
+                   accept_commitment_broadcasts=None):
         show_receipt("JMINIT", bcsource, network, irc_configs, minmakers,
-                     maker_timeout_sec)
+                     maker_timeout_sec, verify_nick_sigs)
         d = self.callRemote(JMInitProto,
                             nick_hash_length=1,
                             nick_max_encoded=2,
@@ -72,12 +74,12 @@ class JMTestServerProtocol(JMBaseProtocol):
         return {'accepted': True}
 
     @JMRequestOffers.responder
-    def on_JM_REQUEST_OFFERS(self):
+    def on_JM_REQUEST_OFFERS(self, since=None):
         show_receipt("JMREQUESTOFFERS")
         #build a huge orderbook to test BigString Argument
         orderbook = ["aaaa" for _ in range(2**15)]
         d = self.callRemote(JMOffers,
-                        orderbook=json.dumps(orderbook))
+                        orderbook=orderbook)
         self.defaultCallbacks(d)
         return {'accepted': True}
 
@@ -86,7 +88,7 @@ class JMTestServerProtocol(JMBaseProtocol):
         show_receipt("JMFILL", amount, commitment, revelation, filled_offers)
         d = self.callRemote(JMFillResponse,
                                 success=True,
-                                ioauth_data = json.dumps(['dummy', 'list']))
+                                ioauth_data=['dummy', 'list'])
         return {'accepted': True}
 
     @JMMakeTx.responder
@@ -114,6 +116,24 @@ class JMTestServerProtocol(JMBaseProtocol):
                                         max_encoded=5,
                                         hostid="hostid2")
         self.defaultCallbacks(d3)        
+        d4 = self.callRemote(JMRequestMsgSigBatch,
+                             requests=[{'nick': "dummynickforsign",
+                                        'cmd': "command" + str(i),
+                                        'msg': "msgforsign",
+                                        'msg_to_be_signed': "fullmsgforsign",
+                                        'hostid': "hostid1"}
+                                       for i in range(3)])
+        self.defaultCallbacks(d4)
+        d5 = self.callRemote(JMRequestMsgSigVerifyBatch,
+                             requests=[{'msg': "msgforverify",
+                                        'fullmsg': "fullmsgforverify",
+                                        'sig': "xxxsigforverify",
+                                        'pubkey': "pubkey1",
+                                        'nick': "dummynickforverify",
+                                        'hashlen': 4,
+                                        'max_encoded': 5,
+                                        'hostid': "hostid2"}])
+        self.defaultCallbacks(d5)
         return {'accepted': True}
             
 
@@ -127,6 +147,19 @@ class JMTestServerProtocol(JMBaseProtocol):
         show_receipt("JMMSGSIGVERIFY", verif_result, nick, fullmsg, hostid)
         return {'accepted': True}
 
+    @JMMsgSignatureBatch.responder
+    def on_JM_MSGSIGNATURE_BATCH(self, signatures):
+        show_receipt("JMMSGSIGNATUREBATCH", signatures)
+        #responses are in request order
+        assert [s['cmd'] for s in signatures] == ["command" + str(i)
+                                                  for i in range(3)]
+        return {'accepted': True}
+
+    @JMMsgSignatureVerifyBatch.responder
+    def on_JM_MSGSIGNATURE_VERIFY_BATCH(self, results):
+        show_receipt("JMMSGSIGVERIFYBATCH", results)
+        return {'accepted': True}
+
 class JMTestClientProtocol(JMBaseProtocol):
 
     def connectionMade(self):
@@ -138,7 +171,8 @@ class JMTestClientProtocol(JMBaseProtocol):
                             network="dummynetwork",
                             irc_configs=json.dumps(['dummy', 'irc', 'config']),
                             minmakers=7,
-                            maker_timeout_sec=8)
+                            maker_timeout_sec=8,
+                            verify_nick_sigs=True)
         self.defaultCallbacks(d)
 
     @JMInitProto.responder
@@ -177,7 +211,7 @@ class JMTestClientProtocol(JMBaseProtocol):
         return {'accepted': True}
 
     @JMOffers.responder
-    def on_JM_OFFERS(self, orderbook):
+    def on_JM_OFFERS(self, orderbook, version=None, full=None):
         show_receipt("JMOFFERS", orderbook)
         d = self.callRemote(JMFill,
                             amount=100,
@@ -218,6 +252,30 @@ class JMTestClientProtocol(JMBaseProtocol):
         self.defaultCallbacks(d)
         return {'accepted': True}
 
+    @JMRequestMsgSigBatch.responder
+    def on_JM_REQUEST_MSGSIG_BATCH(self, requests):
+        show_receipt("JMREQUESTMSGSIGBATCH", requests)
+        d = self.callRemote(JMMsgSignatureBatch,
+                            signatures=[{'nick': r['nick'],
+                                         'cmd': r['cmd'],
+                                         'msg_to_return': "xxxcreatedsigxx",
+                                         'hostid': r['hostid']}
+                                        for r in requests])
+        self.defaultCallbacks(d)
+        return {'accepted': True}
+
+    @JMRequestMsgSigVerifyBatch.responder
+    def on_JM_REQUEST_MSGSIG_VERIFY_BATCH(self, requests):
+        show_receipt("JMREQUESTMSGSIGVERIFYBATCH", requests)
+        d = self.callRemote(JMMsgSignatureVerifyBatch,
+                            results=[{'verif_result': True,
+                                      'nick': r['nick'],
+                                      'fullmsg': r['fullmsg'],
+                                      'hostid': r['hostid']}
+                                     for r in requests])
+        self.defaultCallbacks(d)
+        return {'accepted': True}
+
 class JMTestClientProtocolFactory(protocol.ClientFactory):
     protocol = JMTestClientProtocol
 
@@ -0,0 +1,114 @@
+#! /usr/bin/env python
+from __future__ import absolute_import, print_function
+'''Tests of the coinjoin stage timings.'''
+
+import csv
+import json
+from StringIO import StringIO
+
+from twisted.internet import task
+from twisted.web.test.requesthelper import DummyRequest
+
+from jmbase.metrics import (CoinjoinMetrics, Histogram, MetricsExporter,
+                            MetricsResource)
+
+
+def get_metrics():
+    clock = task.Clock()
+    return CoinjoinMetrics(clock=clock.seconds), clock
+
+
+def test_histogram():
+    h = Histogram(buckets=[1, 2, 5])
+    assert h.quantile(0.5) is None
+    for v in [0.5, 1.5, 1.5, 1.8, 3, 4, 4.5, 20]:
+        h.add(v)
+    d = h.to_dict()
+    assert (d['count'], d['min'], d['max']) == (8, 0.5, 20)
+    assert d['mean'] == sum([0.5, 1.5, 1.5, 1.8, 3, 4, 4.5, 20]) / 8
+    assert d['buckets'] == [[1, 1], [2, 3], [5, 3], ["+Inf", 1]]
+    assert (d['p50'], d['p90'], d['p99']) == (2, 20, 20)
+    assert h.quantile(0.1) == 1
+    #quantiles are no more than the largest value seen
+    h = Histogram(buckets=[1, 2, 5])
+    h.add(0.1)
+    assert h.quantile(0.5) == 0.1
+
+
+def test_stages():
+    m, clock = get_metrics()
+    for nick in ["J5maker1", "J5maker2"]:
+        m.mark_stage("taker", "fill", nick, first=True)
+    clock.advance(2)
+    assert m.mark_stage("taker", "pubkey", "J5maker1") == 2
+    clock.advance(3)
+    m.mark_stage("taker", "pubkey", "J5maker2")
+    m.mark_stage("taker", "auth", "J5maker2")
+    assert m.histograms["taker fill-pubkey"].count == 2
+    assert m.histograms["taker fill-pubkey"].sum == 7
+    maker2 = m.counterparties["J5maker2"][0]
+    assert sorted(maker2) == ["taker fill-pubkey", "taker pubkey-auth"]
+    assert maker2["taker fill-pubkey"].max == 5
+    #a new sequence does not record the time since the last one
+    clock.advance(100)
+    assert m.mark_stage("taker", "fill", "J5maker2", first=True) is None
+    assert m.histograms["taker fill-pubkey"].count == 2
+    #stages without a counterparty
+    m.mark_stage("coinjoin", "fill", first=True)
+    clock.advance(60)
+    m.mark_stage("coinjoin", "ioauth")
+    assert m.histograms["coinjoin fill-ioauth"].max == 60
+    assert None not in m.counterparties
+    with m.timer("nick_sig_verify", "J5maker1"):
+        clock.advance(0.01)
+    assert m.counterparties["J5maker1"][0]["nick_sig_verify"].count == 1
+    m.increment("taker stage1_timeout", "J5maker1")
+    m.increment("taker stage1_timeout", "J5maker2")
+    assert m.counters["taker stage1_timeout"] == 2
+    assert m.counterparties["J5maker2"][1] == {"taker stage1_timeout": 1}
+
+
+def test_bounds():
+    m, clock = get_metrics()
+    m.max_counterparties = 2
+    m.max_stages = 2
+    for nick in ["a", "b", "c"]:
+        m.mark_stage("taker", "fill", nick)
+        m.observe("x", 1, nick)
+    assert list(m.counterparties) == ["b", "c"]
+    assert list(m.stages) == [("taker", "b"), ("taker", "c")]
+    m.observe("x", 1, "b")
+    m.observe("x", 1, "d")
+    assert list(m.counterparties) == ["b", "d"]
+
+
+def test_export(tmpdir):
+    m, clock = get_metrics()
+    m.mark_stage("taker", "tx", "J5maker1")
+    clock.advance(4)
+    m.mark_stage("taker", "sig", "J5maker1")
+    d = json.loads(m.to_json())
+    assert d['histograms']['taker tx-sig']['count'] == 1
+    assert d['counterparties']['J5maker1']['histograms']['taker tx-sig'][
+        'max'] == 4
+    rows = list(csv.DictReader(StringIO(m.to_csv())))
+    assert [(r['name'], r['counterparty'], r['count']) for r in rows] == [
+        ("taker tx-sig", "", "1"), ("taker tx-sig", "J5maker1", "1")]
+    #the file is written every interval, in the format given by its name
+    for name in ["metrics.json", "metrics.csv"]:
+        path = str(tmpdir.join(name))
+        exporter = MetricsExporter(m, path, interval=10, reactor=clock)
+        exporter.start()
+        assert not tmpdir.join(name).check()
+        clock.advance(10)
+        data = tmpdir.join(name).read()
+        assert data == (m.to_csv() if name.endswith(".csv") else m.to_json())
+        assert not tmpdir.join(name + ".tmp").check()
+        exporter.stop()
+        assert not exporter.loop.running
+    request = DummyRequest([""])
+    assert json.loads(MetricsResource(m).render_GET(request)) == json.loads(
+        m.to_json())
+    request = DummyRequest([""])
+    request.args = {"format": ["csv"]}
+    assert MetricsResource(m).render_GET(request) == m.to_csv()
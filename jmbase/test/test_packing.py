@@ -0,0 +1,91 @@
+#! /usr/bin/env python
+from __future__ import absolute_import, print_function
+'''Tests of the packed encoding of AMP arguments, and of BigString.'''
+
+import pytest
+
+from jmbase.bigstring import BigString, CHUNK_MAX
+from jmbase.packing import pack, unpack, PackingError, Packed, HexBytes
+
+
+def make_offers(n):
+    return [{'counterparty': u'J5maker' + unicode(i), 'oid': i,
+             'ordertype': 'swreloffer', 'minsize': 27300,
+             'maxsize': 10**8 + i, 'txfee': 1000,
+             'cjfee': '0.0002' if i % 2 else 250} for i in range(n)]
+
+
+@pytest.mark.parametrize("value", [
+    None, True, False, 0, -1, 2**63 - 1, -2**63, 2**64, -2**70, 1.5,
+    "", "bytes\x00\xff", u"", u"unicod\xe9", [], {},
+    [1, "a", u"b", None, [2, [3]], {"k": [True]}],
+    {"a": 1, u"b": 2, 3: "c", None: None},
+    #tables: uniform dicts, with int, str, unicode and mixed columns
+    make_offers(2), make_offers(100),
+    [{'a': True, 'b': 2**64}, {'a': False, 'b': 1}],
+    [{u'x\xe9': u'\xe9'}, {u'x\xe9': u'y'}],
+    [{'a': 1}, {'b': 1}], [{}, {}], [{'a': 1}, {'a': 2}, 3],
+    {'add': make_offers(3), 'cancel': [["J5a", 0], ["J5b", 1]]},
+])
+def test_roundtrip(value):
+    assert unpack(pack(value)) == value
+
+
+def test_types():
+    value = unpack(pack([(1, "a"), {"s": "x", "u": u"x"}]))
+    assert value == [[1, "a"], {"s": "x", "u": u"x"}]
+    assert type(value[1]["s"]) is str and type(value[1]["u"]) is unicode
+    offers = unpack(pack(make_offers(10)))
+    assert [type(o['counterparty']) for o in offers] == [unicode] * 10
+    assert [type(o['ordertype']) for o in offers] == [str] * 10
+    with pytest.raises(PackingError):
+        pack(object())
+    with pytest.raises(PackingError):
+        pack([set()])
+
+
+def test_compact():
+    import json
+    offers = make_offers(1000)
+    assert len(pack(offers)) < len(json.dumps(offers)) / 2
+
+
+@pytest.mark.parametrize("data", [
+    "", "x", "s\x00\x00\x00\x05abc", "l\x00\x00\x00\x02N", "NN",
+    "l\xff\xff\xff\xffN", "i\x00\x00", "m\x00\x00\x00\x01lNNN",
+    pack(make_offers(10))[:-3], pack(make_offers(10)) + "N",
+    pack(make_offers(10)).replace("S", "Z", 1),
+])
+def test_invalid(data):
+    with pytest.raises(PackingError):
+        unpack(data)
+
+
+def to_and_from_box(arg, value):
+    strings = {}
+    arg.toBox("v", strings, {"v": value}, None)
+    objects = {}
+    arg.fromBox("v", strings, objects, None)
+    return strings, objects["v"]
+
+
+def test_bigstring():
+    for n in [0, 10, CHUNK_MAX, CHUNK_MAX + 1, 3 * CHUNK_MAX + 10]:
+        value = "".join(chr(i % 256) for i in range(n))
+        strings, result = to_and_from_box(BigString(), value)
+        assert result == value
+        assert len(strings) == max(1, -(-n // CHUNK_MAX))
+        assert all(len(s) <= CHUNK_MAX for s in strings.values())
+        if n > CHUNK_MAX:
+            assert strings["v.2"] == value[CHUNK_MAX:2 * CHUNK_MAX]
+
+
+def test_arguments():
+    offers = make_offers(5000)
+    strings, result = to_and_from_box(Packed(), offers)
+    assert len(strings) > 1
+    assert result == offers
+    txhex = "0100000001" + "ab" * 100000
+    strings, result = to_and_from_box(HexBytes(), txhex)
+    assert result == txhex
+    assert sum(len(s) for s in strings.values()) == len(txhex) // 2
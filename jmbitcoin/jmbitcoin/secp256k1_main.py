@@ -123,6 +123,31 @@ def podle_PrivateKey(priv):
     """
     return secp256k1.PrivateKey(priv, ctx=ctx)
 
+def podle_multiply(s, P):
+    """Returns s*P as a new PublicKey object, for a 32 byte
+    binary scalar s and a PublicKey object P (which is not
+    modified). Unlike multiply(), this works on the parsed
+    point directly, using the global context, so avoids
+    serialization round trips in hot loops (PoDLE verification).
+    """
+    if not isinstance(s, bytes) or len(s) != 32:
+        raise TypeError("scalar must be composed of 32 bytes")
+    newpub = secp256k1.PublicKey(secp256k1.ffi.new('secp256k1_pubkey *',
+                                                   P.public_key[0]),
+                                 ctx=ctx)
+    if not secp256k1.lib.secp256k1_ec_pubkey_tweak_mul(ctx, newpub.public_key,
+                                                       s):
+        raise Exception("Tweak is out of range")
+    return newpub
+
+def podle_add(P, Q):
+    """Returns P+Q as a new PublicKey object, for PublicKey
+    objects P and Q.
+    """
+    r = secp256k1.PublicKey(ctx=ctx)
+    r.combine([P.public_key, Q.public_key])
+    return r
+
 
 def privkey_to_address(priv, from_hex=True, magicbyte=0):
     return pubkey_to_address(privkey_to_pubkey(priv, from_hex), magicbyte)
@@ -26,7 +26,7 @@ from .cryptoengine import BTCEngine, BTC_P2PKH, BTC_P2SH_P2WPKH, EngineError
 from .configure import (
     load_program_config, get_p2pk_vbyte, jm_single, get_network,
     validate_address, get_irc_mchannels, get_blockchain_interface_instance,
-    get_p2sh_vbyte, set_config, is_segwit_mode)
+    get_p2sh_vbyte, set_config, is_segwit_mode, get_privmsg_limits)
 from .blockchaininterface import (BlockchainInterface, sync_wallet,
                                   RegtestBitcoinCoreInterface, BitcoinCoreInterface)
 from .electruminterface import ElectrumInterface
@@ -35,13 +35,17 @@ from .client_protocol import (JMTakerClientProtocol, JMClientProtocolFactory,
 from .podle import (set_commitment_file, get_commitment_file,
                     add_external_commitments,
                     PoDLE, generate_podle, get_podle_commitments,
-                    update_commitments)
+                    update_commitments, PoDLECommitmentStore,
+                    get_commitment_store, import_commitments,
+                    export_commitments)
 from .output import generate_podle_error_string, fmt_utxos, fmt_utxo,\
     fmt_tx_data
 from .schedule import (get_schedule, get_tumble_schedule, schedule_to_text,
                        tweak_tumble_schedule, human_readable_schedule_entry,
                        schedule_to_text)
-from .commitment_utils import get_utxo_info, validate_utxo_data, quit
+from .commitment_utils import (get_utxo_info, validate_utxo_data, quit,
+                               read_utxo_file, generate_external_commitments,
+                               add_bulk_external_commitments)
 from .taker_utils import (tumbler_taker_finished_update, restart_waiter,
                              restart_wait, get_tumble_log, direct_send,
                              tumbler_filter_orders_callback)
@@ -50,7 +54,11 @@ from .wallet_utils import (
     open_test_wallet_maybe, create_wallet, get_wallet_cls, get_wallet_path,
     wallet_display)
 from .maker import Maker
-from .yieldgenerator import YieldGenerator, YieldGeneratorBasic, ygmain
+from .yieldgenerator import (YieldGenerator, YieldGeneratorBasic, OfferManager,
+                             ygmain)
+from .yieldstats import YieldStats, YieldStatsError, yield_stats_main
+from .orderbook_archive import (OrderbookArchive, OrderbookArchiver,
+                                OrderbookArchiveError)
 # Set default logging handler to avoid "No handler found" warnings.
 
 try:
@@ -32,6 +32,8 @@ def sync_wallet(wallet, fast=False):
 
 class BlockchainInterface(object):
     __metaclass__ = abc.ABCMeta
+    #seconds between checks of the transactions watched (add_tx_notify)
+    tx_poll_interval = 5.0
 
     def __init__(self):
         pass
@@ -55,7 +57,9 @@ class BlockchainInterface(object):
 
     @abc.abstractmethod
     def sync_unspent(self, wallet):
-        """Finds the unspent transaction outputs belonging to this wallet"""
+        """Finds the unspent transaction outputs belonging to this wallet;
+        may return a Deferred firing once they are found, if that is
+        done asynchronously."""
 
     def add_tx_notify(self, txd, unconfirmfun, confirmfun, notifyaddr,
                       wallet_name=None, timeoutfun=None, spentfun=None, txid_flag=True,
@@ -120,8 +124,7 @@ class BlockchainInterface(object):
             log.debug("Created watcher loop for txid: " + txid)
             loopkey = txid
         self.tx_watcher_loops[loopkey] = [loop, False, False, False]
-        #Hardcoded polling interval, but in any case it can be very short.
-        loop.start(5.0)
+        loop.start(self.tx_poll_interval)
         #Give up on un-broadcast transactions and broadcast but not confirmed
         #transactions as per settings in the config.
         reactor.callLater(float(jm_single().config.get("TIMEOUT",
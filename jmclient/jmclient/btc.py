@@ -113,6 +113,17 @@ except ImportError:
             return r.serialize()
         return r
     
+    def podle_multiply(s, P):
+        """Returns s*P as a new PPubKey, for 32 byte scalar s
+        and PPubKey P.
+        """
+        return PPubKey(ebt.point_to_ser(P._point * decode(s, 256)))
+
+    def podle_add(P, Q):
+        """Returns P+Q as a new PPubKey.
+        """
+        return PPubKey(ebt.point_to_ser(P._point + Q._point))
+
     def add_pubkeys(pubkeys, usehex):
         """Pubkeys should be a list (for compatibility).
         """
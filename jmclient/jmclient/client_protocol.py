@@ -1,6 +1,6 @@
 #! /usr/bin/env python
 from __future__ import print_function
-from twisted.internet import protocol, reactor, task
+from twisted.internet import protocol, reactor, task, defer
 from twisted.internet.error import (ConnectionLost, ConnectionAborted,
                                     ConnectionClosed, ConnectionDone)
 from twisted.protocols import amp
@@ -15,9 +15,9 @@ import hashlib
 import os
 import sys
 from jmclient import (jm_single, get_irc_mchannels, get_log, get_p2sh_vbyte,
-                      RegtestBitcoinCoreInterface)
+                      RegtestBitcoinCoreInterface, get_privmsg_limits)
 from .output import fmt_tx_data
-from jmbase import _byteify
+from jmbase import _byteify, get_metrics, MetricsExporter
 import btc
 
 jlog = get_log()
@@ -87,23 +87,27 @@ class JMClientProtocol(amp.AMP):
         self.defaultCallbacks(d)
         return {'accepted': True}
 
-    @commands.JMRequestMsgSig.responder
-    def on_JM_REQUEST_MSGSIG(self, nick, cmd, msg, msg_to_be_signed, hostid):
+    def sign_nick_message(self, msg, msg_to_be_signed):
+        """Returns msg with our nick pubkey and its signature
+        over msg_to_be_signed appended.
+        """
         sig = btc.ecdsa_sign(str(msg_to_be_signed), self.nick_priv)
-        msg_to_return = str(msg) + " " + self.nick_pubkey + " " + sig
-        d = self.callRemote(commands.JMMsgSignature,
-                            nick=nick,
-                            cmd=cmd,
-                            msg_to_return=msg_to_return,
-                            hostid=hostid)
-        self.defaultCallbacks(d)
-        return {'accepted': True}
+        return str(msg) + " " + self.nick_pubkey + " " + sig
 
-    @commands.JMRequestMsgSigVerify.responder
-    def on_JM_REQUEST_MSGSIG_VERIFY(self, msg, fullmsg, sig, pubkey, nick,
-                                    hashlen, max_encoded, hostid):
+    def verify_nick_message(self, msg, sig, pubkey, nick, hashlen,
+                            max_encoded):
+        """Returns True if sig is a valid signature of msg by pubkey,
+        and pubkey hashes to nick.
+        """
         verif_result = True
-        if not btc.ecdsa_verify(str(msg), sig, pubkey):
+        try:
+            with get_metrics().timer("nick_sig_verify"):
+                sig_ok = btc.ecdsa_verify(str(msg), sig, pubkey)
+        except Exception as e:
+            #a malformed sig must not fail the other messages in its batch
+            jlog.debug("nick signature could not be parsed: " + repr(e))
+            sig_ok = False
+        if not sig_ok:
             jlog.debug("nick signature verification failed, ignoring.")
             verif_result = False
         #check that nick matches hash of pubkey
@@ -115,6 +119,24 @@ class JMClientProtocol(amp.AMP):
             jlog.debug("Nick hash check failed, expected: " + str(nick_unpadded)
                        + ", got: " + str(btc.changebase(nick_pkh_raw, 256, 58)))
             verif_result = False
+        return verif_result
+
+    @commands.JMRequestMsgSig.responder
+    def on_JM_REQUEST_MSGSIG(self, nick, cmd, msg, msg_to_be_signed, hostid):
+        msg_to_return = self.sign_nick_message(msg, msg_to_be_signed)
+        d = self.callRemote(commands.JMMsgSignature,
+                            nick=nick,
+                            cmd=cmd,
+                            msg_to_return=msg_to_return,
+                            hostid=hostid)
+        self.defaultCallbacks(d)
+        return {'accepted': True}
+
+    @commands.JMRequestMsgSigVerify.responder
+    def on_JM_REQUEST_MSGSIG_VERIFY(self, msg, fullmsg, sig, pubkey, nick,
+                                    hashlen, max_encoded, hostid):
+        verif_result = self.verify_nick_message(msg, sig, pubkey, nick,
+                                                hashlen, max_encoded)
         d = self.callRemote(commands.JMMsgSignatureVerify,
                             verif_result=verif_result,
                             nick=nick,
@@ -123,6 +145,33 @@ class JMClientProtocol(amp.AMP):
         self.defaultCallbacks(d)
         return {'accepted': True}
 
+    @commands.JMRequestMsgSigBatch.responder
+    def on_JM_REQUEST_MSGSIG_BATCH(self, requests):
+        signatures = [{'nick': r['nick'],
+                       'cmd': r['cmd'],
+                       'msg_to_return': self.sign_nick_message(
+                           r['msg'], r['msg_to_be_signed']),
+                       'hostid': r['hostid']} for r in requests]
+        for batch in commands.split_amplist(signatures):
+            d = self.callRemote(commands.JMMsgSignatureBatch,
+                                signatures=batch)
+            self.defaultCallbacks(d)
+        return {'accepted': True}
+
+    @commands.JMRequestMsgSigVerifyBatch.responder
+    def on_JM_REQUEST_MSGSIG_VERIFY_BATCH(self, requests):
+        results = [{'verif_result': self.verify_nick_message(
+                        r['msg'], r['sig'], r['pubkey'], r['nick'],
+                        r['hashlen'], r['max_encoded']),
+                    'nick': r['nick'],
+                    'fullmsg': r['fullmsg'],
+                    'hostid': r['hostid']} for r in requests]
+        for batch in commands.split_amplist(results):
+            d = self.callRemote(commands.JMMsgSignatureVerifyBatch,
+                                results=batch)
+            self.defaultCallbacks(d)
+        return {'accepted': True}
+
 class JMMakerClientProtocol(JMClientProtocol):
     def __init__(self, factory, maker, nick_priv=None):
         self.factory = factory
@@ -174,13 +223,24 @@ class JMMakerClientProtocol(JMClientProtocol):
         #only here because Init message uses this field; not used by makers TODO
         minmakers = jm_single().config.getint("POLICY", "minimum_makers")
         maker_timeout_sec = jm_single().maker_timeout_sec
+        verify_nick_sigs = jm_single().config.get(
+            "DAEMON", "verify_nick_sigs") != 'false'
+        hedge_privmsgs = jm_single().config.get(
+            "MESSAGING", "hedge_privmsgs") == 'true'
+        accept_commitment_broadcasts = jm_single().config.getint(
+            "POLICY", "accept_commitment_broadcasts") > 0
 
         d = self.callRemote(commands.JMInit,
                             bcsource=blockchain_source,
                             network=network,
                             irc_configs=json.dumps(irc_configs),
                             minmakers=minmakers,
-                            maker_timeout_sec=maker_timeout_sec)
+                            maker_timeout_sec=maker_timeout_sec,
+                            verify_nick_sigs=verify_nick_sigs,
+                            hedge_privmsgs=hedge_privmsgs,
+                            accept_commitment_broadcasts=
+                            accept_commitment_broadcasts,
+                            **get_privmsg_limits())
         self.defaultCallbacks(d)
 
     @commands.JMAuthReceived.responder
@@ -206,7 +266,7 @@ class JMMakerClientProtocol(JMClientProtocol):
 
     @commands.JMTXReceived.responder
     def on_JM_TX_RECEIVED(self, nick, txhex, offer):
-        offer = _byteify(json.loads(offer))
+        offer = _byteify(offer)
         retval = self.client.on_tx_received(nick, txhex, offer)
         if not retval[0]:
             jlog.info("Maker refuses to continue on receipt of tx")
@@ -244,12 +304,7 @@ class JMMakerClientProtocol(JMClientProtocol):
             for u, tx_data in removed_utxos.items())))
         to_cancel, to_announce = self.client.on_tx_unconfirmed(offerinfo,
                                                                txid, removed_utxos)
-        self.client.modify_orders(to_cancel, to_announce)
-        d = self.callRemote(commands.JMAnnounceOffers,
-                            to_announce=json.dumps(to_announce),
-                            to_cancel=json.dumps(to_cancel),
-                            offerlist=json.dumps(self.client.offerlist))
-        self.defaultCallbacks(d)
+        self.modify_orders(to_cancel, to_announce)
 
     def confirm_callback(self, txd, txid, confirmations):
         #find the offer for this tx
@@ -262,19 +317,28 @@ class JMMakerClientProtocol(JMClientProtocol):
         if not offerinfo:
             jlog.info("Failed to find notified unconfirmed transaction: " + txid)
             return
-        jm_single().bc_interface.wallet_synced = False
-        jm_single().bc_interface.sync_unspent(self.client.wallet)
         jlog.info('tx in a block: ' + txid)
-        self.wait_for_sync_loop = task.LoopingCall(self.modify_orders, offerinfo,
-                                                   confirmations, txid)
-        self.wait_for_sync_loop.start(2.0)
-
-    def modify_orders(self, offerinfo, confirmations, txid):
-        if not jm_single().bc_interface.wallet_synced:
-            return
-        self.wait_for_sync_loop.stop()
+        #resync, to pick up any deposits or spends made elsewhere as well
+        #as our outputs; once it is complete (at once, unless the
+        #interface returns a Deferred), the offers are updated from the
+        #balance changes it caused
+        d = defer.maybeDeferred(jm_single().bc_interface.sync_unspent,
+                                self.client.wallet)
+        d.addCallback(self.on_resynced, offerinfo, confirmations, txid)
+        d.addErrback(lambda f: jlog.error("Failed to resync the wallet: " +
+                                          f.getErrorMessage()))
+
+    def on_resynced(self, _, offerinfo, confirmations, txid):
         to_cancel, to_announce = self.client.on_tx_confirmed(offerinfo,
                                                              confirmations, txid)
+        self.modify_orders(to_cancel, to_announce)
+
+    def modify_orders(self, to_cancel, to_announce):
+        """Applies the changes to our offers, and has the daemon
+        announce them, if there are any.
+        """
+        if not to_cancel and not to_announce:
+            return
         self.client.modify_orders(to_cancel, to_announce)
         d = self.callRemote(commands.JMAnnounceOffers,
                             to_announce=json.dumps(to_announce),
@@ -286,6 +350,10 @@ class JMTakerClientProtocol(JMClientProtocol):
 
     def __init__(self, factory, client, nick_priv=None):
         self.orderbook = None
+        #replica of the daemon's orderbook, keyed by (counterparty, oid),
+        #and its version, kept up to date with changes on each request.
+        self.offers = {}
+        self.orderbook_version = None
         JMClientProtocol.__init__(self, factory, client, nick_priv)
 
     def clientStart(self):
@@ -303,6 +371,15 @@ class JMTakerClientProtocol(JMClientProtocol):
         irc_configs = get_irc_mchannels()
         minmakers = jm_single().config.getint("POLICY", "minimum_makers")
         maker_timeout_sec = jm_single().maker_timeout_sec
+        verify_nick_sigs = jm_single().config.get(
+            "DAEMON", "verify_nick_sigs") != 'false'
+        hedge_privmsgs = jm_single().config.get(
+            "MESSAGING", "hedge_privmsgs") == 'true'
+
+        maker_timeout_min_sec = jm_single().config.get(
+            "TIMEOUT", "maker_timeout_min_sec")
+        maker_timeout_min_sec = int(
+            maker_timeout_min_sec) if maker_timeout_min_sec else None
 
         #To avoid creating yet another config variable, we set the timeout
         #to 20 * maker_timeout_sec.
@@ -315,7 +392,11 @@ class JMTakerClientProtocol(JMClientProtocol):
                             network=network,
                             irc_configs=json.dumps(irc_configs),
                             minmakers=minmakers,
-                            maker_timeout_sec=maker_timeout_sec)
+                            maker_timeout_sec=maker_timeout_sec,
+                            verify_nick_sigs=verify_nick_sigs,
+                            hedge_privmsgs=hedge_privmsgs,
+                            maker_timeout_min_sec=maker_timeout_min_sec,
+                            **get_privmsg_limits())
         self.defaultCallbacks(d)
 
     def stallMonitor(self, schedule_index):
@@ -379,7 +460,6 @@ class JMTakerClientProtocol(JMClientProtocol):
         the ioauth data and returns the proposed
         transaction, passes the phase 2 initiating data to the daemon.
         """
-        ioauth_data = json.loads(ioauth_data)
         if not success:
             jlog.info("Makers who didnt respond: " + str(ioauth_data))
             self.client.add_ignored_makers(ioauth_data)
@@ -396,9 +476,24 @@ class JMTakerClientProtocol(JMClientProtocol):
                 reactor.callLater(0, self.make_tx, nick_list, txhex)
                 return {'accepted': True}
 
+    def update_offers(self, orderbook, version=None, full=None):
+        """Apply the orderbook data from the daemon to the local
+        replica and return it as a list of offers.
+        """
+        if full is False and self.orderbook_version is not None:
+            for counterparty, oid in orderbook['cancel']:
+                self.offers.pop((counterparty, oid), None)
+            for o in orderbook['add']:
+                self.offers[(o['counterparty'], o['oid'])] = o
+        else:
+            self.offers = dict(((o['counterparty'], o['oid']), o)
+                               for o in orderbook)
+        self.orderbook_version = version
+        return self.offers.values()
+
     @commands.JMOffers.responder
-    def on_JM_OFFERS(self, orderbook):
-        self.orderbook = json.loads(orderbook)
+    def on_JM_OFFERS(self, orderbook, version=None, full=None):
+        self.orderbook = self.update_offers(orderbook, version, full)
         #Removed for now, as judged too large, even for DEBUG:
         #jlog.debug("Got the orderbook: " + str(self.orderbook))
         retval = self.client.initialize(self.orderbook)
@@ -435,7 +530,8 @@ class JMTakerClientProtocol(JMClientProtocol):
         return {'accepted': True}
 
     def get_offers(self):
-        d = self.callRemote(commands.JMRequestOffers)
+        d = self.callRemote(commands.JMRequestOffers,
+                            since=self.orderbook_version)
         self.defaultCallbacks(d)
 
     def make_tx(self, nick_list, txhex):
@@ -467,7 +563,28 @@ class JMClientProtocolFactory(protocol.ClientFactory):
     def buildProtocol(self, addr):
         return self.protocol(self, self.client)
 
+def start_metrics_export():
+    """Starts writing, and if configured serving, the coinjoin stage
+    timings; see the LOGGING section of the config.
+    Does nothing if neither metrics_file nor metrics_port is set.
+    """
+    config = jm_single().config
+    path = config.get("LOGGING", "metrics_file")
+    port = config.get("LOGGING", "metrics_port")
+    if not (path or port):
+        return None
+    exporter = MetricsExporter(get_metrics(), path or None,
+                               config.getint("LOGGING", "metrics_interval"),
+                               int(port) if port else None)
+    exporter.start()
+    reactor.addSystemEventTrigger("before", "shutdown", exporter.stop)
+    return exporter
+
 def start_reactor(host, port, factory, ish=True, daemon=False, rs=True, gui=False): #pragma: no cover
+    """Connects factory, or each of a list of factories (as for
+    several makers in one process), to the daemon, first starting
+    the daemon if daemon is True.
+    """
     #(Cannot start the reactor in tests)
     #Not used in prod (twisted logging):
     #startLogging(stdout)
@@ -495,11 +612,14 @@ def start_reactor(host, port, factory, ish=True, daemon=False, rs=True, gui=Fals
                     jlog.error("Tried 100 ports but cannot listen on any of them. Quitting.")
                     sys.exit(1)
                 port += 1
-    if usessl:
-        ctx = ClientContextFactory()
-        reactor.connectSSL(host, port, factory, ctx)
-    else:
-        reactor.connectTCP(host, port, factory)
+    start_metrics_export()
+    factories = factory if isinstance(factory, list) else [factory]
+    for factory in factories:
+        if usessl:
+            ctx = ClientContextFactory()
+            reactor.connectSSL(host, port, factory, ctx)
+        else:
+            reactor.connectTCP(host, port, factory)
     if rs:
         if not gui:
             reactor.run(installSignalHandlers=ish)
@@ -1,8 +1,12 @@
 from __future__ import print_function
 
 import sys
+import time
+import itertools
+import multiprocessing
 import jmclient.btc as btc
 from jmclient import jm_single, get_p2pk_vbyte, get_p2sh_vbyte
+from jmclient.podle import PoDLE, add_external_commitments
 
 def quit(parser, errmsg): #pragma: no cover
     parser.error(errmsg)
@@ -31,7 +35,87 @@ def get_utxo_info(upriv):
         print("failed to parse privkey, make sure it's WIF compressed format.")
         raise
     return u, priv
-    
+
+def read_utxo_file(filename):
+    """Yields (utxo, privkey) pairs from a csv file of lines of the form
+    txid:N, WIF-compressed-privkey, one line at a time, so that
+    arbitrarily large files need not be held in memory.
+    """
+    with open(filename, "rb") as f:
+        for ul in f:
+            ul = ul.strip()
+            if ul:
+                yield get_utxo_info(ul)
+
+def generate_external_commitment(args):
+    """Returns (utxo, entry) with entry the external commitments
+    for the utxo, one per NUMS index in range(tries), in the format
+    of add_external_commitments. A module level function taking a
+    single tuple (utxo, WIF privkey, tries, vbyte) so that it can be
+    run in a worker process.
+    """
+    u, priv, tries, vbyte = args
+    hexpriv = btc.from_wif_privkey(priv, vbyte=vbyte)
+    podle = PoDLE(u, hexpriv)
+    entry = {'reveal': {}}
+    for i in range(tries):
+        r = podle.generate_podle(i)
+        entry['P'] = r['P']
+        entry['reveal'][i] = {'P2': r['P2'], 's': r['sig'], 'e': r['e']}
+    return u, entry
+
+def generate_external_commitments(utxo_datas, tries=None, processes=None,
+                                  progress=None, batch_size=256):
+    """Generate external PoDLE commitments for each (utxo, privkey) in the
+    iterable utxo_datas, across a pool of worker processes (processes=None
+    means one per cpu; 1 means generate in this process).
+    utxo_datas is consumed batch_size items at a time; if progress is given
+    it is called as progress(utxo count, commitment count, elapsed seconds)
+    after each batch.
+    Returns a dict suitable for add_external_commitments.
+    """
+    if tries is None:
+        tries = jm_single().config.getint("POLICY", "taker_utxo_retries")
+    vbyte = get_p2pk_vbyte()
+    #the input is read here rather than by the pool's task feeder thread,
+    #so that parsing errors propagate to the caller.
+    utxo_datas = iter(utxo_datas)
+    pool = None if processes == 1 else multiprocessing.Pool(processes)
+    ecs = {}
+    st = time.time()
+    try:
+        while True:
+            batch = [(u, priv, tries, vbyte) for u, priv in
+                     itertools.islice(utxo_datas, batch_size)]
+            if not batch:
+                break
+            if pool:
+                results = pool.imap_unordered(generate_external_commitment,
+                                              batch, chunksize=16)
+            else:
+                results = itertools.imap(generate_external_commitment, batch)
+            for u, entry in results:
+                ecs[u] = entry
+            if progress:
+                progress(len(ecs), len(ecs) * tries, time.time() - st)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    return ecs
+
+def add_bulk_external_commitments(utxo_datas, tries=None, processes=None,
+                                  progress=None):
+    """Generate the external commitments for all of utxo_datas (see
+    generate_external_commitments) and persist them with a single
+    update of the commitments store. Returns the number of utxos added.
+    """
+    ecs = generate_external_commitments(utxo_datas, tries=tries,
+                                        processes=processes,
+                                        progress=progress)
+    add_external_commitments(ecs)
+    return len(ecs)
+
 def validate_utxo_data(utxo_datas, retrieve=False, segwit=False):
     """For each txid: N, privkey, first
     convert the privkey and convert to address,
@@ -105,6 +105,10 @@ daemon_host = localhost
 #by default the client-daemon connection is plaintext, set to 'true' to use TLS;
 #for this, you need to have a valid (self-signed) certificate installed
 use_ssl = false
+#set to 'false' to have nick signatures on received messages verified
+#by the client rather than by the daemon (the daemon can only do this
+#if the jmbitcoin package is installed alongside it)
+verify_nick_sigs = true
 
 [BLOCKCHAIN]
 #options: bitcoin-rpc, regtest, electrum-server
@@ -126,6 +130,18 @@ usessl = true, true
 socks5 = false, false
 socks5_host = localhost, localhost
 socks5_port = 9050, 9050
+#set to 'true' to send the messages negotiating a coinjoin over every
+#server above on which the counterparty is present, not only one, so
+#that a slow server does not delay the coinjoin
+hedge_privmsgs = false
+#limits on the reassembly of long messages received in parts: the
+#largest message in bytes (a coinjoin transaction of the largest
+#standard size is about 180000 bytes in its encrypted form), the most
+#counterparties whose messages are being received at once, and how
+#many seconds to wait for the next part of a message
+max_privmsg_size = 400000
+max_partial_privmsgs = 500
+partial_privmsg_timeout = 60
 #for tor
 #host = 6dvj6v5imhny3anf.onion, cfyfz6afpgfeirst.onion
 #onion / i2p have their own ports on CGAN
@@ -138,9 +154,22 @@ socks5_port = 9050, 9050
 # Possible choices: DEBUG / INFO / WARNING / ERROR
 # Log level for the files in the logs-folder will always be DEBUG
 console_log_level = INFO
+# Set to a file name to have the time taken by each stage of coinjoins,
+# overall and per counterparty, written there every metrics_interval
+# seconds (as CSV if the name ends in .csv, else JSON); useful for
+# finding slow makers and tuning maker_timeout_sec. With no_daemon = 0,
+# only the client's stages are included.
+metrics_file =
+metrics_interval = 60
+# Set to a port number to also serve them on http://localhost:<port>/
+metrics_port =
 
 [TIMEOUT]
 maker_timeout_sec = 60
+# Once enough makers' response times have been seen, the wait for
+# responses is shortened to fit them, but not below this many seconds;
+# leave empty to always wait maker_timeout_sec (or until all respond)
+maker_timeout_min_sec = 20
 unconfirm_timeout_sec = 90
 confirm_timeout_hours = 6
 
@@ -213,8 +242,14 @@ taker_utxo_amtpercent = 20
 #someone fills your blacklist file with a lot of data.
 accept_commitment_broadcasts = 1
 
+#(Makers) seconds for which the utxos offered to a taker are not
+#offered to any other, unless the transaction is seen before then.
+utxo_reservation_sec = 600
+
 #Location of your commitments.json file (stores commitments you've used
 #and those you want to use in future), relative to the scripts directory.
+#Recent updates are appended to a log file next to it (same name + '.log'),
+#which is folded back into the json file periodically.
 commit_file_location = cmtdata/commitments.json
 """
 
@@ -245,6 +280,15 @@ def get_irc_mchannels():
     return configs
 
 
+def get_privmsg_limits():
+    """The limits on reassembly of privmsgs in the daemon, as keyword
+    arguments of JMInit.
+    """
+    return dict((k, jm_single().config.getint("MESSAGING", k)) for k in [
+        "max_privmsg_size", "max_partial_privmsgs",
+        "partial_privmsg_timeout"])
+
+
 def get_config_irc_channel(channel_name):
     channel = "#" + channel_name
     if get_network() == 'testnet':
@@ -8,32 +8,90 @@ import socket
 import threading
 import ssl
 import binascii
+import hashlib
+from collections import deque
 from twisted.internet.protocol import ClientFactory
 from twisted.internet.ssl import ClientContextFactory
 from twisted.protocols.basic import LineReceiver
 from twisted.internet import reactor, task, defer
 from .blockchaininterface import BlockchainInterface
-from .configure import get_p2sh_vbyte
+from .configure import get_p2sh_vbyte, get_p2pk_vbyte
 from .support import get_log
 from .electrum_data import (get_default_ports, get_default_servers,
                             set_electrum_testnet, DEFAULT_PROTO)
 
 log = get_log()
 
+#Sent with server.version, which must be the first request on a
+#connection; the scripthash methods need protocol version 1.1,
+#server.ping 1.2.
+CLIENT_NAME = "joinmarket"
+PROTOCOL_VERSIONS = ["1.2", "1.4"]
+
 class ElectrumConnectionError(Exception):
     pass
 
+def script_to_scripthash(script):
+    """The hash by which the Electrum protocol (1.1 on) refers to an
+    output script (binary): its sha256, byte reversed, in hex.
+    """
+    return binascii.hexlify(hashlib.sha256(script).digest()[::-1])
+
+def address_to_scripthash(addr):
+    return script_to_scripthash(binascii.unhexlify(
+        btc.address_to_script(addr)))
+
+def script_to_address(script):
+    """Address of an output script (hex), of the configured network.
+    """
+    if btc.is_p2pkh_script(binascii.unhexlify(script)):
+        return btc.script_to_address(script, get_p2pk_vbyte())
+    return btc.script_to_address(script, get_p2sh_vbyte())
+
+def get_header_height(header):
+    """The height in a blockchain.headers.subscribe result or
+    notification (keyed differently in earlier protocol versions).
+    """
+    if 'height' in header:
+        return header['height']
+    return header.get('block_height')
+
 class TxElectrumClientProtocol(LineReceiver):
-    #map deferreds to msgids to correctly link response with request
-    deferreds = {}
+    """Requests are pipelined: sent without waiting for the responses
+    to earlier ones, up to max_in_flight at a time, others being queued
+    until responses arrive. Requests made in the same reactor iteration
+    are sent together, as JSON-RPC batches of up to max_batch.
+    Responses are linked to their requests (deferreds) by id; messages
+    without one are notifications, for ElectrumInterface.on_notification.
+    server.version is sent on its own, the other requests being queued
+    until it is answered.
+    """
     delimiter = "\n"
+    #batched responses (such as histories) can be large
+    MAX_LENGTH = 64 * 1024 * 1024
+    max_in_flight = 500
+    max_batch = 100
+    ping_interval = 60.0
+    clock = reactor
 
     def __init__(self, factory):
         self.factory = factory
+        self.msg_id = 0
+        #deferreds of the requests sent, by id
+        self.in_flight = {}
+        #(request, deferred) of the requests not yet sent
+        self.queued = deque()
+        self.send_call = None
+        self.pingloop = None
+        self.version_negotiated = False
 
     def connectionMade(self):
         log.debug('connection to Electrum succesful')
-        self.msg_id = 0
+        self.msg_id = self.msg_id + 1
+        d = self.in_flight[self.msg_id] = defer.Deferred()
+        self.send_json({'id': self.msg_id, 'method': 'server.version',
+                        'params': [CLIENT_NAME, PROTOCOL_VERSIONS]})
+        d.addCallback(self.on_server_version)
         if self.factory.bci.wallet:
             #Use connectionMade as a trigger to start wallet sync,
             #if the reactor start happened after the call to wallet sync
@@ -42,16 +100,47 @@ class TxElectrumClientProtocol(LineReceiver):
             self.factory.bci.sync_addresses(self.factory.bci.wallet)
         #these server calls must always be done to keep the connection open
         self.start_ping()
-        self.call_server_method('blockchain.numblocks.subscribe')
+        d = self.call_server_method('blockchain.headers.subscribe')
+        d.addCallback(self.on_headers_subscribed)
+        #subscriptions do not outlive a connection
+        self.factory.bci.subscribe_all()
+
+    def connectionLost(self, reason):
+        if self.pingloop and self.pingloop.running:
+            self.pingloop.stop()
+        if self.send_call and self.send_call.active():
+            self.send_call.cancel()
+        self.send_call = None
+        if self.in_flight or self.queued:
+            log.debug("Electrum connection lost with {} requests "
+                      "outstanding".format(len(self.in_flight) +
+                                            len(self.queued)))
+        self.in_flight = {}
+        self.queued.clear()
+
+    def on_server_version(self, response):
+        #(the queued requests are sent once the response is handled)
+        self.version_negotiated = True
+        if response.get('error'):
+            log.error("Electrum server does not support protocol versions "
+                      "{}: {}".format(PROTOCOL_VERSIONS, response['error']))
+        else:
+            log.debug("Electrum server version: " + str(response['result']))
+
+    def on_headers_subscribed(self, response):
+        if response.get('result'):
+            self.factory.bci.on_notification('blockchain.headers.subscribe',
+                                             [response['result']])
 
     def start_ping(self):
-        pingloop = task.LoopingCall(self.ping)
-        pingloop.start(60.0)
+        self.pingloop = task.LoopingCall(self.ping)
+        self.pingloop.clock = self.clock
+        self.pingloop.start(self.ping_interval, now=False)
 
     def ping(self):
         #We dont bother tracking response to this;
         #just for keeping connection active
-        self.call_server_method('server.version')
+        self.call_server_method('server.ping')
 
     def send_json(self, json_data):
         data = json.dumps(json_data).encode()
@@ -59,25 +148,60 @@ class TxElectrumClientProtocol(LineReceiver):
 
     def call_server_method(self, method, params=[]):
         self.msg_id = self.msg_id + 1
-        current_id = self.msg_id
-        self.deferreds[current_id] = defer.Deferred()
-        method_dict = {
-            'id': current_id,
-            'method': method,
-            'params': params
-        }
-        self.send_json(method_dict)
-        return self.deferreds[current_id]
+        d = defer.Deferred()
+        self.queued.append(({'id': self.msg_id, 'method': method,
+                             'params': params}, d))
+        if self.send_call is None:
+            self.send_call = self.clock.callLater(0, self.send_queued)
+        return d
+
+    def send_queued(self):
+        self.send_call = None
+        if not self.connected or not self.version_negotiated:
+            return
+        while self.queued and len(self.in_flight) < self.max_in_flight:
+            batch = []
+            while self.queued and len(batch) < self.max_batch and \
+                    len(self.in_flight) < self.max_in_flight:
+                request, d = self.queued.popleft()
+                self.in_flight[request['id']] = d
+                batch.append(request)
+            self.send_json(batch[0] if len(batch) == 1 else batch)
 
     def lineReceived(self, line):
         try:
             parsed = json.loads(line)
-            msgid = parsed['id']
-            linked_deferred = self.deferreds[msgid]
-        except:
+        except ValueError:
             log.debug("Ignored response from Electrum server: " + str(line))
             return
-        linked_deferred.callback(parsed)
+        for response in parsed if isinstance(parsed, list) else [parsed]:
+            self.response_received(response)
+        if self.queued:
+            self.send_queued()
+
+    def lineLengthExceeded(self, line):
+        log.error("Response from Electrum server too long, disconnecting")
+        return LineReceiver.lineLengthExceeded(self, line)
+
+    def response_received(self, response):
+        if not isinstance(response, dict):
+            log.debug("Ignored response from Electrum server: " +
+                      str(response))
+            return
+        linked_deferred = self.in_flight.pop(response.get('id'), None)
+        if linked_deferred is not None:
+            linked_deferred.callback(response)
+        elif 'method' in response:
+            try:
+                self.factory.bci.on_notification(response['method'],
+                                                 response.get('params', []))
+            except Exception as e:
+                #(which would otherwise drop the connection)
+                log.error("Failed to handle Electrum notification: " +
+                          repr(e))
+        else:
+            log.debug("Ignored response from Electrum server: " +
+                      str(response))
 
 class TxElectrumClientProtocolFactory(ClientFactory):
 
@@ -96,12 +220,23 @@ class TxElectrumClientProtocolFactory(ClientFactory):
         self.bci.start_electrum_proto(None)
 
 class ElectrumConn(threading.Thread):
+    """A connection serving blocking calls, single or batched, from
+    (only) one thread at a time. Calls raise ElectrumConnectionError
+    when not answered within timeout, on an error for a whole batch,
+    or once the connection is closed.
+    """
+    max_batch = 100
+    timeout = 60.0
 
     def __init__(self, server, port, proto):
         threading.Thread.__init__(self)
         self.daemon = True
         self.msg_id = 0
         self.RetQueue = Queue.Queue()
+        self.closed = False
+        #kept up to date by blockchain.headers.subscribe notifications,
+        #once subscribed
+        self.current_height = None
         try:
             if proto == 't':
                 self.s = socket.create_connection((server,int(port)))
@@ -120,53 +255,141 @@ class ElectrumConn(threading.Thread):
         except Exception as e:
             log.error("Error connecting to electrum server; trying again.")
             raise ElectrumConnectionError
+
+    def start(self):
+        threading.Thread.start(self)
+        #which must be answered before any other request is sent
+        response = self.call_server_method('server.version',
+                                           [CLIENT_NAME, PROTOCOL_VERSIONS])
+        if response.get('error'):
+            log.error("Electrum server does not support protocol versions "
+                      "{}: {}".format(PROTOCOL_VERSIONS, response['error']))
         self.ping()
 
     def run(self):
+        buf = b''
         while True:
-            all_data = None
-            while True:
-                data = self.s.recv(1024)
-                if data is None:
+            try:
+                data = self.s.recv(65536)
+            except (socket.error, ssl.SSLError) as e:
+                log.error("Electrum connection failed: " + repr(e))
+                data = None
+            if not data:
+                log.error("Electrum server closed the connection.")
+                self.closed = True
+                #wakes up any call waiting
+                self.RetQueue.put(None)
+                return
+            lines = (buf + data).split(b'\n')
+            buf = lines.pop()
+            for line in lines:
+                if not line.strip():
                     continue
-                if all_data is None:
-                    all_data = data
-                else:
-                    all_data = all_data + data
-                if '\n' in all_data:
-                    break
-            data_json = json.loads(all_data[:-1].decode())
-            self.RetQueue.put(data_json)
+                try:
+                    parsed = json.loads(line.decode())
+                except ValueError:
+                    log.debug("Ignored response from Electrum server: " +
+                              str(line))
+                    continue
+                for response in parsed if isinstance(parsed, list) \
+                        else [parsed]:
+                    if not isinstance(response, dict):
+                        log.debug("Ignored response from Electrum server: "
+                                  + str(response))
+                    elif response.get('id') is None and \
+                            'error' not in response:
+                        self.on_notification(response)
+                    else:
+                        self.RetQueue.put(response)
+
+    def on_notification(self, notification):
+        if notification.get('method') == 'blockchain.headers.subscribe':
+            self.current_height = get_header_height(
+                notification['params'][0])
 
     def ping(self):
+        if self.closed:
+            return
         log.debug('Sending Electrum server ping')
-        self.send_json({'id':0,'method':'server.version','params':[]})
+        try:
+            self.send_json({'id':0,'method':'server.ping','params':[]})
+        except ElectrumConnectionError:
+            return
         t = threading.Timer(60, self.ping)
         t.daemon = True
         t.start()
 
     def send_json(self, json_data):
         data = json.dumps(json_data).encode()
-        self.s.send(data + b'\n')
+        try:
+            self.s.sendall(data + b'\n')
+        except (socket.error, ssl.SSLError) as e:
+            self.closed = True
+            raise ElectrumConnectionError("Electrum connection failed: " +
+                                          repr(e))
+
+    def close(self):
+        self.closed = True
+        try:
+            self.s.close()
+        except (socket.error, ssl.SSLError):
+            pass
 
     def call_server_method(self, method, params=[]):
-        self.msg_id = self.msg_id + 1
-        current_id = self.msg_id
-        method_dict = {
-            'id': current_id,
-            'method': method,
-            'params': params
-        }
-        self.send_json(method_dict)
-        while True:
-            ret_data = self.RetQueue.get()
-            if ret_data.get('id', None) == current_id:
-                return ret_data
+        return self.call_server_methods([(method, params)])[0]
+
+    def call_server_methods(self, calls):
+        """Makes the calls, a list of (method, params), in batches of
+        up to max_batch (a single call is not batched), returning the
+        responses in order.
+        """
+        responses = []
+        for i in range(0, len(calls), self.max_batch):
+            responses.extend(self.call_batch(calls[i:i + self.max_batch]))
+        return responses
+
+    def call_batch(self, calls):
+        if self.closed:
+            raise ElectrumConnectionError("Electrum connection closed")
+        requests = []
+        for method, params in calls:
+            self.msg_id = self.msg_id + 1
+            requests.append({'id': self.msg_id, 'method': method,
+                             'params': params})
+        self.send_json(requests[0] if len(requests) == 1 else requests)
+        responses = {}
+        while len(responses) < len(requests):
+            try:
+                ret_data = self.RetQueue.get(timeout=self.timeout)
+            except Queue.Empty:
+                raise ElectrumConnectionError("No response from Electrum "
+                                              "server in {} seconds".format(
+                                                  self.timeout))
+            if ret_data is None:
+                raise ElectrumConnectionError("Electrum connection closed")
+            if ret_data.get('id') is None:
+                #the server could not parse the request (batch)
+                raise ElectrumConnectionError("Electrum request failed: " +
+                                              str(ret_data['error']))
+            if requests[0]['id'] <= ret_data['id'] <= requests[-1]['id']:
+                responses[ret_data['id']] = ret_data
             else:
                 log.debug(json.dumps(ret_data))
+        return [responses[r['id']] for r in requests]
+
+    def get_current_height(self):
+        if self.current_height is None:
+            self.current_height = get_header_height(self.call_server_method(
+                'blockchain.headers.subscribe')['result'])
+        return self.current_height
 
 class ElectrumInterface(BlockchainInterface):
-    BATCH_SIZE = 8
+    #addresses synced at a time on each branch (at least the gap limit)
+    BATCH_SIZE = 20
+    #watched transactions are checked when the server notifies a change
+    #to their scripts, or a new block (see add_tx_notify); polling is
+    #only a fallback
+    tx_poll_interval = 30.0
     def __init__(self, testnet=False, electrum_server=None):
         self.synctype = "sync-only"
         if testnet:
@@ -178,6 +401,11 @@ class ElectrumInterface(BlockchainInterface):
         #Format: {"txid": (loop, unconfirmed true/false, confirmed true/false,
         #spent true/false), ..}
         self.tx_watcher_loops = {}
+        #keys of tx_watcher_loops by the scripthashes they watch
+        self.scripthash_watchers = {}
+        #(wallet, script) of the synced wallets' scripts, by scripthash
+        self.wallet_scripts = {}
+        self.current_height = None
         self.wallet = None
         self.wallet_synced = False
 
@@ -201,14 +429,29 @@ class ElectrumInterface(BlockchainInterface):
         is asynchronous).
         """
         try:
-            s, p = self.get_server(None)
-            self.electrum_conn = ElectrumConn(s, p, DEFAULT_PROTO)
+            self.connect_electrum_conn()
         except ElectrumConnectionError:
             reactor.callLater(1.0, self.start_connection_thread)
-            return
-        self.electrum_conn.start()
-        #used to hold open server conn
-        self.electrum_conn.call_server_method('blockchain.numblocks.subscribe')
+
+    def connect_electrum_conn(self):
+        s, p = self.get_server(None)
+        conn = ElectrumConn(s, p, DEFAULT_PROTO)
+        try:
+            conn.start()
+            #used to hold open server conn, and for the current height
+            conn.get_current_height()
+        except ElectrumConnectionError:
+            conn.close()
+            raise
+        self.electrum_conn = conn
+
+    def get_electrum_conn(self):
+        """The connection for blocking calls, replaced once closed
+        (raising ElectrumConnectionError if that fails).
+        """
+        if self.electrum_conn is None or self.electrum_conn.closed:
+            self.connect_electrum_conn()
+        return self.electrum_conn
 
     def sync_wallet(self, wallet, fast=False, restart_cb=False):
         """This triggers the start of syncing, wiping temporary state
@@ -238,10 +481,118 @@ class ElectrumInterface(BlockchainInterface):
     def get_from_electrum(self, method, params=[], blocking=False):
         params = [params] if type(params) is not list else params
         if blocking:
-            return self.electrum_conn.call_server_method(method, params)
+            return self.get_electrum_conn().call_server_method(method, params)
         else:
             return self.factory.client.call_server_method(method, params)
 
+    def get_batch_from_electrum(self, method, paramslist):
+        """Blocking calls of method for each of paramslist, made
+        as one batch; returns the results, in order.
+        """
+        return [r.get('result') for r in
+                self.get_electrum_conn().call_server_methods(
+                    [(method, [p] if type(p) is not list else p)
+                     for p in paramslist])]
+
+    def on_notification(self, method, params):
+        """Called with the notifications (of subscriptions) from the
+        server, on the asynchronous connection.
+        """
+        if method == 'blockchain.headers.subscribe' and params:
+            self.current_height = get_header_height(params[0])
+            #transactions seen, waiting for confirmation
+            for key, wl in self.tx_watcher_loops.items():
+                if wl[1] and not wl[2]:
+                    self.run_watcher(key)
+        elif method == 'blockchain.scripthash.subscribe' and params:
+            self.on_scripthash_changed(params[0])
+
+    def subscribe_scripthash(self, scripthash):
+        client = getattr(self.factory, 'client', None)
+        if client and client.connected:
+            self.get_from_electrum('blockchain.scripthash.subscribe',
+                                   scripthash)
+
+    def subscribe_all(self):
+        """(Re)subscribes to the scripthashes watched and those of the
+        wallet.
+        """
+        for scripthash in set(self.scripthash_watchers) | set(
+                self.wallet_scripts):
+            self.subscribe_scripthash(scripthash)
+
+    def on_scripthash_changed(self, scripthash):
+        for key in list(self.scripthash_watchers.get(scripthash, [])):
+            self.run_watcher(key)
+        if scripthash in self.wallet_scripts and self.wallet_synced:
+            wallet, script = self.wallet_scripts[scripthash]
+            d = self.get_from_electrum('blockchain.scripthash.listunspent',
+                                       scripthash)
+            d.addCallback(self.update_script_utxos, wallet, script)
+
+    def run_watcher(self, key):
+        """Runs the check of watcher loop key now, rather than when it
+        is next polled; forgets it if it has ended.
+        """
+        wl = self.tx_watcher_loops.get(key)
+        if not wl or not wl[0].running:
+            for keys in self.scripthash_watchers.values():
+                keys.discard(key)
+            return
+        loop = wl[0]
+        loop.f(*loop.a, **loop.kw)
+
+    def update_script_utxos(self, unspent_info, wallet, script):
+        """Brings the wallet's utxos of script into line with the
+        server's listunspent response unspent_info.
+        """
+        res = unspent_info.get('result')
+        if res is None:
+            return
+        unspent = dict(((binascii.unhexlify(u['tx_hash']), int(u['tx_pos'])),
+                        int(u['value'])) for u in res)
+        spent = [utxo for utxos in wallet.get_utxos_by_mixdepth_().values()
+                 for utxo, data in utxos.items()
+                 if data['script'] == script and utxo not in unspent]
+        if spent:
+            wallet.remove_old_utxos_({'ins': [
+                {'outpoint': {'hash': txid, 'index': index}}
+                for txid, index in spent]})
+        for (txid, index), value in unspent.items():
+            wallet.add_utxo(txid, index, script, value)
+
+    def add_tx_notify(self, txd, unconfirmfun, confirmfun, notifyaddr,
+                      wallet_name=None, timeoutfun=None, spentfun=None,
+                      txid_flag=True, n=0, c=1, vb=None):
+        """As for the other interfaces, but the watcher loop is also
+        run whenever the server notifies a change to the history of the
+        script it queries.
+        """
+        super(ElectrumInterface, self).add_tx_notify(
+            txd, unconfirmfun, confirmfun, notifyaddr, wallet_name=wallet_name,
+            timeoutfun=timeoutfun, spentfun=spentfun, txid_flag=txid_flag,
+            n=n, c=c, vb=vb)
+        scripthashes = []
+        if txid_flag:
+            key = btc.txhash(btc.serialize(txd))
+            addr = self.get_watched_address(txd)
+            if addr:
+                scripthashes.append(address_to_scripthash(addr))
+            if spentfun:
+                scripthashes.append(script_to_scripthash(
+                    binascii.unhexlify(txd['outs'][n]['script'])))
+        else:
+            key = notifyaddr
+            scripthashes.append(address_to_scripthash(notifyaddr))
+        for scripthash in scripthashes:
+            if scripthash not in self.scripthash_watchers:
+                self.scripthash_watchers[scripthash] = set()
+                self.subscribe_scripthash(scripthash)
+            self.scripthash_watchers[scripthash].add(key)
+
+    def get_batch_size(self, wallet):
+        return max(self.BATCH_SIZE, wallet.gap_limit)
+
     def sync_addresses(self, wallet, restart_cb=None):
         if not self.electrum_conn:
             #wait until we have some connection up before starting
@@ -262,10 +613,14 @@ class ElectrumInterface(BlockchainInterface):
             self.temp_addr_history[mixdepth] = {}
         if forchange not in self.temp_addr_history[mixdepth]:
             self.temp_addr_history[mixdepth][forchange] = {"finished": False}
-        for i in range(start_index, start_index + self.BATCH_SIZE):
+        #the requests of a batch go to the server together (see
+        #TxElectrumClientProtocol)
+        for i in range(start_index, start_index + self.get_batch_size(wallet)):
             #get_new_addr is OK here, as guaranteed to be sequential *on this branch*
             a = wallet.get_new_addr(mixdepth, forchange)
-            d = self.get_from_electrum('blockchain.address.get_history', a)
+            d = self.get_from_electrum(
+                'blockchain.scripthash.get_history',
+                script_to_scripthash(wallet.addr_to_script(a)))
             #makes sure entries in temporary address history are ready
             #to be accessed.
             if i not in self.temp_addr_history[mixdepth][forchange]:
@@ -279,28 +634,29 @@ class ElectrumInterface(BlockchainInterface):
                                 addr, start_index):
         """Given the history data for an address from Electrum, update the current view
         of the wallet's usage at mixdepth mixdepth and account forchange, address addr at
-        index i. Once all addresses from index start_index to start_index + self.BATCH_SIZE
-        have been thus updated, trigger either continuation to the next batch, or, if
+        index i. Once all addresses from index start_index to start_index plus the batch
+        size have been thus updated, trigger either continuation to the next batch, or, if
         conditions are fulfilled, end syncing for this (mixdepth, forchange) branch, and
         if all such branches are finished, proceed to the sync_unspent step.
         """
         tah = self.temp_addr_history[mixdepth][forchange]
-        if len(history['result']) > 0:
+        batch_size = self.get_batch_size(wallet)
+        if history.get('result'):
             tah[i]['used'] = True
         tah[i]['synced'] = True
         #Having updated this specific record, check if the entire batch from start_index
         #has been synchronized
-        if all([tah[i]['synced'] for i in range(start_index, start_index + self.BATCH_SIZE)]):
+        if all([tah[i]['synced'] for i in range(start_index, start_index + batch_size)]):
             #check if unused goes back as much as gaplimit *and* we are ahead of any
             #existing index_cache from the wallet file; if both true, end, else, continue
             #to next batch
             if all([tah[i]['used'] is False for i in range(
-                start_index + self.BATCH_SIZE - wallet.gap_limit,
-                start_index + self.BATCH_SIZE)]):
+                start_index + batch_size - wallet.gap_limit,
+                start_index + batch_size)]):
                 last_used_addr = None
                 #to find last used, note that it may be in the *previous* batch;
                 #may as well just search from the start, since it takes no time.
-                for i in range(start_index + self.BATCH_SIZE):
+                for i in range(start_index + batch_size):
                     if tah[i]['used']:
                         last_used_addr = tah[i]['addr']
                 if last_used_addr:
@@ -320,10 +676,12 @@ class ElectrumInterface(BlockchainInterface):
                     self.sync_unspent(wallet)
             else:
                 #continue search forwards on this branch
-                self.synchronize_batch(wallet, mixdepth, forchange, start_index + self.BATCH_SIZE)
+                self.synchronize_batch(wallet, mixdepth, forchange, start_index + batch_size)
 
     def sync_unspent(self, wallet):
-        # finds utxos in the wallet
+        """Finds the utxos in the wallet; returns a Deferred firing once
+        they are all found.
+        """
         wallet.reset_utxos()
         #Prepare list of all used addresses
         addrs = set()
@@ -341,7 +699,7 @@ class ElectrumInterface(BlockchainInterface):
             self.wallet_synced = True
             if self.synctype == 'sync-only':
                 reactor.stop()
-            return
+            return defer.succeed(None)
         #make sure to add any addresses during the run (a subset of those
         #added to the address cache)
         for md in range(wallet.max_mixdepth):
@@ -351,15 +709,37 @@ class ElectrumInterface(BlockchainInterface):
             for path in wallet.yield_imported_paths(md):
                 addrs.add(wallet.get_addr_path(path))
 
+        self.subscribe_wallet(wallet, addrs)
         self.listunspent_calls = len(addrs)
+        self.unspent_synced = defer.Deferred()
         for a in addrs:
-            # FIXME: update to protocol version 1.1 and use scripthash instead
             script = wallet.addr_to_script(a)
-            d = self.get_from_electrum('blockchain.address.listunspent', a)
+            d = self.get_from_electrum('blockchain.scripthash.listunspent',
+                                       script_to_scripthash(script))
             d.addCallback(self.process_listunspent_data, wallet, script)
+        return self.unspent_synced
+
+    def subscribe_wallet(self, wallet, addrs):
+        """Subscribes to the scripts of the addresses addrs, and the
+        next gap_limit on each branch, so that the wallet's utxos are
+        updated as they change (see on_scripthash_changed).
+        """
+        addrs = set(addrs)
+        for md in range(wallet.max_mixdepth + 1):
+            for internal in (True, False):
+                start = wallet.get_next_unused_index(md, internal)
+                for index in range(start, start + wallet.gap_limit):
+                    addrs.add(wallet.get_addr(md, internal, index))
+        for a in addrs:
+            script = wallet.addr_to_script(a)
+            scripthash = script_to_scripthash(script)
+            is_new = scripthash not in self.wallet_scripts
+            self.wallet_scripts[scripthash] = (wallet, script)
+            if is_new:
+                self.subscribe_scripthash(scripthash)
 
     def process_listunspent_data(self, unspent_info, wallet, script):
-        res = unspent_info['result']
+        res = unspent_info.get('result') or []
         for u in res:
             txid = binascii.unhexlify(u['tx_hash'])
             wallet.add_utxo(txid, int(u['tx_pos']), script, int(u['value']))
@@ -369,49 +749,66 @@ class ElectrumInterface(BlockchainInterface):
             self.wallet_synced = True
             if self.synctype == "sync-only":
                 reactor.stop()
+            self.unspent_synced.callback(None)
 
     def pushtx(self, txhex):
         brcst_res = self.get_from_electrum('blockchain.transaction.broadcast',
                                            txhex, blocking=True)
-        brcst_status = brcst_res['result']
-        if isinstance(brcst_status, str) and len(brcst_status) == 64:
+        brcst_status = brcst_res.get('result')
+        if isinstance(brcst_status, basestring) and len(brcst_status) == 64:
             return (True, brcst_status)
-        log.debug(brcst_status)
+        log.debug(brcst_status or brcst_res.get('error'))
         return (False, None)
 
     def query_utxo_set(self, txout, includeconf=False):
-        self.current_height = self.get_from_electrum(
-            "blockchain.numblocks.subscribe", blocking=True)['result']
+        """The transactions of the outpoints are fetched, each once, in
+        one batch, and then the unspent outputs of their scripts in
+        another; the height is that last notified.
+        """
         if not isinstance(txout, list):
             txout = [txout]
-        utxos = [[t[:64],int(t[65:])] for t in txout]
+        utxos = [(t[:64], int(t[65:])) for t in txout]
+        txids = list(set(u[0] for u in utxos))
+        txhexes = dict(zip(txids, self.get_batch_from_electrum(
+            'blockchain.transaction.get', txids)))
+        outs = {}
+        for txid, index in utxos:
+            if not txhexes[txid]:
+                continue
+            tx_outs = btc.deserialize(str(txhexes[txid]))['outs']
+            if index < len(tx_outs):
+                outs[(txid, index)] = tx_outs[index]
+        scripts = list(set(o['script'] for o in outs.values()))
+        #heights of the unspent outputs
+        unspent = {}
+        for res in self.get_batch_from_electrum(
+                'blockchain.scripthash.listunspent',
+                [script_to_scripthash(binascii.unhexlify(s))
+                 for s in scripts]):
+            for u in res or []:
+                unspent[(str(u['tx_hash']), u['tx_pos'])] = u['height']
+        if includeconf:
+            self.current_height = self.get_electrum_conn().get_current_height()
         result = []
         for ut in utxos:
-            address = self.get_from_electrum("blockchain.utxo.get_address",
-                                             ut, blocking=True)['result']
-            utxo_info = self.get_from_electrum("blockchain.address.listunspent",
-                                               address, blocking=True)['result']
-            utxo = None
-            for u in utxo_info:
-                if u['tx_hash'] == ut[0] and u['tx_pos'] == ut[1]:
-                    utxo = u
-            if utxo is None:
+            if ut not in outs or ut not in unspent:
                 result.append(None)
-            else:
-                r = {
-                    'value': utxo['value'],
-                    'address': address,
-                    'script': btc.address_to_script(address)
-                }
-                if includeconf:
-                    if int(utxo['height']) in [0, -1]:
-                        #-1 means unconfirmed inputs
-                        r['confirms'] = 0
-                    else:
-                        #+1 because if current height = tx height, that's 1 conf
-                        r['confirms'] = int(self.current_height) - int(
-                            utxo['height']) + 1
-                result.append(r)
+                continue
+            script = outs[ut]['script']
+            r = {
+                'value': outs[ut]['value'],
+                'address': script_to_address(script),
+                'script': script
+            }
+            if includeconf:
+                if int(unspent[ut]) in [0, -1]:
+                    #-1 means unconfirmed inputs
+                    r['confirms'] = 0
+                else:
+                    #+1 because if current height = tx height, that's 1 conf
+                    r['confirms'] = int(self.current_height) - int(
+                        unspent[ut]) + 1
+            result.append(r)
         return result
 
     def estimate_fee_per_kb(self, N):
@@ -433,16 +830,14 @@ class ElectrumInterface(BlockchainInterface):
         """
         wl = self.tx_watcher_loops[notifyaddr]
         print('txoutset=' + pprint.pformat(tx_output_set))
-        unconftx = self.get_from_electrum('blockchain.address.get_mempool',
-                                          notifyaddr, blocking=True).get('result')
-        unconftxs = set([str(t['tx_hash']) for t in unconftx])
+        scripthash = address_to_scripthash(notifyaddr)
+        unconftx = self.get_from_electrum('blockchain.scripthash.get_mempool',
+                                          scripthash, blocking=True).get('result')
+        unconftxs = list(set([str(t['tx_hash']) for t in unconftx or []]))
         if len(unconftxs):
-            txdatas = []
-            for txid in unconftxs:
-                txdatas.append({'id': txid,
-                                'hex':str(self.get_from_electrum(
-                                    'blockchain.transaction.get',txid,
-                                    blocking=True).get('result'))})
+            txdatas = [{'id': txid, 'hex': str(txhex)} for txid, txhex in zip(
+                unconftxs, self.get_batch_from_electrum(
+                    'blockchain.transaction.get', unconftxs))]
             unconfirmed_txid = None
             for txdata in txdatas:
                 txhex = txdata['hex']
@@ -460,15 +855,15 @@ class ElectrumInterface(BlockchainInterface):
                 wl[1] = True
                 return
 
-        conftx = self.get_from_electrum('blockchain.address.listunspent',
-                                        notifyaddr, blocking=True).get('result')
-        conftxs = set([str(t['tx_hash']) for t in conftx])
+        conftx = self.get_from_electrum('blockchain.scripthash.listunspent',
+                                        scripthash, blocking=True).get('result')
+        #(unspent outputs include those in the mempool, at height 0)
+        conftxs = list(set([str(t['tx_hash']) for t in conftx or []
+                            if t['height'] > 0]))
         if len(conftxs):
-            txdatas = []
-            for txid in conftxs:
-                txdata = str(self.get_from_electrum('blockchain.transaction.get',
-                                                    txid, blocking=True).get('result'))
-                txdatas.append({'hex':txdata,'id':txid})
+            txdatas = [{'id': txid, 'hex': str(txhex)} for txid, txhex in zip(
+                conftxs, self.get_batch_from_electrum(
+                    'blockchain.transaction.get', conftxs))]
             confirmed_txid = None
             for txdata in txdatas:
                 txhex = txdata['hex']
@@ -485,41 +880,47 @@ class ElectrumInterface(BlockchainInterface):
                 wl[0].stop()
                 return
 
+    @staticmethod
+    def get_watched_address(txd):
+        """The address queried for the transaction txd: choose an output
+        address for the query. Filter out p2pkh addresses, assume p2sh
+        (thus would fail to find tx on some nonstandard script type).
+        """
+        for out in txd['outs']:
+            if not btc.is_p2pkh_script(out['script']):
+                return btc.script_to_address(out['script'], get_p2sh_vbyte())
+        return None
+
     def tx_watcher(self, txd, unconfirmfun, confirmfun, spentfun, c, n):
         """Called at a polling interval, checks if the given deserialized
         transaction (which must be fully signed) is (a) broadcast, (b) confirmed
-        and (c) spent from. (c, n ignored in electrum version, just supports
-        registering first confirmation).
+        and (c) spent from at index n. (c ignored in electrum version, just
+        supports registering first confirmation).
         TODO: There is no handling of conflicts here.
         """
         txid = btc.txhash(btc.serialize(txd))
         wl = self.tx_watcher_loops[txid]
         #first check if in mempool (unconfirmed)
-        #choose an output address for the query. Filter out
-        #p2pkh addresses, assume p2sh (thus would fail to find tx on
-        #some nonstandard script type)
-        addr = None
-        for i in range(len(txd['outs'])):
-            if not btc.is_p2pkh_script(txd['outs'][i]['script']):
-                addr = btc.script_to_address(txd['outs'][i]['script'], get_p2sh_vbyte())
-                break
+        addr = self.get_watched_address(txd)
         if not addr:
             log.error("Failed to find any p2sh output, cannot be a standard "
                       "joinmarket transaction, fatal error!")
             reactor.stop()
             return
-        unconftxs_res = self.get_from_electrum('blockchain.address.get_mempool',
-                                              addr, blocking=True).get('result')
-        unconftxs = [str(t['tx_hash']) for t in unconftxs_res]
+        scripthash = address_to_scripthash(addr)
+        unconftxs_res = self.get_from_electrum('blockchain.scripthash.get_mempool',
+                                              scripthash, blocking=True).get('result')
+        unconftxs = [str(t['tx_hash']) for t in unconftxs_res or []]
 
         if not wl[1] and txid in unconftxs:
             print("Tx: " + str(txid) + " seen on network.")
             unconfirmfun(txd, txid)
             wl[1] = True
             return
-        conftx = self.get_from_electrum('blockchain.address.listunspent',
-                                        addr, blocking=True).get('result')
-        conftxs = [str(t['tx_hash']) for t in conftx]
+        conftx = self.get_from_electrum('blockchain.scripthash.listunspent',
+                                        scripthash, blocking=True).get('result')
+        #(unspent outputs include those in the mempool, at height 0)
+        conftxs = [str(t['tx_hash']) for t in conftx or [] if t['height'] > 0]
         if not wl[2] and len(conftxs) and txid in conftxs:
             print("Tx: " + str(txid) + " is confirmed.")
             confirmfun(txd, txid, 1)
@@ -527,6 +928,33 @@ class ElectrumInterface(BlockchainInterface):
             #Note we do not stop the monitoring loop when
             #confirmations occur, since we are also monitoring for spending.
             return
-        if not spentfun or wl[3]:
+        if not spentfun or wl[3] or not (wl[1] or wl[2]):
             return
-
+        #The output is spent once no longer unspent; the spending
+        #transaction is then in the history of its script.
+        spent_scripthash = script_to_scripthash(
+            binascii.unhexlify(txd['outs'][n]['script']))
+        unspent = self.get_from_electrum('blockchain.scripthash.listunspent',
+                                         spent_scripthash,
+                                         blocking=True).get('result')
+        if unspent is None or any(str(u['tx_hash']) == txid and
+                                  u['tx_pos'] == n for u in unspent):
+            return
+        history = self.get_from_electrum('blockchain.scripthash.get_history',
+                                         spent_scripthash,
+                                         blocking=True).get('result')
+        others = [str(h['tx_hash']) for h in history or []
+                  if str(h['tx_hash']) != txid]
+        for txhex in self.get_batch_from_electrum('blockchain.transaction.get',
+                                                  others):
+            if not txhex:
+                continue
+            deser = btc.deserialize(str(txhex))
+            for vin in deser['ins']:
+                if vin['outpoint']['hash'] == txid and \
+                        vin['outpoint']['index'] == n:
+                    log.info("We found a spending transaction: " +
+                             btc.txhash(str(txhex)))
+                    spentfun(deser, txid)
+                    wl[3] = True
+                    return
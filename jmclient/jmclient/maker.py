@@ -4,17 +4,25 @@ from __future__ import print_function
 import base64
 import pprint
 import sys
+import time
 from binascii import unhexlify
 
 import btc
 from jmclient.configure import jm_single
 from jmbase.support import get_log
+from jmbase.metrics import get_metrics
 from jmclient.support import (calc_cj_fee)
 from jmclient.podle import verify_podle, PoDLE
 from twisted.internet import task
 jlog = get_log()
 
 class Maker(object):
+    """Serves any number of takers at once: the utxos offered to
+    each (by oid_to_order) are reserved in the wallet for that
+    taker's nick, and so not offered to others, until the
+    transaction is seen on the network or the reservation expires
+    (see reserve_utxos).
+    """
     def __init__(self, wallet):
         self.active_orders = {}
         self.wallet = wallet
@@ -50,9 +58,11 @@ class Maker(object):
         def reject(msg):
             jlog.info("Counterparty commitment not accepted, reason: " + msg)
             return (False,)
-        if not verify_podle(str(cr_dict['P']), str(cr_dict['P2']), str(cr_dict['sig']),
-                                str(cr_dict['e']), str(commitment),
-                                index_range=range(tries)):
+        with get_metrics().timer("maker verify_podle", nick):
+            podle_ok = verify_podle(str(cr_dict['P']), str(cr_dict['P2']),
+                                    str(cr_dict['sig']), str(cr_dict['e']),
+                                    str(commitment), index_range=range(tries))
+        if not podle_ok:
             reason = "verify_podle failed"
             return reject(reason)
         #finally, check that the proffered utxo is real, old enough, large enough,
@@ -80,11 +90,14 @@ class Maker(object):
             return reject(reason)
 
         # authorisation of taker passed
-        #Find utxos for the transaction now:
+        #Find utxos for the transaction now (those reserved for an
+        #earlier !fill from this nick may be chosen again):
+        self.wallet.release_utxos(nick)
         utxos, cj_addr, change_addr = self.oid_to_order(offer, amount)
         if not utxos:
             #could not find funds
             return (False,)
+        self.reserve_utxos(nick, utxos)
         self.wallet.update_cache_index()
         # Construct data for auth request back to taker.
         # Need to choose an input utxo pubkey to sign with
@@ -107,11 +120,21 @@ class Maker(object):
         except IndexError as e:
             return (False, 'malformed txhex. ' + repr(e))
         jlog.info('obtained tx\n' + pprint.pformat(tx))
-        goodtx, errmsg = self.verify_unsigned_tx(tx, offerinfo)
+        with get_metrics().timer("maker verify_tx", nick):
+            goodtx, errmsg = self.verify_unsigned_tx(tx, offerinfo)
         if not goodtx:
             jlog.info('not a good tx, reason=' + errmsg)
+            self.wallet.release_utxos(nick)
             return (False, errmsg)
+        #if our reservation expired, the utxos may since have been
+        #offered to another taker
+        reserved = self.wallet.get_reserved_utxos()
+        if any(reserved.get(u, nick) != nick for u in offerinfo["utxos"]):
+            jlog.info('utxos now reserved for another taker')
+            return (False, 'utxos no longer available')
         jlog.info('goodtx')
+        #the taker may broadcast any time now; keep the utxos until then
+        self.reserve_utxos(nick, offerinfo["utxos"])
         sigs = []
         utxos = offerinfo["utxos"]
 
@@ -124,7 +147,9 @@ class Maker(object):
             amount = utxos[utxo]['value']
             our_inputs[index] = (script, amount)
 
-        txs = self.wallet.sign_tx(btc.deserialize(unhexlify(txhex)), our_inputs)
+        with get_metrics().timer("maker sign_tx", nick):
+            txs = self.wallet.sign_tx(btc.deserialize(unhexlify(txhex)),
+                                      our_inputs)
 
         for index in our_inputs:
             sigmsg = txs['ins'][index]['script']
@@ -136,6 +161,15 @@ class Maker(object):
             sigs.append(base64.b64encode(sigmsg))
         return (True, sigs)
 
+    def reserve_utxos(self, nick, utxos):
+        """Reserves utxos (as returned by oid_to_order) for nick,
+        releasing any reserved for it before (as for an earlier
+        !fill), for utxo_reservation_sec from now.
+        """
+        expiry = time.time() + jm_single().config.getint(
+            "POLICY", "utxo_reservation_sec")
+        self.wallet.reserve_utxos(list(utxos), nick, expiry)
+
     def verify_unsigned_tx(self, txd, offerinfo):
         """This code is security-critical.
         Before signing the transaction the Maker must ensure
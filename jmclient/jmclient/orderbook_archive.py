@@ -0,0 +1,328 @@
+from __future__ import print_function
+"""
+An archive of the orderbook over time, as seen by an OrderbookWatch
+(such as ob-watcher's), for the analysis of liquidity and fees.
+
+The archive is a directory of segment files, one per (UTC) day, each
+a sequence of records: a snapshot of the whole orderbook, then the
+changes to it (offers added or replaced, and offers cancelled, by
+counterparty and oid), with a new snapshot every so often. Records are
+a header (kind, timestamp, payload length) and a zlib compressed JSON
+payload, offers being lists of the values of OFFER_FIELDS.
+
+The index file lists the snapshots, as lines 'timestamp segment offset';
+so the orderbook at any time is found by reading forward from the last
+snapshot before it, and queries of a period read only the segments of
+that period.
+"""
+import bisect
+import json
+import math
+import os
+import struct
+import time
+import zlib
+
+from twisted.internet import reactor, task
+
+from jmbase.support import get_log
+from .support import calc_cj_fee
+
+log = get_log()
+
+OFFER_FIELDS = ['counterparty', 'oid', 'ordertype', 'minsize', 'maxsize',
+                'txfee', 'cjfee']
+
+RECORD_SNAPSHOT = 0
+RECORD_DELTA = 1
+
+_record_header = struct.Struct(">BdI")
+INDEX_NAME = "index"
+SEGMENT_FORMAT = "orderbook-%Y%m%d.dat"
+
+
+class OrderbookArchiveError(Exception):
+    pass
+
+
+def get_segment_name(timestamp):
+    return time.strftime(SEGMENT_FORMAT, time.gmtime(timestamp))
+
+
+class OrderbookArchive(object):
+    """The archive in directory (created if need be). Written by
+    add_snapshot and add_delta, in time order; read by iter_records,
+    iter_books and the queries get_depth and get_fee_percentiles.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segment = None
+        self.file = None
+        self.last_time = None
+        self.index = []
+        self.index_size = 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get_index(self):
+        """Returns [(timestamp, segment, offset)] for the snapshots, in
+        time order, picking up any added since (by another process).
+        """
+        path = self._path(INDEX_NAME)
+        if not os.path.isfile(path) or \
+                os.path.getsize(path) == self.index_size:
+            return self.index
+        index = []
+        with open(path, "rb") as f:
+            data = f.read()
+        for line in data.split("\n"):
+            try:
+                timestamp, segment, offset = line.split(" ")
+                index.append((float(timestamp), segment, int(offset)))
+            except ValueError:
+                #(including a partly written last line)
+                continue
+        self.index = index
+        self.index_size = len(data)
+        return index
+
+    def _open_segment(self, name):
+        """Opens segment name for appending, dropping any partly
+        written record at its end.
+        """
+        self.close()
+        path = self._path(name)
+        if os.path.isfile(path):
+            size = os.path.getsize(path)
+            end = 0
+            with open(path, "rb") as f:
+                for offset, (_, _, length) in self._iter_headers(f):
+                    if offset + _record_header.size + length > size:
+                        break
+                    end = offset + _record_header.size + length
+                    f.seek(end)
+            if end < size:
+                with open(path, "r+b") as f:
+                    f.truncate(end)
+        self.file = open(path, "ab")
+        self.segment = name
+
+    @staticmethod
+    def _iter_headers(f):
+        """Yields (offset, (kind, timestamp, length)) for the records of
+        segment file f, which the caller must move past the payload.
+        """
+        while True:
+            offset = f.tell()
+            data = f.read(_record_header.size)
+            if len(data) != _record_header.size:
+                return
+            yield offset, _record_header.unpack(data)
+
+    def _write(self, kind, timestamp, data):
+        #times must not go backwards, for the index
+        if self.last_time is not None and timestamp < self.last_time:
+            timestamp = self.last_time
+        name = get_segment_name(timestamp)
+        if name != self.segment:
+            if kind != RECORD_SNAPSHOT:
+                raise OrderbookArchiveError(
+                    "A segment must start with a snapshot")
+            self._open_segment(name)
+        payload = zlib.compress(json.dumps(data, separators=(',', ':')))
+        offset = self.file.tell()
+        self.file.write(_record_header.pack(kind, timestamp, len(payload)) +
+                        payload)
+        self.file.flush()
+        self.last_time = timestamp
+        return timestamp, offset
+
+    def needs_snapshot(self, timestamp):
+        """Whether the next record, at timestamp, must be a snapshot
+        (as it starts a segment).
+        """
+        return get_segment_name(timestamp) != self.segment
+
+    def add_snapshot(self, timestamp, offers):
+        """Records the whole orderbook at timestamp, offers being dicts
+        with keys OFFER_FIELDS.
+        """
+        timestamp, offset = self._write(
+            RECORD_SNAPSHOT, timestamp,
+            [[o[k] for k in OFFER_FIELDS] for o in offers])
+        with open(self._path(INDEX_NAME), "ab") as f:
+            f.write("{:.3f} {} {}\n".format(timestamp, self.segment, offset))
+
+    def add_delta(self, timestamp, add, cancel):
+        """Records the changes to the orderbook since the last record:
+        add, offers (dicts as for add_snapshot) added or replacing those
+        with the same counterparty and oid, and cancel, the
+        [counterparty, oid] of offers removed.
+        """
+        self._write(RECORD_DELTA, timestamp,
+                    [[[o[k] for k in OFFER_FIELDS] for o in add],
+                     [list(c) for c in cancel]])
+
+    def iter_records(self, start=None, end=None):
+        """Yields (timestamp, kind, data) for the records from the last
+        snapshot at or before start (or the first) to the last record
+        at or before end; data is a list of offers (as lists) for a
+        snapshot, [offers, cancels] for a delta.
+        """
+        index = self.get_index()
+        if not index:
+            return
+        i = 0
+        if start is not None:
+            i = max(bisect.bisect_right([s[0] for s in index], start) - 1, 0)
+        last_segment = get_segment_name(end) if end is not None else None
+        segments = []
+        for _, segment, _ in index[i:]:
+            if last_segment is not None and segment > last_segment:
+                break
+            if segment not in segments:
+                segments.append(segment)
+        offset = index[i][2]
+        for segment in segments:
+            with open(self._path(segment), "rb") as f:
+                f.seek(offset)
+                for _, (kind, timestamp, length) in self._iter_headers(f):
+                    if end is not None and timestamp > end:
+                        return
+                    payload = f.read(length)
+                    if len(payload) != length:
+                        break
+                    try:
+                        data = json.loads(zlib.decompress(payload))
+                    except (zlib.error, ValueError) as e:
+                        raise OrderbookArchiveError("Bad record in {}: {}"
+                                                    .format(segment, e))
+                    yield timestamp, kind, data
+            offset = 0
+
+    def iter_books(self, start, end=None, step=3600):
+        """Yields (timestamp, book) for timestamp from start to end (or
+        now) every step seconds, book being the orderbook as last
+        recorded by then, a dict of offers (dicts with keys OFFER_FIELDS)
+        by (counterparty, oid). Times before the first record are
+        skipped. The same dict is yielded each time, changed in between.
+        """
+        if end is None:
+            end = time.time()
+        book = None
+        t = start
+        for timestamp, kind, data in self.iter_records(start, end):
+            while t < timestamp and t <= end:
+                if book is not None:
+                    yield t, book
+                t += step
+            if kind == RECORD_SNAPSHOT:
+                book = {}
+                add, cancel = data, []
+            else:
+                add, cancel = data
+            for o in add:
+                book[(o[0], o[1])] = dict(zip(OFFER_FIELDS, o))
+            for c in cancel:
+                book.pop(tuple(c), None)
+        while t <= end and book is not None:
+            yield t, book
+            t += step
+
+    @staticmethod
+    def _offers_for(book, amount, ordertypes):
+        return [o for o in book.itervalues()
+                if o['minsize'] <= amount <= o['maxsize'] and
+                (ordertypes is None or o['ordertype'] in ordertypes)]
+
+    def get_depth(self, amount, start, end=None, step=3600,
+                  ordertypes=None):
+        """Returns [(timestamp, offers, counterparties)] for the times
+        of iter_books: the numbers of offers for a coinjoin of amount
+        satoshis (of ordertypes, if given), and of their counterparties.
+        """
+        result = []
+        for t, book in self.iter_books(start, end, step):
+            offers = self._offers_for(book, amount, ordertypes)
+            result.append((t, len(offers),
+                           len(set(o['counterparty'] for o in offers))))
+        return result
+
+    def get_fee_percentiles(self, amount, start, end=None, step=3600,
+                            percentiles=(10, 50, 90), ordertypes=None):
+        """Returns [(timestamp, fees)] for the times of iter_books, fees
+        being the coinjoin fees in satoshis for amount at each of the
+        percentiles (nearest rank) over the offers for it, or None if
+        there are none.
+        """
+        result = []
+        for t, book in self.iter_books(start, end, step):
+            fees = sorted(calc_cj_fee(o['ordertype'], o['cjfee'], amount)
+                          for o in self._offers_for(book, amount,
+                                                    ordertypes))
+            if not fees:
+                result.append((t, None))
+                continue
+            ranks = [min(max(int(math.ceil(p * len(fees) / 100.0)), 1),
+                         len(fees)) for p in percentiles]
+            result.append((t, [fees[r - 1] for r in ranks]))
+        return result
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        self.file = None
+        self.segment = None
+
+
+class OrderbookArchiver(object):
+    """Records the orderbook of watch (an OrderbookWatch) in archive
+    every interval seconds: as the changes since, or as a snapshot on
+    the first time, at the start of each day, and if snapshot_interval
+    seconds have passed since the last, so that reading the orderbook
+    at any time never replays more than that.
+    """
+    interval = 60
+    snapshot_interval = 3600
+    clock = reactor
+
+    def __init__(self, watch, archive, interval=None):
+        self.watch = watch
+        self.archive = archive
+        if interval is not None:
+            self.interval = interval
+        self.version = None
+        self.last_snapshot = None
+        self.loop = None
+
+    def start(self):
+        self.loop = task.LoopingCall(self.record)
+        self.loop.clock = self.clock
+        self.loop.start(self.interval)
+
+    def stop(self):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+        self.archive.close()
+
+    def record(self):
+        now = self.clock.seconds()
+        since = self.version
+        if self.last_snapshot is None or self.archive.needs_snapshot(now) \
+                or now - self.last_snapshot >= self.snapshot_interval:
+            since = None
+        try:
+            version, full, data = self.watch.get_orderbook_update(since)
+            if full:
+                self.archive.add_snapshot(now, data)
+                self.last_snapshot = now
+            elif version != self.version:
+                self.archive.add_delta(now, data['add'], data['cancel'])
+            self.version = version
+        except (IOError, OSError) as e:
+            #a snapshot is taken next time
+            log.error("Failed to archive the orderbook: " + repr(e))
+            self.last_snapshot = None
@@ -3,13 +3,17 @@ from __future__ import print_function
 #Proof Of Discrete Logarithm Equivalence
 #For algorithm steps, see https://gist.github.com/AdamISZ/9cbba5e9408d23813ca8
 import os
+import sys
 import hashlib
 import json
 import binascii
+from collections import OrderedDict
 PODLE_COMMIT_FILE = None
+from jmbase.support import get_log
 from btc import (multiply, add_pubkeys, getG, podle_PublicKey, podle_PrivateKey,
-                 encode, decode, N,
+                 podle_multiply, podle_add, encode, decode, N,
                  podle_PublicKey_class, podle_PrivateKey_class)
+log = get_log()
 
 
 def set_commitment_file(file_loc):
@@ -116,9 +120,9 @@ class PoDLE(object):
         #TODO nonce could be rfc6979?
         if not k:
             k = os.urandom(32)
-        J = getNUMS(index)
+        J = get_NUMS_point(index)
         KG = podle_PrivateKey(k).pubkey
-        KJ = multiply(k, J.serialize(), False, return_serialized=False)
+        KJ = podle_multiply(k, J)
         self.P2 = getP2(self.priv, J)
         self.get_commitment()
         self.e = hashlib.sha256(''.join([x.serialize(
@@ -176,19 +180,19 @@ class PoDLE(object):
             raise PoDLEError("Verify called without sufficient data")
         if not self.get_commitment() == commitment:
             return False
-        for J in [getNUMS(i) for i in index_range]:
-            sig_priv = podle_PrivateKey(self.s)
-            sG = sig_priv.pubkey
-            sJ = multiply(self.s, J.serialize(), False)
-            e_int = decode(self.e, 256)
-            minus_e = encode(-e_int % N, 256, minlen=32)
-            minus_e_P = multiply(minus_e, self.P.serialize(), False)
-            minus_e_P2 = multiply(minus_e, self.P2.serialize(), False)
-            KGser = add_pubkeys([sG.serialize(), minus_e_P], False)
-            KJser = add_pubkeys([sJ, minus_e_P2], False)
+        #Only K_J depends on the NUMS point; K_G = sG - eP, the -eP2 term
+        #of K_J = sJ - eP2 and the serializations of P, P2 are computed once.
+        e_int = decode(self.e, 256)
+        minus_e = encode(-e_int % N, 256, minlen=32)
+        sG = podle_PrivateKey(self.s).pubkey
+        KGser = podle_add(sG, podle_multiply(minus_e, self.P)).serialize()
+        minus_e_P2 = podle_multiply(minus_e, self.P2)
+        PP2ser = self.P.serialize() + self.P2.serialize()
+        for i in index_range:
+            sJ = podle_multiply(self.s, get_NUMS_point(i))
+            KJser = podle_add(sJ, minus_e_P2).serialize()
             #check 2: e =?= H(K_G || K_J || P || P2)
-            e_check = hashlib.sha256(KGser + KJser + self.P.serialize() +
-                                     self.P2.serialize()).digest()
+            e_check = hashlib.sha256(KGser + KJser + PP2ser).digest()
             if e_check == self.e:
                 return True
         #commitment fails for any NUMS in the provided range
@@ -231,6 +235,26 @@ def getNUMS(index=0):
     assert False, "It seems inconceivable, doesn't it?"  # pragma: no cover
 
 
+#Parsed NUMS points from precomp_NUMS, keyed by index; filled on
+#first use by get_NUMS_point.
+_NUMS_points = {}
+
+
+def get_NUMS_point(index=0):
+    """Returns the NUMS point for this index as a public key object,
+    as for getNUMS() but taken from the precomputed table, parsed
+    once and cached, rather than searched for on each call.
+    """
+    try:
+        return _NUMS_points[index]
+    except KeyError:
+        if index not in precomp_NUMS:
+            raise PoDLEError("NUMS index out of range: " + repr(index))
+        pt = podle_PublicKey(binascii.unhexlify(precomp_NUMS[index]))
+        _NUMS_points[index] = pt
+        return pt
+
+
 def verify_all_NUMS(write=False):
     """Check that the algorithm produces the expected NUMS
     values; more a sanity check than anything since if the file
@@ -256,11 +280,268 @@ def getP2(priv, nums_pt):
     just the most easy way to manipulate it in the
     library), calculate priv*nums_pt
     """
-    priv_raw = priv.private_key
-    return multiply(priv_raw,
-                    nums_pt.serialize(),
-                    False,
-                    return_serialized=False)
+    return podle_multiply(priv.private_key, nums_pt)
+
+
+class PoDLECommitmentStore(object):
+    """Persistent store of used and external PoDLE commitments.
+
+    All data is kept in memory (the used commitments in a set, so that
+    membership checks are O(1)), and persisted as two files:
+
+    * a snapshot at the commitment file location, in the legacy
+      commitments.json format {'used': [..], 'external': {..}}.
+    * an append-only log next to it (same name + '.log'); each
+      update appends a single json line instead of rewriting the
+      snapshot. The first line of the log records the sha256 of the
+      snapshot it extends, so a log left over from a different (or
+      hand-edited) snapshot is discarded rather than replayed.
+
+    Once the log holds more than compact_threshold records, it is
+    folded into a fresh snapshot (see compact()).
+    Changes made to either file by another process are picked up on the
+    next access by comparing file stats, so e.g. add-utxo.py can run
+    alongside a tumbler as before.
+    """
+    compact_threshold = 1000
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.log_filename = filename + ".log"
+        self._reset()
+        self.load()
+
+    def _reset(self):
+        self.used = set()
+        self.used_order = []
+        self.external = {}
+        self._snapshot_sig = None
+        self._snapshot_hash = None
+        self._log_offset = 0
+        self._log_records = 0
+
+    @staticmethod
+    def _file_sig(fname):
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime)
+
+    def load(self):
+        """Read the snapshot and replay any valid log on top of it.
+        Raises PoDLEError if the snapshot is not correctly formatted.
+        """
+        self._reset()
+        if os.path.isfile(self.filename):
+            with open(self.filename, "rb") as f:
+                raw = f.read()
+            try:
+                c = json.loads(raw)
+            except ValueError:
+                raise PoDLEError("File is not valid json: " + self.filename)
+            if not isinstance(c, dict) or 'used' not in c.keys() or \
+                    'external' not in c.keys():
+                raise PoDLEError("Incorrectly formatted file: " +
+                                 self.filename)
+            for cmt in c['used']:
+                self._add_used(cmt)
+            self.external = c['external']
+            self._snapshot_hash = hashlib.sha256(raw).hexdigest()
+        self._snapshot_sig = self._file_sig(self.filename)
+        self._replay_log()
+
+    def _replay_log(self):
+        if not self._snapshot_hash or not os.path.isfile(self.log_filename):
+            return
+        with open(self.log_filename, "rb") as f:
+            if self._log_offset == 0:
+                header = f.readline()
+                try:
+                    valid = json.loads(header)['snapshot'] == \
+                        self._snapshot_hash
+                except (ValueError, KeyError, TypeError):
+                    valid = False
+                if not valid:
+                    #stale log from a snapshot which no longer exists;
+                    #it will be replaced on the next write.
+                    return
+                self._log_offset = f.tell()
+            f.seek(self._log_offset)
+            while True:
+                line = f.readline()
+                #a partially written final line (e.g. crash during
+                #append) is not applied, and will be retried next time.
+                if not line.endswith("\n"):
+                    break
+                try:
+                    self._apply(json.loads(line))
+                except ValueError:
+                    log.warn("Ignoring invalid commitment log entry in " +
+                             self.log_filename)
+                self._log_offset = f.tell()
+                self._log_records += 1
+
+    def refresh(self):
+        """Pick up any changes made on disk by another process
+        (or by hand); cheap if nothing has changed.
+        """
+        if self._file_sig(self.filename) != self._snapshot_sig:
+            self.load()
+            return
+        if self._snapshot_hash:
+            log_sig = self._file_sig(self.log_filename)
+            if log_sig is None:
+                if self._log_offset > 0:
+                    self.load()
+            elif log_sig[0] < self._log_offset:
+                self.load()
+            elif log_sig[0] > self._log_offset:
+                self._replay_log()
+
+    def _add_used(self, commitment):
+        if commitment not in self.used:
+            self.used.add(commitment)
+            self.used_order.append(commitment)
+
+    def _apply(self, record):
+        if 'used' in record:
+            #a single commitment, or a list of them (see import_json)
+            used = record['used']
+            for cmt in (used if isinstance(used, list) else [used]):
+                self._add_used(cmt)
+        if 'remove' in record:
+            for u in record['remove']:
+                self.external.pop(u, None)
+        if 'add' in record:
+            self.external.update(record['add'])
+
+    def _append(self, record):
+        """Apply the record in memory and append it to the log,
+        starting a new log (against a new snapshot if need be) if the
+        current one is not valid.
+        """
+        self.refresh()
+        if not self._snapshot_hash or self._log_offset == 0:
+            self.compact()
+        #normalize types (e.g. integer 'reveal' keys) to what a reload
+        #from disk would give
+        line = json.dumps(record)
+        self._apply(json.loads(line))
+        with open(self.log_filename, "ab") as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+            self._log_offset = f.tell()
+        self._log_records += 1
+        if self._log_records >= self.compact_threshold:
+            self.compact()
+
+    def compact(self):
+        """Write the full current state as a new snapshot (atomically,
+        via a temporary file) and start a new, empty log against it.
+        """
+        raw = self.to_json()
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, "wb") as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.name == 'nt' and os.path.exists(self.filename): #pragma: no cover
+            os.remove(self.filename)
+        os.rename(tmpname, self.filename)
+        self._snapshot_hash = hashlib.sha256(raw).hexdigest()
+        self._snapshot_sig = self._file_sig(self.filename)
+        with open(self.log_filename, "wb") as f:
+            f.write(json.dumps({'snapshot': self._snapshot_hash}) + "\n")
+            f.flush()
+            self._log_offset = f.tell()
+        self._log_records = 0
+
+    def to_json(self):
+        """Serialization in the legacy commitments.json format.
+        """
+        return json.dumps({'used': self.used_order,
+                           'external': self.external}, indent=4)
+
+    def is_used(self, commitment):
+        self.refresh()
+        return commitment in self.used
+
+    def get_external(self, utxo=None):
+        """Returns the external commitment entry for utxo (or None),
+        or the full dict of external commitments if utxo is None.
+        """
+        self.refresh()
+        if utxo is None:
+            return self.external
+        return self.external.get(utxo)
+
+    def add_used(self, commitment):
+        self.refresh()
+        if commitment in self.used:
+            return
+        self._append({'used': commitment})
+
+    def remove_external(self, utxos):
+        if isinstance(utxos, basestring):
+            utxos = [utxos]
+        self.refresh()
+        to_remove = [u for u in utxos if u in self.external]
+        if to_remove:
+            self._append({'remove': to_remove})
+
+    def add_external(self, ecs):
+        if ecs:
+            self._append({'add': ecs})
+
+    def import_json(self, filename):
+        """Merge the contents of a legacy format commitments file
+        into this store.
+        """
+        with open(filename, "rb") as f:
+            try:
+                c = json.loads(f.read())
+            except ValueError:
+                raise PoDLEError("File is not valid json: " + filename)
+        if not isinstance(c, dict) or 'used' not in c.keys() or \
+                'external' not in c.keys():
+            raise PoDLEError("Incorrectly formatted file: " + filename)
+        #merged in one log record, so in one append (and fsync)
+        self.refresh()
+        record = {}
+        used = [cmt for cmt in OrderedDict.fromkeys(c['used'])
+                if cmt not in self.used]
+        if used:
+            record['used'] = used
+        if c['external']:
+            record['add'] = c['external']
+        if record:
+            self._append(record)
+
+    def export_json(self, filename):
+        """Write the current contents of the store to filename
+        in the legacy commitments.json format.
+        """
+        self.refresh()
+        with open(filename, "wb") as f:
+            f.write(self.to_json())
+
+
+_commitment_store = None
+
+def get_commitment_store():
+    """Returns the PoDLECommitmentStore for the current
+    commitment file location (see set_commitment_file).
+    """
+    global _commitment_store
+    if _commitment_store is None or \
+            _commitment_store.filename != PODLE_COMMIT_FILE:
+        _commitment_store = PoDLECommitmentStore(PODLE_COMMIT_FILE)
+    return _commitment_store
 
 
 def get_podle_commitments():
@@ -273,14 +554,12 @@ def get_podle_commitments():
     Since takers request transactions serially there should be no
     locking requirement here. Multiple simultaneous taker bots
     would require extra attention.
+    Note that this returns copies; for membership checks, use
+    get_commitment_store() directly.
     """
-    if not os.path.isfile(PODLE_COMMIT_FILE):
-        return ([], {})
-    with open(PODLE_COMMIT_FILE, "rb") as f:
-        c = json.loads(f.read())
-    if 'used' not in c.keys() or 'external' not in c.keys():
-        raise PoDLEError("Incorrectly formatted file: " + PODLE_COMMIT_FILE)
-    return (c['used'], c['external'])
+    store = get_commitment_store()
+    store.refresh()
+    return (list(store.used_order), dict(store.external))
 
 
 def add_external_commitments(ecs):
@@ -298,62 +577,58 @@ def update_commitments(commitment=None,
     """Optionally add the commitment commitment to the list of 'used',
     and optionally remove the available external commitment
     whose key value is the utxo in external_to_remove,
-    persist updated entries to disk.
+    persist updated entries to disk (appended to the commitments log,
+    see PoDLECommitmentStore).
     """
-    c = {}
-    if os.path.isfile(PODLE_COMMIT_FILE):
-        with open(PODLE_COMMIT_FILE, "rb") as f:
-            try:
-                c = json.loads(f.read())
-            except ValueError: #pragma: no cover
-                #Exit conditions cannot be included in tests.
-                print("the file: " + PODLE_COMMIT_FILE + " is not valid json.")
-                sys.exit(0)
-
-    if 'used' in c:
-        commitments = c['used']
-    else:
-        commitments = []
-    if 'external' in c:
-        external = c['external']
-    else:
-        external = {}
+    try:
+        store = get_commitment_store()
+    except PoDLEError as e: #pragma: no cover
+        #Exit conditions cannot be included in tests.
+        print(repr(e))
+        sys.exit(0)
     if commitment:
-        commitments.append(commitment)
-        #remove repeats
-        commitments = list(set(commitments))
+        store.add_used(commitment)
     if external_to_remove:
-        external = {
-            k: v
-            for k, v in external.items() if k not in external_to_remove
-        }
+        store.remove_external(external_to_remove)
     if external_to_add:
-        external.update(external_to_add)
-    to_write = {}
-    to_write['used'] = commitments
-    to_write['external'] = external
-    with open(PODLE_COMMIT_FILE, "wb") as f:
-        f.write(json.dumps(to_write, indent=4))
+        store.add_external(external_to_add)
+    if not os.path.isfile(PODLE_COMMIT_FILE):
+        #as before, ensure the file exists after any update
+        store.compact()
+
+
+def import_commitments(filename):
+    """Merge a legacy format commitments.json file into the
+    current commitments store.
+    """
+    get_commitment_store().import_json(filename)
+
+
+def export_commitments(filename):
+    """Write the current commitments to filename in the
+    legacy commitments.json format.
+    """
+    get_commitment_store().export_json(filename)
 
 def get_podle_tries(utxo, priv=None, max_tries=1, external=False):
-    used_commitments, external_commitments = get_podle_commitments()
+    store = get_commitment_store()
 
     if external:
-        if utxo in external_commitments:
-            ec = external_commitments[utxo]
+        ec = store.get_external(utxo)
+        if ec:
             #use as many as were provided in the file, up to a max of max_tries
             m = min([len(ec['reveal'].keys()), max_tries])
             for i in reversed(range(m)):
                 key = str(i)
                 p = PoDLE(u=utxo,P=ec['P'],P2=ec['reveal'][key]['P2'],
                           s=ec['reveal'][key]['s'], e=ec['reveal'][key]['e'])
-                if p.get_commitment() in used_commitments:
+                if store.is_used(p.get_commitment()):
                     return i+1
     else:
         for i in reversed(range(max_tries)):
             p = PoDLE(u=utxo, priv=priv)
             c = p.generate_podle(i)
-            if c['commit'] in used_commitments:
+            if store.is_used(c['commit']):
                 return i+1
     return 0
 
@@ -373,7 +648,7 @@ def generate_podle(priv_utxo_pairs, max_tries=1, allow_external=None, k=None):
     one there, use it and add it to the list of used commitments.
     If still nothing available, return None.
     """
-    used_commitments, external_commitments = get_podle_commitments()
+    store = get_commitment_store()
     for priv, utxo in priv_utxo_pairs:
         tries = get_podle_tries(utxo, priv, max_tries)
         if tries >= max_tries:
@@ -396,7 +671,7 @@ def generate_podle(priv_utxo_pairs, max_tries=1, allow_external=None, k=None):
                 update_commitments(external_to_remove=u)
                 continue
             index = str(tries)
-            ec = external_commitments[u]
+            ec = store.get_external(u)
             p = PoDLE(u=u,P=ec['P'],P2=ec['reveal'][index]['P2'],
                       s=ec['reveal'][index]['s'], e=ec['reveal'][index]['e'])
             update_commitments(commitment=p.get_commitment())
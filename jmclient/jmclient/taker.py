@@ -9,6 +9,7 @@ from binascii import hexlify, unhexlify
 import btc
 from jmclient.configure import get_p2sh_vbyte, jm_single
 from jmbase.support import get_log
+from jmbase.metrics import get_metrics
 from jmclient.support import (calc_cj_fee, weighted_order_choose, choose_orders,
                               choose_sweep_orders)
 from jmclient.wallet import estimate_tx_fee
@@ -216,7 +217,7 @@ class Taker(object):
         #Initialization has been successful. We must set the nonrespondants
         #now to keep track of what changed when we receive the utxo data
         self.nonrespondants = self.orderbook.keys()
-
+        get_metrics().mark_stage("coinjoin", "fill", first=True)
         return (True, self.cjamount, commitment, revelation, self.orderbook)
 
     def filter_orderbook(self, orderbook, sweep=False):
@@ -331,6 +332,7 @@ class Taker(object):
         """
         if self.aborted:
             return (False, "User aborted")
+        get_metrics().mark_stage("coinjoin", "ioauth")
 
         #Temporary list used to aggregate all ioauth data that must be removed
         rejected_counterparties = []
@@ -484,6 +486,7 @@ class Taker(object):
             # placeholders required
             ins['script'] = 'deadbeef'
         self.taker_info_callback("INFO", "Built tx, sending to counterparties.")
+        get_metrics().mark_stage("coinjoin", "tx")
         return (True, self.maker_utxo_data.keys(), tx)
 
     def auth_counterparty(self, btc_sig, auth_pub, maker_pk):
@@ -592,6 +595,7 @@ class Taker(object):
             return False
         assert not len(self.nonrespondants)
         jlog.info('all makers have sent their signatures')
+        get_metrics().mark_stage("coinjoin", "signed")
         self.taker_info_callback("INFO", "Transaction is valid, signing..")
         jlog.debug("schedule item was: " + str(self.schedule[self.schedule_index]))
         return self.self_sign_and_push()
@@ -769,6 +773,7 @@ class Taker(object):
         if not pushed:
             self.on_finished_callback(False, fromtx=True)
         else:
+            get_metrics().mark_stage("coinjoin", "broadcast")
             if nick_to_use:
                 return (nick_to_use, tx)
         #if push was not successful, return None
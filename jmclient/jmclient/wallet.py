@@ -5,6 +5,7 @@ import warnings
 import functools
 import collections
 import numbers
+import time
 from binascii import hexlify, unhexlify
 from datetime import datetime
 from copy import deepcopy
@@ -101,6 +102,12 @@ class UTXOManager(object):
         self.selector = merge_func
         # {mixdexpth: {(txid, index): (path, value)}}
         self._utxo = None
+        # {(txid, index): (owner, expiry)}; not persisted
+        self._reserved = {}
+        # {mixdepth: total value of its utxos}, kept up to date
+        self._balance = None
+        # called as func(mixdepth, balance) on any change of a balance
+        self._balance_listeners = []
         self._load_storage()
         assert self._utxo is not None
 
@@ -119,6 +126,9 @@ class UTXOManager(object):
                 txid = utxo[:self.TXID_LEN]
                 index = int(utxo[self.TXID_LEN:])
                 md_data[(txid, index)] = value
+        self._balance = collections.defaultdict(int)
+        for md, data in self._utxo.items():
+            self._balance[md] = sum(value for path, value in data.values())
 
     def save(self, write=True):
         new_data = {}
@@ -134,6 +144,21 @@ class UTXOManager(object):
 
     def reset(self):
         self._utxo = collections.defaultdict(dict)
+        emptied = [md for md, value in self._balance.items() if value]
+        self._balance = collections.defaultdict(int)
+        for md in emptied:
+            self._balance_changed(md)
+
+    def add_balance_listener(self, func):
+        """
+        Have func(mixdepth, balance) called whenever the balance of a
+        mixdepth changes (with utxos reserved or not).
+        """
+        self._balance_listeners.append(func)
+
+    def _balance_changed(self, mixdepth):
+        for func in self._balance_listeners:
+            func(mixdepth, self._balance[mixdepth])
 
     def have_utxo(self, txid, index):
         for md in self._utxo:
@@ -147,7 +172,11 @@ class UTXOManager(object):
         assert isinstance(index, numbers.Integral)
         assert isinstance(mixdepth, numbers.Integral)
 
-        return self._utxo[mixdepth].pop((txid, index))
+        self._reserved.pop((txid, index), None)
+        path, value = self._utxo[mixdepth].pop((txid, index))
+        self._balance[mixdepth] -= value
+        self._balance_changed(mixdepth)
+        return path, value
 
     def add_utxo(self, txid, index, path, value, mixdepth):
         assert isinstance(txid, bytes)
@@ -156,23 +185,63 @@ class UTXOManager(object):
         assert isinstance(value, numbers.Integral)
         assert isinstance(mixdepth, numbers.Integral)
 
+        old = self._utxo[mixdepth].get((txid, index))
         self._utxo[mixdepth][(txid, index)] = (path, value)
+        self._balance[mixdepth] += value - (old[1] if old else 0)
+        if not old or old[1] != value:
+            self._balance_changed(mixdepth)
+
+    def reserve_utxos(self, utxos, owner, expiry):
+        """
+        Reserve utxos for owner until the time expiry, in place of any
+        utxos reserved for owner before. Reserved utxos are not
+        selected by select_utxos until released, spent or expired.
+
+        args:
+            utxos: list of (txid, index)
+            owner: any hashable, such as the nick of a counterparty
+            expiry: time.time() after which the reservation lapses
+        """
+        self.release_utxos(owner)
+        for utxo in utxos:
+            self._reserved[utxo] = (owner, expiry)
+
+    def release_utxos(self, owner):
+        for utxo, (o, expiry) in self._reserved.items():
+            if o == owner:
+                del self._reserved[utxo]
+
+    def get_reserved_utxos(self):
+        """
+        returns:
+            {(txid, index): owner} for all unexpired reservations
+        """
+        now = time.time()
+        for utxo, (owner, expiry) in self._reserved.items():
+            if expiry <= now:
+                del self._reserved[utxo]
+        return {utxo: owner for utxo, (owner, expiry)
+                in self._reserved.items()}
 
     def select_utxos(self, mixdepth, amount, utxo_filter=()):
         assert isinstance(mixdepth, numbers.Integral)
         utxos = self._utxo[mixdepth]
+        reserved = self.get_reserved_utxos()
         available = [{'utxo': utxo, 'value': val}
-            for utxo, (addr, val) in utxos.items() if utxo not in utxo_filter]
+            for utxo, (addr, val) in utxos.items()
+            if utxo not in utxo_filter and utxo not in reserved]
         selected = self.selector(available, amount)
         return {s['utxo']: {'path': utxos[s['utxo']][0],
                             'value': utxos[s['utxo']][1]}
                 for s in selected}
 
-    def get_balance_by_mixdepth(self):
-        balance_dict = collections.defaultdict(int)
-        for mixdepth, utxomap in self._utxo.items():
-            value = sum(x[1] for x in utxomap.values())
-            balance_dict[mixdepth] = value
+    def get_balance_by_mixdepth(self, include_reserved=True):
+        balance_dict = self._balance.copy()
+        if not include_reserved:
+            for utxo in self.get_reserved_utxos():
+                md = self.have_utxo(*utxo)
+                if md is not False:
+                    balance_dict[md] -= self._utxo[md][utxo][1]
         return balance_dict
 
     def get_utxos_by_mixdepth(self):
@@ -543,9 +612,58 @@ class BaseWallet(object):
     def reset_utxos(self):
         self._utxos.reset()
 
-    def get_balance_by_mixdepth(self, verbose=True):
+    def reserve_utxos(self, utxos, owner, expiry):
+        """
+        Reserve utxos for owner (e.g. the counterparty of a coinjoin in
+        progress) until the time expiry, replacing any utxos reserved
+        for owner before; they are excluded from selection meanwhile.
+
+        args:
+            utxos: list of 'txid:index' strings
+            owner: any hashable
+            expiry: time.time() after which the reservation lapses
+        """
+        self.reserve_utxos_([(unhexlify(utxo[:64]), int(utxo[65:]))
+                             for utxo in utxos], owner, expiry)
+
+    def reserve_utxos_(self, utxos, owner, expiry):
+        """
+        args:
+            utxos: list of (txid, index)
+            owner: any hashable
+            expiry: time.time() after which the reservation lapses
+        """
+        self._utxos.reserve_utxos(utxos, owner, expiry)
+
+    def release_utxos(self, owner):
+        self._utxos.release_utxos(owner)
+
+    def add_balance_listener(self, func):
+        """
+        Have func(mixdepth, balance) called whenever the balance of a
+        mixdepth changes, as utxos are added or removed.
+        """
+        self._utxos.add_balance_listener(func)
+
+    def get_reserved_utxos(self):
+        """
+        returns:
+            {'txid:index': owner}
+        """
+        return {hexlify(txid) + ':' + str(index): owner
+                for (txid, index), owner in self.get_reserved_utxos_().items()}
+
+    def get_reserved_utxos_(self):
+        """
+        returns:
+            {(txid, index): owner}
+        """
+        return self._utxos.get_reserved_utxos()
+
+    def get_balance_by_mixdepth(self, verbose=True, include_reserved=True):
         # TODO: verbose
-        return self._utxos.get_balance_by_mixdepth()
+        return self._utxos.get_balance_by_mixdepth(
+            include_reserved=include_reserved)
 
     @deprecated
     def get_utxos_by_mixdepth(self, verbose=True):
@@ -1,7 +1,6 @@
 #! /usr/bin/env python
 from __future__ import absolute_import, print_function
 
-import datetime
 import os
 import time
 import abc
@@ -11,36 +10,77 @@ from jmclient import (Maker, jm_single, get_network, load_program_config, get_lo
                       sync_wallet, JMClientProtocolFactory,
                       start_reactor, calc_cj_fee, WalletError)
 from .wallet_utils import open_test_wallet_maybe, get_wallet_path
+from .yieldstats import YieldStats
 
 jlog = get_log()
 
 MAX_MIX_DEPTH = 5
 
+def get_offer_diff(oldoffers, newoffers):
+    """Returns (oids to cancel, offers to announce) to turn the
+    offers oldoffers into newoffers.
+    """
+    new_oids = set(o['oid'] for o in newoffers)
+    to_cancel = [o['oid'] for o in oldoffers if o['oid'] not in new_oids]
+    to_announce = [o for o in newoffers if o not in oldoffers]
+    return to_cancel, to_announce
+
+class OfferManager(object):
+    """Keeps a yield generator's offers in step with its wallet.
+    The wallet tells it of every change of a mixdepth's balance;
+    when asked for updates, it recomputes the offers only if there
+    were changes the yield generator considers relevant (see
+    YieldGenerator.offers_affected), and returns only the offers
+    that differ.
+    """
+    def __init__(self, yg):
+        self.yg = yg
+        self.changed = set()
+        #the balances the current offers were computed from
+        self.balances = None
+        yg.wallet.add_balance_listener(self.on_balance_changed)
+
+    def on_balance_changed(self, mixdepth, balance):
+        self.changed.add(mixdepth)
+
+    def get_offer_updates(self):
+        """Returns (oids to cancel, offers to announce).
+        """
+        changed, self.changed = self.changed, set()
+        balances = self.yg.wallet.get_balance_by_mixdepth(verbose=False)
+        if self.balances is not None and (not changed or
+                not self.yg.offers_affected(self.balances, balances, changed)):
+            return [], []
+        self.balances = balances
+        return get_offer_diff(self.yg.offerlist or [],
+                              self.yg.create_my_orders())
+
 class YieldGenerator(Maker):
     """A maker for the purposes of generating a yield from held
     bitcoins, offering from the maximum mixdepth and trying to offer
     the largest amount within the constraints of mixing depth isolation.
     """
     __metaclass__ = abc.ABCMeta
-    statement_file = os.path.join('logs', 'yigen-statement.csv')
+    #income statement, see YieldStats
+    stats_file = os.path.join('logs', 'yigen-stats.dat')
+    #as written by earlier versions; imported into a new stats_file
+    legacy_statement_file = os.path.join('logs', 'yigen-statement.csv')
 
-    def __init__(self, wallet):
+    def __init__(self, wallet, stats_file=None):
+        if stats_file:
+            self.stats_file = stats_file
         Maker.__init__(self, wallet)
+        self.offer_manager = OfferManager(self)
         self.tx_unconfirm_timestamp = {}
-        if not os.path.isfile(self.statement_file):
-            self.log_statement(
-                ['timestamp', 'cj amount/satoshi', 'my input count',
-                 'my input value/satoshi', 'cjfee/satoshi', 'earned/satoshi',
-                 'confirm time/min', 'notes'])
-
-        timestamp = datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-        self.log_statement([timestamp, '', '', '', '', '', '', 'Connected'])
-
-    def log_statement(self, data):
-        data = [str(d) for d in data]
-        self.income_statement = open(self.statement_file, 'a')
-        self.income_statement.write(','.join(data) + '\n')
-        self.income_statement.close()
+        is_new = not os.path.isfile(self.stats_file)
+        self.stats = YieldStats(self.stats_file)
+        if is_new and not stats_file and \
+                os.path.isfile(self.legacy_statement_file):
+            jlog.info("Importing income statement from " +
+                      self.legacy_statement_file)
+            with open(self.legacy_statement_file, "rb") as f:
+                self.stats.import_csv(f)
+        self.stats.add_connected()
 
     @abc.abstractmethod
     def create_my_orders(self):
@@ -49,6 +89,13 @@ class YieldGenerator(Maker):
         (Note: should be called "create_my_offers")
         """
 
+    def offers_affected(self, old_balances, new_balances, changed):
+        """Returns whether the offers may change, given the balances
+        by mixdepth they were made from, the current ones, and which
+        mixdepths' balances changed in between.
+        """
+        return any(old_balances[m] != new_balances[m] for m in changed)
+
     @abc.abstractmethod
     def oid_to_order(self, cjorder, oid, amount):
         """Must convert an order with an offer/order id
@@ -73,10 +120,10 @@ class YieldGeneratorBasic(YieldGenerator):
     It will often (but not always) reannounce orders after transactions,
     thus is somewhat suboptimal in giving more information to spies.
     """
-    def __init__(self, wallet, offerconfig):
+    def __init__(self, wallet, offerconfig, stats_file=None):
         self.txfee, self.cjfee_a, self.cjfee_r, self.ordertype, self.minsize \
              = offerconfig
-        super(YieldGeneratorBasic,self).__init__(wallet)
+        super(YieldGeneratorBasic,self).__init__(wallet, stats_file)
 
     def create_my_orders(self):
         mix_balance = self.wallet.get_balance_by_mixdepth(verbose=False)
@@ -115,7 +162,9 @@ class YieldGeneratorBasic(YieldGenerator):
 
     def oid_to_order(self, offer, amount):
         total_amount = amount + offer["txfee"]
-        mix_balance = self.wallet.get_balance_by_mixdepth()
+        #not counting utxos reserved for other takers' coinjoins
+        mix_balance = self.wallet.get_balance_by_mixdepth(
+            include_reserved=False)
         max_mix = max(mix_balance, key=mix_balance.get)
 
         filtered_mix_balance = [m
@@ -151,19 +200,14 @@ class YieldGeneratorBasic(YieldGenerator):
 
         return utxos, cj_addr, change_addr
 
+    def offers_affected(self, old_balances, new_balances, changed):
+        # the one offer depends only on the highest mixdepth balance
+        return max(old_balances.values() or [0]) != \
+            max(new_balances.values() or [0])
+
     def on_tx_unconfirmed(self, offer, txid, removed_utxos):
         self.tx_unconfirm_timestamp[offer["cjaddr"]] = int(time.time())
-        # if the balance of the highest-balance mixing depth change then
-        # reannounce it
-        oldoffer = self.offerlist[0] if len(self.offerlist) > 0 else None
-        newoffers = self.create_my_orders()
-        if len(newoffers) == 0:
-            return [0], []  # cancel old order
-        if oldoffer:
-            if oldoffer['maxsize'] == newoffers[0]['maxsize']:
-                return [], []  # change nothing
-        # announce new order, replacing the old order
-        return [], [newoffers[0]]
+        return self.offer_manager.get_offer_updates()
 
     def on_tx_confirmed(self, offer, confirmations, txid):
         if offer["cjaddr"] in self.tx_unconfirm_timestamp:
@@ -171,20 +215,24 @@ class YieldGeneratorBasic(YieldGenerator):
                 offer["cjaddr"]]
         else:
             confirm_time = 0
-        timestamp = datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S")
         real_cjfee = calc_cj_fee(offer["offer"]["ordertype"],
                                  offer["offer"]["cjfee"], offer["amount"])
-        self.log_statement([timestamp, offer["amount"], len(
-            offer["utxos"]), sum([av['value'] for av in offer["utxos"].values(
-            )]), real_cjfee, real_cjfee - offer["offer"]["txfee"], round(
-                confirm_time / 60.0, 2), ''])
+        self.stats.add_fill(offer["amount"], len(offer["utxos"]),
+                            sum([av['value'] for av in offer["utxos"].values()]),
+                            real_cjfee, real_cjfee - offer["offer"]["txfee"],
+                            confirm_time)
         return self.on_tx_unconfirmed(offer, txid, None)
 
 def ygmain(ygclass, txfee=1000, cjfee_a=200, cjfee_r=0.002, ordertype='swreloffer',
            nickserv_password='', minsize=100000, gaplimit=6):
     import sys
 
-    parser = OptionParser(usage='usage: %prog [options] [wallet file]')
+    parser = OptionParser(usage='usage: %prog [options] [wallet file] '
+                          '[more wallet files]',
+                          description='Runs a yield generator for each '
+                          'wallet file given, all in this one process, '
+                          'sharing one daemon and blockchain interface, '
+                          'each with its own nick.')
     parser.add_option('-o', '--ordertype', action='store', type='string',
                       dest='ordertype', default=ordertype,
                       help='type of order; can be either reloffer or absoffer')
@@ -213,7 +261,10 @@ def ygmain(ygclass, txfee=1000, cjfee_a=200, cjfee_r=0.002, ordertype='swreloffe
     if len(args) < 1:
         parser.error('Needs a wallet')
         sys.exit(0)
-    wallet_name = args[0]
+    wallet_names = args
+    if len(set(wallet_names)) != len(wallet_names):
+        parser.error('The same wallet cannot be used by two yield generators')
+        sys.exit(0)
     ordertype = options.ordertype
     txfee = options.txfee
     if ordertype in ('reloffer', 'swreloffer'):
@@ -234,20 +285,33 @@ def ygmain(ygclass, txfee=1000, cjfee_a=200, cjfee_r=0.002, ordertype='swreloffe
 
     load_program_config()
 
-    wallet_path = get_wallet_path(wallet_name, 'wallets')
-    wallet = open_test_wallet_maybe(
-        wallet_path, wallet_name, 4, gap_limit=options.gaplimit)
+    wallets = []
+    for wallet_name in wallet_names:
+        wallet_path = get_wallet_path(wallet_name, 'wallets')
+        wallets.append(open_test_wallet_maybe(
+            wallet_path, wallet_name, 4, gap_limit=options.gaplimit))
 
     if jm_single().config.get("BLOCKCHAIN", "blockchain_source") == "electrum-server":
         jm_single().bc_interface.synctype = "with-script"
 
-    while not jm_single().bc_interface.wallet_synced:
-        sync_wallet(wallet, fast=options.fastsync)
+    for wallet in wallets:
+        jm_single().bc_interface.wallet_synced = False
+        while not jm_single().bc_interface.wallet_synced:
+            sync_wallet(wallet, fast=options.fastsync)
 
-    maker = ygclass(wallet, [options.txfee, cjfee_a, cjfee_r,
-                             options.ordertype, options.minsize])
-    jlog.info('starting yield generator')
-    clientfactory = JMClientProtocolFactory(maker, proto_type="MAKER")
+    clientfactories = []
+    for wallet_name, wallet in zip(wallet_names, wallets):
+        #with several wallets, each has its own income statement
+        stats_file = None
+        if len(wallets) > 1:
+            stats_file = os.path.join('logs', 'yigen-stats-{}.dat'.format(
+                os.path.splitext(os.path.basename(wallet_name))[0]))
+        maker = ygclass(wallet, [options.txfee, cjfee_a, cjfee_r,
+                                 options.ordertype, options.minsize],
+                        stats_file=stats_file)
+        jlog.info('starting yield generator for wallet ' + wallet_name)
+        clientfactories.append(JMClientProtocolFactory(maker,
+                                                       proto_type="MAKER"))
 
     nodaemon = jm_single().config.getint("DAEMON", "no_daemon")
     daemon = True if nodaemon == 1 else False
@@ -255,4 +319,4 @@ def ygmain(ygclass, txfee=1000, cjfee_a=200, cjfee_r=0.002, ordertype='swreloffe
         startLogging(sys.stdout)
     start_reactor(jm_single().config.get("DAEMON", "daemon_host"),
                       jm_single().config.getint("DAEMON", "daemon_port"),
-                      clientfactory, daemon=daemon)
+                      clientfactories, daemon=daemon)
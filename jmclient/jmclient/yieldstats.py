@@ -0,0 +1,347 @@
+from __future__ import print_function
+"""
+The income statement of a yield generator: an append-only log of its
+events (connections, and coinjoins once confirmed), one fixed size
+binary record each, in time order.
+
+Each record also holds the running totals up to and including it, so
+the totals over any period are the difference of two records, found
+by binary search: aggregates never require reading the history, only
+O(log n) records of it. The fixed record size also means any column
+can be read with a strided read (e.g. numpy.fromfile with RECORD_DTYPE).
+
+The log can be exported as, and created from, the CSV statement
+written by earlier versions (yigen-statement.csv).
+
+Several processes (such as yield generators run from the same
+directory) may append to the same statement: each append is made under
+an exclusive lock of the file (where fcntl is available), from the last
+record as then on disk.
+"""
+import csv
+import datetime
+import os
+import struct
+import sys
+import time
+from contextlib import contextmanager
+from optparse import OptionParser
+
+try:
+    import fcntl
+except ImportError: #pragma: no cover
+    #(Windows) appends are then not safe across processes
+    fcntl = None
+
+from jmbase.support import get_log
+
+log = get_log()
+
+HEADER = b"JMYGSTATS1\n"
+
+EVENT_CONNECTED = 0
+EVENT_FILL = 1
+
+#the event, then the running totals
+_record = struct.Struct(">BdqIqqqd" + "qqqqqd")
+RECORD_SIZE = _record.size
+RECORD_FIELDS = ['event', 'timestamp', 'amount', 'inputs', 'input_value',
+                 'cjfee', 'earned', 'confirm_time',
+                 'total_fills', 'total_amount', 'total_inputs',
+                 'total_cjfee', 'total_earned', 'total_confirm_time']
+RECORD_DTYPE = [('event', '>u1'), ('timestamp', '>f8'), ('amount', '>i8'),
+                ('inputs', '>u4'), ('input_value', '>i8'), ('cjfee', '>i8'),
+                ('earned', '>i8'), ('confirm_time', '>f8'),
+                ('total_fills', '>i8'), ('total_amount', '>i8'),
+                ('total_inputs', '>i8'), ('total_cjfee', '>i8'),
+                ('total_earned', '>i8'), ('total_confirm_time', '>f8')]
+
+TOTALS_FIELDS = ['fills', 'amount', 'inputs', 'cjfee', 'earned',
+                 'confirm_time']
+
+LEGACY_CSV_HEADER = ['timestamp', 'cj amount/satoshi', 'my input count',
+                     'my input value/satoshi', 'cjfee/satoshi',
+                     'earned/satoshi', 'confirm time/min', 'notes']
+LEGACY_TIME_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+#periods reported by default, in seconds
+DEFAULT_WINDOWS = [("24h", 24 * 3600), ("7d", 7 * 24 * 3600),
+                   ("30d", 30 * 24 * 3600)]
+
+class YieldStatsError(Exception):
+    pass
+
+
+class YieldStats(object):
+    """The statement in filename, created if it does not exist (unless
+    readonly). Records are appended by add_connected and add_fill, and
+    read back by get_totals, get_rolling_totals and iter_records.
+    """
+    def __init__(self, filename, readonly=False):
+        self.filename = filename
+        self.readonly = readonly
+        self.file = None
+        if not os.path.isfile(filename):
+            if readonly:
+                raise YieldStatsError("No statement file: " + filename)
+            try:
+                fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except OSError:
+                #created by another process in the meantime
+                pass
+            else:
+                os.write(fd, HEADER)
+                os.close(fd)
+        self.reader = open(filename, "rb")
+        if self.reader.read(len(HEADER)) != HEADER:
+            self.reader.close()
+            raise YieldStatsError("Not a statement file: " + filename)
+        self.count = None
+        self.last = None
+        self._update_count()
+        if not readonly:
+            #(O_APPEND) every write goes to the end of the file as it is
+            self.file = open(filename, "ab")
+            with self._locked():
+                pass
+
+    @contextmanager
+    def _locked(self):
+        """Holds the lock of the file, having picked up any records
+        appended by others, and dropped any partly written record (as
+        left by a writer which died).
+        """
+        if fcntl:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            self._update_count()
+            end = self._offset(self.count)
+            if os.path.getsize(self.filename) > end:
+                os.ftruncate(self.file.fileno(), end)
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    def _offset(self, i):
+        return len(HEADER) + i * RECORD_SIZE
+
+    def _update_count(self):
+        """Picks up records appended since (by another process).
+        """
+        size = os.path.getsize(self.filename)
+        count = max(size - len(HEADER), 0) // RECORD_SIZE
+        if count != self.count:
+            self.count = count
+            self.last = self.get_record(count - 1) if count else None
+
+    def __len__(self):
+        self._update_count()
+        return self.count
+
+    def _read(self, i):
+        self.reader.seek(self._offset(i))
+        data = self.reader.read(RECORD_SIZE)
+        if len(data) != RECORD_SIZE:
+            raise IndexError(i)
+        return _record.unpack(data)
+
+    def get_record(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return dict(zip(RECORD_FIELDS, self._read(i)))
+
+    def iter_records(self, start=0):
+        self.reader.seek(self._offset(start))
+        while True:
+            data = self.reader.read(RECORD_SIZE)
+            if len(data) != RECORD_SIZE:
+                return
+            yield dict(zip(RECORD_FIELDS, _record.unpack(data)))
+
+    def _append(self, event, timestamp, amount=0, inputs=0, input_value=0,
+                cjfee=0, earned=0, confirm_time=0.0):
+        if self.readonly:
+            raise YieldStatsError("Statement opened read only")
+        if timestamp is None:
+            timestamp = time.time()
+        with self._locked():
+            #times must not go backwards, for the binary search
+            if self.last and timestamp < self.last['timestamp']:
+                timestamp = self.last['timestamp']
+            totals = self._totals_at(self.count - 1)
+            if event == EVENT_FILL:
+                totals = [totals[0] + 1, totals[1] + amount,
+                          totals[2] + inputs, totals[3] + cjfee,
+                          totals[4] + earned, totals[5] + confirm_time]
+            values = [event, timestamp, amount, inputs, input_value, cjfee,
+                      earned, confirm_time] + totals
+            self.file.write(_record.pack(*values))
+            self.file.flush()
+            self.count += 1
+            self.last = dict(zip(RECORD_FIELDS, values))
+
+    def add_connected(self, timestamp=None):
+        self._append(EVENT_CONNECTED, timestamp)
+
+    def add_fill(self, amount, inputs, input_value, cjfee, earned,
+                 confirm_time, timestamp=None):
+        """Records a confirmed coinjoin: its amount, the number and
+        total value of our inputs, the coinjoin fee, what we earned
+        (the fee less our tx fee contribution), and the seconds from
+        broadcast to confirmation.
+        """
+        self._append(EVENT_FILL, timestamp, amount, inputs, input_value,
+                     cjfee, earned, confirm_time)
+
+    def _totals_at(self, i):
+        """The running totals up to and including record i (as a
+        list, in the order of TOTALS_FIELDS).
+        """
+        if i < 0:
+            return [0, 0, 0, 0, 0, 0.0]
+        if i == self.count - 1 and self.last:
+            record = self.last
+            return [record['total_' + k] for k in TOTALS_FIELDS]
+        return list(self._read(i)[8:])
+
+    def find(self, timestamp):
+        """Returns the index of the first record at or after
+        timestamp (len(self) if there is none).
+        """
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._read(mid)[1] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get_totals(self, since=None, until=None):
+        """Returns the totals (a dict with keys TOTALS_FIELDS) of the
+        coinjoins recorded from time since up to time until (if given),
+        and mean_confirm_time (None without coinjoins).
+        """
+        start = self.find(since) if since is not None else 0
+        end = self.find(until) if until is not None else len(self)
+        before = self._totals_at(start - 1)
+        after = self._totals_at(end - 1)
+        totals = dict((k, a - b) for k, a, b in zip(TOTALS_FIELDS, after,
+                                                     before))
+        totals['mean_confirm_time'] = (totals['confirm_time'] /
+            totals['fills'] if totals['fills'] else None)
+        return totals
+
+    def get_rolling_totals(self, windows=DEFAULT_WINDOWS, now=None):
+        """Returns [(name, totals)] for each (name, seconds) in windows,
+        the totals of the seconds before now, and then ('all', totals)
+        """
+        if now is None:
+            now = time.time()
+        return [(name, self.get_totals(since=now - seconds))
+                for name, seconds in windows] + [('all', self.get_totals())]
+
+    def export_csv(self, f):
+        """Writes the statement in the format of yigen-statement.csv
+        to the file f.
+        """
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(LEGACY_CSV_HEADER)
+        for r in self.iter_records():
+            timestamp = datetime.datetime.fromtimestamp(
+                r['timestamp']).strftime(LEGACY_TIME_FORMAT)
+            if r['event'] == EVENT_CONNECTED:
+                writer.writerow([timestamp, '', '', '', '', '', '',
+                                 'Connected'])
+            else:
+                writer.writerow([timestamp, r['amount'], r['inputs'],
+                                 r['input_value'], r['cjfee'], r['earned'],
+                                 round(r['confirm_time'] / 60.0, 2), ''])
+
+    def import_csv(self, f):
+        """Appends the rows of a yigen-statement.csv file f; returns
+        the number of rows that could not be read.
+        """
+        bad = 0
+        for row in csv.reader(f):
+            if not row or row[0] == LEGACY_CSV_HEADER[0]:
+                continue
+            try:
+                timestamp = time.mktime(datetime.datetime.strptime(
+                    row[0], LEGACY_TIME_FORMAT).timetuple())
+                if row[7:8] == ['Connected']:
+                    self.add_connected(timestamp)
+                else:
+                    self.add_fill(int(row[1]), int(row[2]), int(row[3]),
+                                  int(row[4]), int(row[5]),
+                                  float(row[6]) * 60, timestamp)
+            except (ValueError, IndexError):
+                bad += 1
+        if bad:
+            log.warn("Skipped {} unreadable rows of statement".format(bad))
+        return bad
+
+    def close(self):
+        for f in (self.file, self.reader):
+            if f:
+                f.close()
+        self.file = self.reader = None
+
+
+def format_totals(rolling):
+    """Returns a table of the totals from get_rolling_totals.
+    """
+    lines = ["{:>6} {:>6} {:>16} {:>6} {:>12} {:>12} {:>12}".format(
+        "period", "fills", "amount/satoshi", "inputs", "cjfee/satoshi",
+        "earned/satoshi", "confirm/min")]
+    for name, t in rolling:
+        confirm = t['mean_confirm_time']
+        lines.append("{:>6} {:>6} {:>16} {:>6} {:>12} {:>12} {:>12}".format(
+            name, t['fills'], t['amount'], t['inputs'], t['cjfee'],
+            t['earned'], "" if confirm is None else
+            "{:.2f}".format(confirm / 60.0)))
+    return "\n".join(lines)
+
+def yield_stats_main(default_file=os.path.join('logs', 'yigen-stats.dat')):
+    """Main function of the yield generator statistics script; returned
+    is a string (output or error).
+    """
+    parser = OptionParser(
+        usage='usage: %prog [options] [statement file]',
+        description='Shows the totals of the coinjoins in the income '
+        'statement of a yield generator (default ' + default_file + '), '
+        'over the last day, week and month and in all.')
+    parser.add_option('--csv', action='store', type='string', dest='csv',
+                      default=None,
+                      help='write the statement as CSV (in the format of '
+                      'yigen-statement.csv) to this file, - for stdout')
+    parser.add_option('--import-csv', action='store', type='string',
+                      dest='import_csv', default=None,
+                      help='create the statement file from a '
+                      'yigen-statement.csv file')
+    (options, args) = parser.parse_args()
+    filename = args[0] if args else default_file
+    if options.import_csv:
+        if os.path.exists(filename):
+            return "Statement file already exists: " + filename
+        stats = YieldStats(filename)
+        with open(options.import_csv, "rb") as f:
+            bad = stats.import_csv(f)
+        return "Imported {} records into {}{}".format(
+            len(stats), filename,
+            ", skipped {} unreadable rows".format(bad) if bad else "")
+    try:
+        stats = YieldStats(filename, readonly=True)
+    except YieldStatsError as e:
+        return str(e)
+    if options.csv == '-':
+        stats.export_csv(sys.stdout)
+        return ""
+    if options.csv:
+        with open(options.csv, "wb") as f:
+            stats.export_csv(f)
+        return "Wrote " + options.csv
+    return format_totals(stats.get_rolling_totals())
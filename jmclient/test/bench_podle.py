@@ -0,0 +1,61 @@
+#! /usr/bin/env python
+from __future__ import print_function
+'''Benchmark of maker-side PoDLE verification, i.e. the check
+done in Maker.on_auth_received for every !auth message received.
+Not collected by pytest; run directly:
+
+    python bench_podle.py [number of commitments] [taker_utxo_retries]
+'''
+import os
+import sys
+import time
+import binascii
+from jmclient.podle import PoDLE, verify_podle
+
+
+def make_revelations(n, tries):
+    """Serialized revelations as sent by takers, spread over
+    the allowed NUMS indices.
+    """
+    revs = []
+    for i in range(n):
+        priv = os.urandom(32)
+        p = PoDLE(binascii.hexlify(os.urandom(32)) + ":0",
+                  binascii.hexlify(priv))
+        commitment = p.generate_podle(i % tries)['commit']
+        revs.append((commitment, p.serialize_revelation()))
+    return revs
+
+
+def verify_all(revs, tries, corrupt=False):
+    """Verify as the maker does; if corrupt, every commitment is
+    checked against the wrong opening, so that all of index_range
+    is exhausted (the worst case, e.g. for spam).
+    """
+    ok = 0
+    for i, (commitment, rev) in enumerate(revs):
+        cr = PoDLE.deserialize_revelation(rev)
+        if corrupt:
+            cr['e'] = PoDLE.deserialize_revelation(revs[i - 1][1])['e']
+        if verify_podle(str(cr['P']), str(cr['P2']), str(cr['sig']),
+                        str(cr['e']), str(commitment),
+                        index_range=range(tries)):
+            ok += 1
+    return ok
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    tries = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    revs = make_revelations(n, tries)
+    for label, corrupt in [("valid", False), ("invalid", True)]:
+        st = time.time()
+        ok = verify_all(revs, tries, corrupt)
+        elapsed = time.time() - st
+        assert ok == (0 if corrupt else n)
+        print("{}: {} auth verifications in {:.3f}s, {:.1f}/s".format(
+            label, n, elapsed, n / elapsed))
+
+
+if __name__ == "__main__":
+    main()
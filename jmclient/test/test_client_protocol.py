@@ -13,7 +13,7 @@ from twisted.protocols.amp import UnknownRemoteError
 from twisted.protocols import amp
 from twisted.trial import unittest
 from jmbase.commands import *
-from taker_test_data import t_raw_signed_tx
+from taker_test_data import t_raw_signed_tx, t_orderbook
 import json
 import jmbitcoin as bitcoin
 
@@ -105,7 +105,10 @@ class JMTestServerProtocol(JMBaseProtocol):
 
     @JMInit.responder
     def on_JM_INIT(self, bcsource, network, irc_configs, minmakers,
-                   maker_timeout_sec):
+                   maker_timeout_sec, verify_nick_sigs=None,
+                   hedge_privmsgs=None, maker_timeout_min_sec=None,
+                   accept_commitment_broadcasts=None, max_privmsg_size=None,
+                   max_partial_privmsgs=None, partial_privmsg_timeout=None):
         show_receipt("JMINIT", bcsource, network, irc_configs, minmakers,
                      maker_timeout_sec)
         d = self.callRemote(JMInitProto,
@@ -131,12 +134,12 @@ class JMTestServerProtocol(JMBaseProtocol):
         return {'accepted': True}
 
     @JMRequestOffers.responder
-    def on_JM_REQUEST_OFFERS(self):
+    def on_JM_REQUEST_OFFERS(self, since=None):
         show_receipt("JMREQUESTOFFERS")
-        #build a huge orderbook to test BigString Argument
-        orderbook = ["aaaa" for _ in range(15)]
         d = self.callRemote(JMOffers,
-                        orderbook=json.dumps(orderbook))
+                        orderbook=t_orderbook,
+                        version=1,
+                        full=True)
         self.defaultCallbacks(d)
         return {'accepted': True}
 
@@ -146,7 +149,7 @@ class JMTestServerProtocol(JMBaseProtocol):
         show_receipt("JMFILL", amount, commitment, revelation, filled_offers)
         d = self.callRemote(JMFillResponse,
                                 success=success,
-                                ioauth_data = json.dumps(['dummy', 'list']))
+                                ioauth_data=['dummy', 'list'])
         return {'accepted': True}
 
     @JMMakeTx.responder
@@ -179,6 +182,25 @@ class JMTestServerProtocol(JMBaseProtocol):
                                         max_encoded=5,
                                         hostid="hostid2")
         self.defaultCallbacks(d3)
+        d5 = self.callRemote(JMRequestMsgSigBatch,
+                             requests=[{'nick': "dummynickforsign" + str(i),
+                                        'cmd': "command1",
+                                        'msg': "msgforsign",
+                                        'msg_to_be_signed': "fullmsgforsign",
+                                        'hostid': "hostid1"}
+                                       for i in range(3)])
+        self.defaultCallbacks(d5)
+        d6 = self.callRemote(JMRequestMsgSigVerifyBatch,
+                             requests=[{'msg': "msgforverify",
+                                        'fullmsg': fullmsg,
+                                        'sig': s,
+                                        'pubkey': pub,
+                                        'nick': "dummynickforverify",
+                                        'hashlen': 4,
+                                        'max_encoded': 5,
+                                        'hostid': "hostid2"}
+                                       for s in [sig, "badsig"]])
+        self.defaultCallbacks(d6)
         d4 = self.callRemote(JMSigReceived,
                                 nick="dummynick",
                                 sig="dummysig")
@@ -196,6 +218,19 @@ class JMTestServerProtocol(JMBaseProtocol):
         show_receipt("JMMSGSIGVERIFY", verif_result, nick, fullmsg, hostid)
         return {'accepted': True}
 
+    @JMMsgSignatureBatch.responder
+    def on_JM_MSGSIGNATURE_BATCH(self, signatures):
+        show_receipt("JMMSGSIGNATUREBATCH", signatures)
+        assert [s['nick'] for s in signatures] == [
+            "dummynickforsign" + str(i) for i in range(3)]
+        return {'accepted': True}
+
+    @JMMsgSignatureVerifyBatch.responder
+    def on_JM_MSGSIGNATURE_VERIFY_BATCH(self, results):
+        show_receipt("JMMSGSIGVERIFYBATCH", results)
+        assert len(results) == 2
+        return {'accepted': True}
+
 class JMTestServerProtocolFactory(protocol.ServerFactory):
     protocol = JMTestServerProtocol
 
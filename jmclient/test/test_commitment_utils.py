@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 from __future__ import print_function
 from commontest import DummyBlockchainInterface
+import binascii
 import pytest
+import jmbitcoin as bitcoin
 
-from jmclient import (load_program_config, jm_single)
-from jmclient.commitment_utils import get_utxo_info, validate_utxo_data
+from jmclient import (load_program_config, jm_single, set_commitment_file,
+                      get_commitment_file, get_podle_commitments)
+from jmclient.commitment_utils import (get_utxo_info, validate_utxo_data,
+                                       read_utxo_file,
+                                       generate_external_commitments,
+                                       add_bulk_external_commitments)
+from jmclient.podle import verify_podle
 from taker_test_data import (t_utxos_by_mixdepth, t_selected_utxos, t_orderbook,
                              t_maker_response, t_chosen_orders, t_dummy_ext)
 
@@ -55,4 +62,41 @@ def test_get_utxo_info():
     retval = validate_utxo_data(utxodatas, False)
     assert not retval
     dbci.setQUSFail(False)
-    
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_bulk_external_commitments(tmpdir, processes):
+    load_program_config()
+    jm_single().config.set("BLOCKCHAIN", "network", "mainnet")
+    privkey = "L1RrrnXkcKut5DEMwtDthjwRcTTwED36thyL1DebVrKuwvohjMNi"
+    utxos = ["%064x:%d" % (i, i % 3) for i in range(1, 10)]
+    csvfile = tmpdir.join("utxos.csv")
+    csvfile.write("\n".join(u + ", " + privkey for u in utxos) + "\n\n")
+    assert list(read_utxo_file(str(csvfile))) == [(u, privkey) for u in utxos]
+    reports = []
+    ecs = generate_external_commitments(read_utxo_file(str(csvfile)), tries=2,
+                                        processes=processes, batch_size=4,
+                                        progress=lambda *a: reports.append(a))
+    assert sorted(ecs.keys()) == sorted(utxos)
+    assert [r[:2] for r in reports] == [(4, 8), (8, 16), (9, 18)]
+    for u in utxos:
+        assert sorted(ecs[u]['reveal'].keys()) == [0, 1]
+        for i, r in ecs[u]['reveal'].items():
+            commitment = bitcoin.sha256(binascii.unhexlify(r['P2']))
+            assert verify_podle(str(ecs[u]['P']), str(r['P2']), str(r['s']),
+                                str(r['e']), commitment,
+                                index_range=[i])
+    #a bad line anywhere in the input is raised to the caller
+    csvfile.write("not a utxo\n", mode="a")
+    with pytest.raises(Exception):
+        generate_external_commitments(read_utxo_file(str(csvfile)), tries=2,
+                                      processes=processes)
+    prev = get_commitment_file()
+    set_commitment_file(str(tmpdir.join("commitments.json")))
+    try:
+        assert add_bulk_external_commitments(
+            [(u, privkey) for u in utxos[:3]], tries=1,
+            processes=processes) == 3
+        assert sorted(get_podle_commitments()[1].keys()) == utxos[:3]
+    finally:
+        set_commitment_file(prev)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+from __future__ import print_function
+'''Tests of the Electrum client protocol.'''
+
+import binascii
+import json
+import Queue
+
+import pytest
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+
+from jmclient.electruminterface import (ElectrumConn, ElectrumConnectionError,
+                                        ElectrumInterface,
+                                        TxElectrumClientProtocol,
+                                        script_to_scripthash)
+
+
+class DummyBCI(object):
+    wallet = None
+
+    def __init__(self):
+        self.notifications = []
+        self.subscribed = 0
+
+    def on_notification(self, method, params):
+        self.notifications.append((method, params))
+
+    def subscribe_all(self):
+        self.subscribed += 1
+
+
+class DummyFactory(object):
+    def __init__(self):
+        self.bci = DummyBCI()
+
+
+def get_protocol(max_in_flight, max_batch):
+    clock = task.Clock()
+    proto = TxElectrumClientProtocol(DummyFactory())
+    proto.clock = clock
+    proto.max_in_flight = max_in_flight
+    proto.max_batch = max_batch
+    transport = proto_helpers.StringTransport()
+    proto.makeConnection(transport)
+    return proto, transport, clock
+
+
+def get_sent(transport):
+    lines = transport.value().split("\n")[:-1]
+    transport.clear()
+    return [json.loads(l) for l in lines]
+
+
+def respond(proto, requests, batch=True):
+    responses = [{'id': r['id'], 'result': r['params']} for r in requests]
+    if batch:
+        proto.lineReceived(json.dumps(responses))
+    else:
+        for response in responses:
+            proto.lineReceived(json.dumps(response))
+
+
+def test_scripthash():
+    #the example in the Electrum protocol documentation
+    script = binascii.unhexlify(
+        "76a91462e907b15cbf27d5425399ebf6f0fb50ebb88f1888ac")
+    assert script_to_scripthash(script) == \
+        "8b01df4e368ea28f8dc0423bcf7a4923e3a12d307c875e47a0cfbf90b5c39161"
+
+
+def test_pipelining():
+    proto, transport, clock = get_protocol(max_in_flight=5, max_batch=2)
+    assert proto.factory.bci.subscribed == 1
+    #server.version is sent alone, on connection
+    sent = get_sent(transport)
+    assert len(sent) == 1 and sent[0]['method'] == 'server.version'
+    results = []
+    ds = [proto.call_server_method('blockchain.scripthash.get_history',
+                                   [str(i)]) for i in range(7)]
+    for d in ds:
+        d.addCallback(lambda r: results.append(r['result']))
+    #nothing else is sent until it is answered
+    clock.advance(0)
+    assert transport.value() == ""
+    respond(proto, sent, batch=False)
+    sent = get_sent(transport)
+    #then batches, up to 5 requests in flight
+    assert [len(s) if isinstance(s, list) else 1 for s in sent] == [2, 2, 1]
+    assert sent[0][0]['method'] == 'blockchain.headers.subscribe'
+    assert len(proto.in_flight) == 5 and len(proto.queued) == 3
+    #responses in any order; each sends those queued, up to the limit
+    respond(proto, sent[2:], batch=False)
+    resent = get_sent(transport)
+    assert len(resent) == 1 and not isinstance(resent[0], list)
+    respond(proto, sent[1] + sent[0])
+    resent += get_sent(transport)
+    assert [len(s) if isinstance(s, list) else 1 for s in resent] == [1, 2]
+    assert len(proto.queued) == 0
+    respond(proto, [resent[0]] + resent[1])
+    assert sorted(results) == [[str(i)] for i in range(7)]
+    assert proto.in_flight == {}
+    #notifications, and responses to no request
+    proto.lineReceived(json.dumps({'method': 'blockchain.headers.subscribe',
+                                   'params': [{'height': 5}]}))
+    proto.lineReceived(json.dumps({'id': 1000, 'result': None}))
+    proto.lineReceived("garbage")
+    assert proto.factory.bci.notifications == [
+        ('blockchain.headers.subscribe', [{'height': 5}])]
+    clock.advance(proto.ping_interval)
+    assert get_sent(transport)[0]['method'] == 'server.ping'
+    proto.connectionLost(None)
+    assert not proto.pingloop.running
+
+
+def get_conn(max_batch=100, timeout=60.0):
+    #without connecting to a server; sent requests are recorded
+    conn = ElectrumConn.__new__(ElectrumConn)
+    conn.msg_id = 0
+    conn.RetQueue = Queue.Queue()
+    conn.closed = False
+    conn.max_batch = max_batch
+    conn.timeout = timeout
+    conn.sent = []
+    conn.send_json = conn.sent.append
+    return conn
+
+
+def test_blocking_batches():
+    conn = get_conn(max_batch=2)
+
+    def answer(requests):
+        conn.sent.append(requests)
+        for r in requests if isinstance(requests, list) else [requests]:
+            conn.RetQueue.put({'id': r['id'], 'result': r['params']})
+    conn.send_json = answer
+    calls = [('blockchain.transaction.get', [str(i)]) for i in range(5)]
+    assert [r['result'] for r in conn.call_server_methods(calls)] == \
+        [[str(i)] for i in range(5)]
+    assert [len(s) if isinstance(s, list) else 1 for s in conn.sent] == \
+        [2, 2, 1]
+
+
+def test_blocking_failures():
+    #no response
+    conn = get_conn(timeout=0.01)
+    with pytest.raises(ElectrumConnectionError):
+        conn.call_server_method('server.ping')
+    #an error for the whole batch
+    conn = get_conn()
+    conn.RetQueue.put({'id': None, 'error': {'code': -32700}})
+    with pytest.raises(ElectrumConnectionError):
+        conn.call_server_methods([('server.ping', [])] * 2)
+
+    #the connection closed, with a call waiting or not
+    class ClosedSocket(object):
+        def recv(self, n):
+            return b''
+    conn = get_conn()
+    conn.s = ClosedSocket()
+    conn.run()
+    assert conn.closed
+    with pytest.raises(ElectrumConnectionError):
+        conn.call_batch([('server.ping', [])])
+    conn.closed = False
+    conn.RetQueue.put(None)
+    with pytest.raises(ElectrumConnectionError):
+        conn.call_server_method('server.ping')
+
+
+class DummyWallet(object):
+    def __init__(self, utxos):
+        #{(txid, index): (script, value)}
+        self.utxos = utxos
+
+    def get_utxos_by_mixdepth_(self):
+        return {0: dict((u, {'script': script, 'value': value})
+                        for u, (script, value) in self.utxos.items())}
+
+    def remove_old_utxos_(self, tx):
+        for inp in tx['ins']:
+            self.utxos.pop((inp['outpoint']['hash'], inp['outpoint']['index']))
+
+    def add_utxo(self, txid, index, script, value):
+        self.utxos[(txid, index)] = (script, value)
+
+    #for subscribe_wallet; no addresses beyond those given
+    max_mixdepth = 0
+    gap_limit = 0
+
+    def get_next_unused_index(self, mixdepth, internal):
+        return 0
+
+    def addr_to_script(self, addr):
+        return addr
+
+
+def get_interface():
+    #without connecting to a server
+    bci = ElectrumInterface.__new__(ElectrumInterface)
+    bci.factory = DummyFactory()
+    bci.tx_watcher_loops = {}
+    bci.scripthash_watchers = {}
+    bci.wallet_scripts = {}
+    bci.current_height = None
+    return bci
+
+
+def test_notifications():
+    bci = get_interface()
+    clock = task.Clock()
+    checks = []
+    loop = task.LoopingCall(checks.append, 1)
+    loop.clock = clock
+    loop.start(bci.tx_poll_interval, now=False)
+    bci.tx_watcher_loops["txid"] = [loop, False, False, False]
+    bci.scripthash_watchers["sh"] = set(["txid"])
+    #a change to the script's history runs the watcher
+    bci.on_notification('blockchain.scripthash.subscribe', ["sh", "status"])
+    bci.on_notification('blockchain.scripthash.subscribe', ["other", None])
+    assert len(checks) == 1
+    #new blocks only run watchers of transactions seen, not confirmed
+    bci.on_notification('blockchain.headers.subscribe', [{'height': 100}])
+    assert len(checks) == 1 and bci.current_height == 100
+    bci.tx_watcher_loops["txid"][1] = True
+    bci.on_notification('blockchain.headers.subscribe',
+                        [{'block_height': 101}])
+    assert len(checks) == 2 and bci.current_height == 101
+    #polling remains
+    clock.advance(bci.tx_poll_interval)
+    assert len(checks) == 3
+    #ended watchers are forgotten
+    loop.stop()
+    bci.on_notification('blockchain.scripthash.subscribe', ["sh", "status2"])
+    assert len(checks) == 3 and bci.scripthash_watchers["sh"] == set()
+
+
+def test_update_script_utxos():
+    bci = get_interface()
+    script, other = b"\x00\x14" + b"\x01" * 20, b"\x00\x14" + b"\x02" * 20
+    txids = [binascii.hexlify(chr(i) * 32) for i in range(3)]
+    wallet = DummyWallet({(binascii.unhexlify(txids[0]), 0): (script, 1000),
+                          (binascii.unhexlify(txids[1]), 1): (script, 2000),
+                          (binascii.unhexlify(txids[1]), 0): (other, 3000)})
+    #the first spent, a new one received
+    bci.update_script_utxos({'result': [
+        {'tx_hash': txids[1], 'tx_pos': 1, 'value': 2000, 'height': 10},
+        {'tx_hash': txids[2], 'tx_pos': 0, 'value': 4000, 'height': 0}]},
+                            wallet, script)
+    assert wallet.utxos == {
+        (binascii.unhexlify(txids[1]), 1): (script, 2000),
+        (binascii.unhexlify(txids[1]), 0): (other, 3000),
+        (binascii.unhexlify(txids[2]), 0): (script, 4000)}
+    #errors change nothing
+    bci.update_script_utxos({'error': 'busy'}, wallet, script)
+    assert len(wallet.utxos) == 3
+
+
+def test_several_wallets():
+    bci = get_interface()
+    bci.wallet_synced = True
+    script_a = b"\x00\x14" + b"\x01" * 20
+    script_b = b"\x00\x14" + b"\x02" * 20
+    txid = binascii.hexlify(b"\x03" * 32)
+    wallet_a, wallet_b = DummyWallet({}), DummyWallet({})
+    #(the dummy wallets' addresses are their scripts)
+    bci.subscribe_wallet(wallet_a, [script_a])
+    bci.subscribe_wallet(wallet_b, [script_b])
+    #resyncing a wallet changes nothing
+    bci.subscribe_wallet(wallet_a, [script_a])
+    assert len(bci.wallet_scripts) == 2
+    requests = []
+
+    def get_from_electrum(method, params=[], blocking=False):
+        requests.append((method, params))
+        return defer.succeed({'result': [
+            {'tx_hash': txid, 'tx_pos': 0, 'value': 1000, 'height': 0}]})
+    bci.get_from_electrum = get_from_electrum
+    #a change to a script updates the wallet it belongs to
+    bci.on_notification('blockchain.scripthash.subscribe',
+                        [script_to_scripthash(script_a), "status"])
+    assert requests == [('blockchain.scripthash.listunspent',
+                         script_to_scripthash(script_a))]
+    assert wallet_a.utxos == {(binascii.unhexlify(txid), 0): (script_a, 1000)}
+    assert wallet_b.utxos == {}
+    bci.on_notification('blockchain.scripthash.subscribe',
+                        [script_to_scripthash(script_b), "status"])
+    assert wallet_b.utxos == {(binascii.unhexlify(txid), 0): (script_b, 1000)}
+    assert len(wallet_a.utxos) == 1
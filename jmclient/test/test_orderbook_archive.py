@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+from __future__ import print_function
+'''Tests of the orderbook archive.'''
+
+import os
+
+from twisted.internet import task
+
+from jmclient.orderbook_archive import (OrderbookArchive, OrderbookArchiver,
+                                        RECORD_SNAPSHOT, RECORD_DELTA,
+                                        INDEX_NAME, get_segment_name)
+
+DAY = 24 * 3600
+#midnight (UTC)
+START = 1500000000 - 1500000000 % DAY
+
+
+def offer(counterparty, oid=0, ordertype='swreloffer', minsize=10**5,
+          maxsize=10**8, cjfee='0.0002'):
+    return {'counterparty': counterparty, 'oid': oid, 'ordertype': ordertype,
+            'minsize': minsize, 'maxsize': maxsize, 'txfee': 0,
+            'cjfee': cjfee}
+
+
+class DummyWatch(object):
+    """Keeps the orderbook and change log as OrderbookWatch does.
+    """
+    def __init__(self):
+        self.offers = {}
+        self.changes = []
+        self.version = 0
+
+    def _change(self, key, o):
+        self.version += 1
+        self.changes.append((self.version, key, o))
+
+    def add(self, o):
+        key = (o['counterparty'], o['oid'])
+        self.offers[key] = o
+        self._change(key, o)
+
+    def cancel(self, counterparty, oid=0):
+        del self.offers[(counterparty, oid)]
+        self._change((counterparty, oid), None)
+
+    def get_orderbook_update(self, since=None):
+        if since is None:
+            return self.version, True, self.offers.values()
+        latest = {}
+        for version, key, o in self.changes:
+            if version > since:
+                latest[key] = o
+        return self.version, False, {
+            'add': [o for o in latest.values() if o],
+            'cancel': [list(k) for k, o in latest.items() if o is None]}
+
+
+def test_queries(tmpdir):
+    archive = OrderbookArchive(str(tmpdir))
+    archive.add_snapshot(START + 100, [offer('a'), offer('b', cjfee='0.0004'),
+                                       offer('c', ordertype='swabsoffer',
+                                             cjfee='1000')])
+    archive.add_delta(START + 7200, [offer('d', maxsize=10**6)], [['a', 0]])
+    #the next day
+    archive.add_snapshot(START + DAY + 100, [offer('b', cjfee='0.0004')])
+    archive.add_delta(START + DAY + 3700, [offer('b', 1, cjfee='0.0001')], [])
+    assert sorted(f for f in os.listdir(str(tmpdir))) == [
+        INDEX_NAME, get_segment_name(START), get_segment_name(START + DAY)]
+    assert len(archive.get_index()) == 2
+    assert [r[1] for r in archive.iter_records()] == [
+        RECORD_SNAPSHOT, RECORD_DELTA, RECORD_SNAPSHOT, RECORD_DELTA]
+    #only from the snapshot before start
+    assert [r[0] for r in archive.iter_records(START + DAY + 200)] == [
+        START + DAY + 100, START + DAY + 3700]
+    #nothing before the first record
+    depth = archive.get_depth(10**7, START, START + 3 * 3600)
+    assert depth == [(START + 3600, 3, 3), (START + 7200, 2, 2),
+                     (START + 3 * 3600, 2, 2)]
+    assert archive.get_depth(10**5, START + 3 * 3600, START + 3 * 3600) == [
+        (START + 3 * 3600, 3, 3)]
+    assert archive.get_depth(10**7, START + DAY + 3600, START + DAY + 7200,
+                             ordertypes=['swreloffer']) == [
+        (START + DAY + 3600, 1, 1), (START + DAY + 7200, 2, 1)]
+    fees = archive.get_fee_percentiles(10**7, START + 3600, START + 3600,
+                                       percentiles=(0, 50, 100))
+    assert fees == [(START + 3600, [1000, 2000, 4000])]
+    assert archive.get_fee_percentiles(10**9, START, START + 3600) == [
+        (START + 3600, None)]
+    #a reader sees what is added later
+    reader = OrderbookArchive(str(tmpdir))
+    assert len(reader.get_depth(10**7, START, START + 2 * DAY)) == 48
+    archive.add_snapshot(START + 2 * DAY + 100, [])
+    assert reader.get_depth(10**7, START + 2 * DAY + 3600,
+                            START + 2 * DAY + 3600) == [
+        (START + 2 * DAY + 3600, 0, 0)]
+
+
+def test_archiver(tmpdir):
+    watch = DummyWatch()
+    watch.add(offer('a'))
+    clock = task.Clock()
+    clock.advance(START + 60)
+    archiver = OrderbookArchiver(watch, OrderbookArchive(str(tmpdir)))
+    archiver.clock = clock
+    archiver.start()
+    watch.add(offer('b'))
+    clock.advance(archiver.interval)
+    #unchanged, so nothing recorded
+    clock.advance(archiver.interval)
+    watch.cancel('a')
+    clock.advance(archiver.interval)
+    clock.advance(archiver.snapshot_interval)
+    records = list(archiver.archive.iter_records())
+    assert [r[1] for r in records] == [RECORD_SNAPSHOT, RECORD_DELTA,
+                                       RECORD_DELTA, RECORD_SNAPSHOT]
+    assert records[2][2] == [[], [['a', 0]]]
+    assert len(records[3][2]) == 1
+    #a new segment starts with a snapshot
+    clock.advance(DAY)
+    assert archiver.archive.get_index()[-1][1:] == (
+        get_segment_name(START + DAY), 0)
+    archiver.stop()
+    #a partly written record is dropped on reopening
+    segment = str(tmpdir.join(get_segment_name(START + DAY)))
+    size = os.path.getsize(segment)
+    with open(segment, "ab") as f:
+        f.write("\x01" * 5)
+    archive = OrderbookArchive(str(tmpdir))
+    archive.add_snapshot(START + DAY + 5000, [offer('c')])
+    assert os.path.getsize(segment) > size
+    records = list(archive.iter_records(START + DAY))
+    assert records[-1][2] == [[u'c', 0, u'swreloffer', 10**5, 10**8, 0,
+                               u'0.0002']]
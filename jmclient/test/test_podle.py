@@ -11,7 +11,8 @@ from jmclient import (load_program_config, get_log, jm_single, generate_podle,
                       generate_podle_error_string, set_commitment_file,
                       get_commitment_file, PoDLE, get_podle_commitments,
                       add_external_commitments, update_commitments)
-from jmclient.podle import verify_all_NUMS, verify_podle, PoDLEError
+from jmclient.podle import (verify_all_NUMS, verify_podle, PoDLEError,
+                            PoDLECommitmentStore, getNUMS, get_NUMS_point)
 from commontest import make_wallets
 log = get_log()
 
@@ -78,6 +79,22 @@ def test_nums_verify(setup_podle):
     """
     verify_all_NUMS(True)
 
+def test_nums_table(setup_podle):
+    """The cached NUMS table must agree with the search in getNUMS,
+    and be shared between calls.
+    """
+    for i in [0, 1, 9, 127, 255]:
+        assert get_NUMS_point(i).serialize() == getNUMS(i).serialize()
+        assert get_NUMS_point(i) is get_NUMS_point(i)
+    with pytest.raises(PoDLEError):
+        get_NUMS_point(256)
+    #a commitment at index 8 only verifies if 8 is in the allowed range
+    priv = os.urandom(32)
+    Pser, P2ser, s, e, commitment = generate_single_podle_sig(priv, 8)
+    assert verify_podle(Pser, P2ser, s, e, commitment, index_range=range(9))
+    assert not verify_podle(Pser, P2ser, s, e, commitment,
+                            index_range=range(8))
+
 def test_external_commitments(setup_podle):
     """Add this generated commitment to the external list
     {txid:N:{'P':pubkey, 'reveal':{1:{'P2':P2,'s':s,'e':e}, 2:{..},..}}}
@@ -148,6 +165,68 @@ def test_external_commitments(setup_podle):
 
 
 
+def test_commitment_store(tmpdir):
+    """Check that updates to the store are appended to the log
+    rather than rewriting the snapshot, are visible to a fresh
+    instance, and that compaction/export give the legacy format.
+    """
+    fname = str(tmpdir.join('commitments.json'))
+    store = PoDLECommitmentStore(fname)
+    assert not store.is_used("aa"*32)
+    store.add_used("aa"*32)
+    with open(fname, "rb") as f:
+        snapshot = f.read()
+    store.add_used("bb"*32)
+    store.add_used("aa"*32)
+    store.add_external({"cc"*32 + ":0": {'P': "dd", 'reveal': {
+        0: {'P2': "ee", 's': "ff", 'e': "00"}}}})
+    #the snapshot is untouched; the updates are in the log
+    with open(fname, "rb") as f:
+        assert f.read() == snapshot
+    store2 = PoDLECommitmentStore(fname)
+    assert store2.used_order == ["aa"*32, "bb"*32]
+    assert store2.get_external("cc"*32 + ":0")['reveal']['0']['P2'] == "ee"
+    store2.remove_external("cc"*32 + ":0")
+    #changes from another instance are picked up on access
+    assert store.get_external("cc"*32 + ":0") is None
+    #a stale log is ignored if the snapshot is replaced
+    with open(fname, "wb") as f:
+        f.write(json.dumps({'used': [], 'external': {}}))
+    assert not store.is_used("aa"*32)
+    store.add_used("11"*32)
+    store.compact()
+    with open(fname, "rb") as f:
+        assert json.loads(f.read()) == {'used': ["11"*32], 'external': {}}
+    #round trip via the legacy format
+    legacy = str(tmpdir.join('legacy.json'))
+    store.export_json(legacy)
+    store3 = PoDLECommitmentStore(str(tmpdir.join('other.json')))
+    store3.import_json(legacy)
+    assert store3.is_used("11"*32)
+    #merged in a single log record, which a reload replays
+    with open(legacy, "wb") as f:
+        f.write(json.dumps({'used': ["%064x" % i for i in range(50)],
+                            'external': {}}))
+    records = store3._log_records
+    store3.import_json(legacy)
+    assert store3._log_records == records + 1
+    assert len(PoDLECommitmentStore(store3.filename).used) == 51
+    with open(legacy, "wb") as f:
+        f.write(json.dumps({'used': []}))
+    with pytest.raises(PoDLEError) as e_info:
+        store3.import_json(legacy)
+
+def test_commitment_store_compaction(tmpdir):
+    fname = str(tmpdir.join('commitments.json'))
+    store = PoDLECommitmentStore(fname)
+    store.compact_threshold = 5
+    for i in range(12):
+        store.add_used(bitcoin.sha256(str(i)))
+    assert store._log_records < 5
+    store2 = PoDLECommitmentStore(fname)
+    assert store2.used == store.used
+    assert store2.used_order == store.used_order
+
 def test_podle_constructor(setup_podle):
     """Tests rules about construction of PoDLE object
     are conformed to.
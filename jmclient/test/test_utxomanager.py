@@ -3,6 +3,7 @@ from __future__ import print_function, absolute_import, division, unicode_litera
 from jmclient.wallet import UTXOManager
 from test_storage import MockStorage
 import pytest
+import time
 
 from jmclient import load_program_config
 import jmclient
@@ -86,6 +87,81 @@ def test_utxomanager_select(setup_env_nodeps):
     assert len(um.select_utxos(mixdepth, value)) is 2
 
 
+
+def test_utxomanager_reserve(setup_env_nodeps):
+    storage = MockStorage(None, 'wallet.jmdat', None, create=True)
+    UTXOManager.initialize(storage)
+    um = UTXOManager(storage, select)
+
+    txid = b'\x00' * UTXOManager.TXID_LEN
+    path = (0,)
+    mixdepth = 0
+    value = 500
+    expiry = time.time() + 600
+
+    for index in range(4):
+        um.add_utxo(txid, index, path, value, mixdepth)
+
+    um.reserve_utxos([(txid, 0), (txid, 1)], 'J5taker1', expiry)
+    um.reserve_utxos([(txid, 2)], 'J5taker2', expiry)
+    assert um.get_reserved_utxos() == {(txid, 0): 'J5taker1',
+                                       (txid, 1): 'J5taker1',
+                                       (txid, 2): 'J5taker2'}
+    assert list(um.select_utxos(mixdepth, value)) == [(txid, 3)]
+    assert um.get_balance_by_mixdepth()[mixdepth] == 4 * value
+    assert um.get_balance_by_mixdepth(
+        include_reserved=False)[mixdepth] == value
+
+    # a new reservation replaces the owner's previous one
+    um.reserve_utxos([(txid, 1)], 'J5taker1', expiry)
+    assert len(um.select_utxos(mixdepth, value)) == 2
+
+    # released when spent, by the owner, or on expiry
+    um.remove_utxo(txid, 2, mixdepth)
+    assert um.get_reserved_utxos() == {(txid, 1): 'J5taker1'}
+    um.release_utxos('J5taker1')
+    assert len(um.select_utxos(mixdepth, value)) == 3
+    um.reserve_utxos([(txid, 0)], 'J5taker3', time.time() - 1)
+    assert um.get_reserved_utxos() == {}
+    assert len(um.select_utxos(mixdepth, value)) == 3
+
+    # reservations are not persisted
+    um.reserve_utxos([(txid, 0)], 'J5taker1', expiry)
+    um.save()
+    um = UTXOManager(storage, select)
+    assert um.get_reserved_utxos() == {}
+
+
+
+def test_utxomanager_balance_events(setup_env_nodeps):
+    storage = MockStorage(None, 'wallet.jmdat', None, create=True)
+    UTXOManager.initialize(storage)
+    um = UTXOManager(storage, select)
+    events = []
+    um.add_balance_listener(lambda md, balance: events.append((md, balance)))
+
+    txid = b'\x00' * UTXOManager.TXID_LEN
+    path = (0,)
+
+    um.add_utxo(txid, 0, path, 500, 0)
+    um.add_utxo(txid, 1, path, 300, 2)
+    um.add_utxo(txid, 2, path, 200, 0)
+    # re-adding a known utxo changes nothing
+    um.add_utxo(txid, 2, path, 200, 0)
+    um.remove_utxo(txid, 0, 0)
+    assert events == [(0, 500), (2, 300), (0, 700), (0, 200)]
+    assert um.get_balance_by_mixdepth() == {0: 200, 2: 300}
+
+    um.save()
+    um = UTXOManager(storage, select)
+    assert um.get_balance_by_mixdepth() == {0: 200, 2: 300}
+    del events[:]
+    um.add_balance_listener(lambda md, balance: events.append((md, balance)))
+    um.reset()
+    assert sorted(events) == [(0, 0), (2, 0)]
+    assert um.get_balance_by_mixdepth()[0] == 0
+
+
 @pytest.fixture
 def setup_env_nodeps(monkeypatch):
     monkeypatch.setattr(jmclient.configure, 'get_blockchain_interface_instance',
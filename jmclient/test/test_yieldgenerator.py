@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+from __future__ import print_function
+'''Tests of the updating of a yield generator's offers.'''
+
+import pytest
+from twisted.internet import defer
+
+import jmclient
+from jmclient import YieldGeneratorBasic, load_program_config, jm_single
+from jmclient.wallet import UTXOManager
+from jmclient.yieldgenerator import get_offer_diff
+from jmclient.client_protocol import JMMakerClientProtocol
+from commontest import DummyBlockchainInterface
+from test_storage import MockStorage
+
+
+class DummyWallet(object):
+    def __init__(self):
+        storage = MockStorage(None, 'wallet.jmdat', None, create=True)
+        UTXOManager.initialize(storage)
+        self._utxos = UTXOManager(storage, lambda unspent, value: unspent)
+        self.max_mixdepth = 4
+
+    def add_balance_listener(self, func):
+        self._utxos.add_balance_listener(func)
+
+    def get_balance_by_mixdepth(self, verbose=True, include_reserved=True):
+        return self._utxos.get_balance_by_mixdepth(include_reserved)
+
+    def add(self, index, value, mixdepth):
+        self._utxos.add_utxo(b'\x00' * 32, index, (mixdepth,), value,
+                             mixdepth)
+
+    def remove(self, index, mixdepth):
+        self._utxos.remove_utxo(b'\x00' * 32, index, mixdepth)
+
+
+class OfflineYieldGenerator(YieldGeneratorBasic):
+    def try_to_create_my_orders(self):
+        self.sync_wait_loop.stop()
+        self.offerlist = self.create_my_orders()
+
+
+def test_offer_diff():
+    offers = [{'oid': 0, 'maxsize': 10}, {'oid': 1, 'maxsize': 20}]
+    assert get_offer_diff(offers, offers) == ([], [])
+    assert get_offer_diff(offers, []) == ([0, 1], [])
+    assert get_offer_diff(offers, [{'oid': 1, 'maxsize': 30}]) == (
+        [0], [{'oid': 1, 'maxsize': 30}])
+
+
+def test_offer_updates(setup_env_nodeps, tmpdir, monkeypatch):
+    monkeypatch.setattr(YieldGeneratorBasic, 'stats_file',
+                        str(tmpdir.join('stats.dat')))
+    #the statement of earlier versions is imported
+    legacy = tmpdir.join('statement.csv')
+    legacy.write('2017/07/14 12:00:00,,,,,,,Connected\n')
+    monkeypatch.setattr(YieldGeneratorBasic, 'legacy_statement_file',
+                        str(legacy))
+    wallet = DummyWallet()
+    wallet.add(0, 10**8, 0)
+    wallet.add(1, 5 * 10**7, 1)
+    yg = OfflineYieldGenerator(wallet, [1000, 200, 0.0002, 'swreloffer',
+                                        100000])
+    assert yg.offerlist[0]['maxsize'] == 10**8 - jm_single().DUST_THRESHOLD
+    assert len(yg.stats) == 2
+    calls = []
+    create_my_orders = yg.create_my_orders
+    def counted():
+        calls.append(1)
+        return create_my_orders()
+    yg.create_my_orders = counted
+    mgr = yg.offer_manager
+    #the first update always recomputes
+    assert mgr.get_offer_updates() == ([], [])
+    assert len(calls) == 1
+    #no change of the highest balance: nothing is recomputed
+    assert mgr.get_offer_updates() == ([], [])
+    wallet.remove(1, 1)
+    wallet.add(2, 7 * 10**7, 1)
+    assert mgr.get_offer_updates() == ([], [])
+    assert len(calls) == 1
+    wallet.add(3, 10**7, 0)
+    to_cancel, to_announce = mgr.get_offer_updates()
+    assert len(calls) == 2
+    assert to_cancel == []
+    assert [o['maxsize'] for o in to_announce] == [
+        11 * 10**7 - jm_single().DUST_THRESHOLD]
+    yg.modify_orders(to_cancel, to_announce)
+    #all coins gone: the offer is cancelled
+    for index, mixdepth in [(0, 0), (3, 0), (2, 1)]:
+        wallet.remove(index, mixdepth)
+    assert mgr.get_offer_updates() == ([0], [])
+
+
+class ConfirmRecorder(object):
+    wallet = None
+
+    def __init__(self):
+        self.confirmed = []
+
+    def on_tx_confirmed(self, offerinfo, confirmations, txid):
+        self.confirmed.append(txid)
+        return [], []
+
+
+def test_confirm_after_resync(setup_env_nodeps, monkeypatch):
+    maker = ConfirmRecorder()
+    proto = JMMakerClientProtocol(None, maker)
+    proto.finalized_offers = {"J5taker": {"txd": {"outs": ["out"]}}}
+    #a resync done at once
+    proto.confirm_callback({"outs": ["out"]}, "txid1", 1)
+    assert maker.confirmed == ["txid1"]
+    #the offers are updated only once an asynchronous resync is done
+    synced = defer.Deferred()
+    monkeypatch.setattr(jm_single().bc_interface, 'sync_unspent',
+                        lambda wallet: synced)
+    proto.confirm_callback({"outs": ["out"]}, "txid2", 1)
+    assert maker.confirmed == ["txid1"]
+    synced.callback(None)
+    assert maker.confirmed == ["txid1", "txid2"]
+
+@pytest.fixture
+def setup_env_nodeps(monkeypatch):
+    monkeypatch.setattr(jmclient.configure, 'get_blockchain_interface_instance',
+                        lambda x: DummyBlockchainInterface())
+    load_program_config()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+from __future__ import print_function
+'''Tests of the yield generator income statement.'''
+
+import os
+from StringIO import StringIO
+
+import pytest
+
+from jmclient.yieldstats import (YieldStats, YieldStatsError, HEADER,
+                                 RECORD_SIZE, LEGACY_CSV_HEADER)
+
+DAY = 24 * 3600
+#noon, so that local times in the csv do not cross a day
+START = 1500000000 - 1500000000 % DAY + DAY // 2
+
+
+def make_stats(tmpdir):
+    stats = YieldStats(str(tmpdir.join("stats.dat")))
+    stats.add_connected(START)
+    for day in range(10):
+        #one fill per day, all earning 100 more than the last
+        stats.add_fill(10**7 + day, 2, 2 * 10**7, 1000 + 100 * day,
+                       500 + 100 * day, 600, START + day * DAY + 60)
+    return stats
+
+
+def test_totals(tmpdir):
+    stats = make_stats(tmpdir)
+    assert len(stats) == 11
+    assert os.path.getsize(stats.filename) == len(HEADER) + 11 * RECORD_SIZE
+    t = stats.get_totals()
+    assert (t['fills'], t['inputs'], t['earned']) == (10, 20, 9500)
+    assert t['amount'] == 10 * 10**7 + 45
+    assert t['mean_confirm_time'] == 600
+    #the last three days
+    t = stats.get_totals(since=START + 7 * DAY)
+    assert (t['fills'], t['cjfee']) == (3, 1700 + 1800 + 1900)
+    t = stats.get_totals(since=START + 2 * DAY, until=START + 4 * DAY)
+    assert (t['fills'], t['earned']) == (2, 700 + 800)
+    t = stats.get_totals(since=START + 20 * DAY)
+    assert t['fills'] == 0 and t['mean_confirm_time'] is None
+    rolling = dict(stats.get_rolling_totals(now=START + 10 * DAY))
+    assert [rolling[k]['fills'] for k in ["24h", "7d", "30d", "all"]] == [
+        1, 7, 10, 10]
+    #times never go backwards
+    stats.add_fill(1, 1, 1, 1, 1, 1, START)
+    assert stats.get_record(-1)['timestamp'] == START + 9 * DAY + 60
+    assert stats.get_record(-1)['total_fills'] == 11
+
+
+def test_reopen(tmpdir):
+    stats = make_stats(tmpdir)
+    reader = YieldStats(stats.filename, readonly=True)
+    assert reader.get_totals()['fills'] == 10
+    #appends are seen by readers
+    stats.add_fill(10**8, 1, 10**8, 0, -200, 60, START + 11 * DAY)
+    assert reader.get_totals()['fills'] == 11
+    assert reader.get_totals()['earned'] == 9300
+    with pytest.raises(YieldStatsError):
+        reader.add_connected()
+    stats.close()
+    #a partly written record is dropped
+    with open(stats.filename, "ab") as f:
+        f.write("\x01" * 10)
+    stats = YieldStats(stats.filename)
+    assert len(stats) == 12
+    assert os.path.getsize(stats.filename) == len(HEADER) + 12 * RECORD_SIZE
+    stats.add_connected()
+    assert stats.get_totals()['fills'] == 11
+    with pytest.raises(YieldStatsError):
+        YieldStats(str(tmpdir.join("missing.dat")), readonly=True)
+    tmpdir.join("other.dat").write("timestamp,x\n")
+    with pytest.raises(YieldStatsError):
+        YieldStats(str(tmpdir.join("other.dat")))
+
+
+def test_writers(tmpdir):
+    #as yield generators run from the same directory
+    filename = str(tmpdir.join("stats.dat"))
+    a = YieldStats(filename)
+    b = YieldStats(filename)
+    a.add_fill(100, 1, 100, 10, 5, 60, START)
+    b.add_fill(200, 1, 200, 20, 10, 60, START + 1)
+    a.add_fill(300, 1, 300, 30, 15, 60, START + 2)
+    records = list(YieldStats(filename, readonly=True).iter_records())
+    assert [r['amount'] for r in records] == [100, 200, 300]
+    assert [r['total_amount'] for r in records] == [100, 300, 600]
+    assert a.get_totals()['earned'] == b.get_totals()['earned'] == 30
+    #times never go backwards, across writers either
+    b.add_connected(START)
+    assert b.get_record(-1)['timestamp'] == START + 2
+
+
+def test_csv(tmpdir):
+    stats = make_stats(tmpdir)
+    out = StringIO()
+    stats.export_csv(out)
+    lines = out.getvalue().splitlines()
+    assert lines[0] == ",".join(LEGACY_CSV_HEADER)
+    assert lines[1].endswith(",,,,,,,Connected")
+    assert lines[2].split(",")[1:] == ["10000000", "2", "20000000", "1000",
+                                       "500", "10.0", ""]
+    copy = YieldStats(str(tmpdir.join("copy.dat")))
+    assert copy.import_csv(StringIO(out.getvalue() + "garbage\n")) == 1
+    assert len(copy) == 11
+    assert copy.get_totals() == stats.get_totals()
+    copied = StringIO()
+    copy.export_csv(copied)
+    assert copied.getvalue() == out.getvalue()
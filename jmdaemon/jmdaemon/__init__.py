@@ -8,6 +8,9 @@ from .irc import IRCMessageChannel
 from jmbase.support import get_log
 from .message_channel import MessageChannel, MessageChannelCollection
 from .orderbookwatch import OrderbookWatch
+from .nick_verifier import NickSignatureVerifier, nick_verification_available
+from .commitment_blacklist import (CommitmentBlacklist,
+                                   get_commitment_blacklist)
 from jmbase import commands
 from .daemon_protocol import (JMDaemonServerProtocolFactory, JMDaemonServerProtocol,
                               start_daemon)
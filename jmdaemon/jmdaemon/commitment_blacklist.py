@@ -0,0 +1,181 @@
+#! /usr/bin/env python
+from __future__ import print_function
+"""The maker's record of PoDLE commitments already used, by its own
+coinjoins or as broadcast by other makers, which it will not accept
+again (see check_utxo_blacklist in daemon_protocol).
+Stored as one hex commitment per line, in the file commitmentlist.
+"""
+import os
+
+from twisted.internet import reactor
+
+from jmbase.support import get_log
+
+log = get_log()
+
+
+class CommitmentBlacklist(object):
+    """A set of commitments, loaded from filename once, to which new
+    commitments are appended. Appends are flushed at once, but only
+    fsync'ed sync_delay seconds later, together with any others made
+    in the meantime.
+    Other processes appending to the same file are picked up cheaply,
+    by a check of its size, on each lookup.
+    The file is rewritten (compacted) on loading if it holds many
+    duplicate lines; and, if max_entries is set, whenever it holds
+    twice that many commitments, keeping the most recent max_entries.
+    """
+    sync_delay = 1.0
+    compact_ratio = 2
+    clock = reactor
+
+    def __init__(self, filename, max_entries=None):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.file = None
+        self.sync_call = None
+        self.load()
+
+    def load(self):
+        self.close()
+        self.commitments = set()
+        #only kept in order if it is to be trimmed
+        self.order = [] if self.max_entries else None
+        self.offset = 0
+        self.lines = 0
+        #(older versions wrote no newline after the last line)
+        self._read_new(complete=True)
+        if self.lines > self.compact_ratio * max(len(self.commitments), 1) \
+               or self._over_limit(1):
+            self.compact()
+
+    def _over_limit(self, factor):
+        return self.max_entries and \
+            len(self.commitments) > factor * self.max_entries
+
+    def _read_new(self, complete=False):
+        """Reads the complete lines added to the file since offset,
+        leaving any partly appended last line (by another process) to be
+        read once finished; unless complete, when it is taken as whole.
+        """
+        if not os.path.isfile(self.filename):
+            return
+        with open(self.filename, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        if not complete:
+            data = data[:data.rfind("\n") + 1]
+        self.offset += len(data)
+        for line in data.split("\n"):
+            c = line.strip()
+            if c:
+                self.lines += 1
+                self._add(c)
+
+    def _add(self, commitment):
+        if commitment in self.commitments:
+            return False
+        self.commitments.add(commitment)
+        if self.order is not None:
+            self.order.append(commitment)
+        return True
+
+    def refresh(self):
+        try:
+            size = os.path.getsize(self.filename)
+        except OSError:
+            size = 0
+        if size < self.offset:
+            #rewritten by someone else
+            self.load()
+        elif size > self.offset:
+            self._read_new()
+
+    def __contains__(self, commitment):
+        self.refresh()
+        return commitment in self.commitments
+
+    def __len__(self):
+        return len(self.commitments)
+
+    def add(self, commitment):
+        """Returns False if commitment is already in the blacklist,
+        else adds it (to the file as well) and returns True.
+        """
+        self.refresh()
+        if not self._add(commitment):
+            return False
+        f = self._get_file()
+        f.write(commitment + "\n")
+        f.flush()
+        self.offset = f.tell()
+        self.lines += 1
+        if not self.sync_call:
+            self.sync_call = self.clock.callLater(self.sync_delay, self.sync)
+        if self._over_limit(2):
+            self.compact()
+        return True
+
+    def _get_file(self):
+        if self.file is None:
+            self.file = open(self.filename, "ab")
+            self.file.seek(0, os.SEEK_END)
+            #ending a last line left unterminated by an older version,
+            #not one another process is still appending
+            if 0 < self.file.tell() == self.offset:
+                with open(self.filename, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != "\n":
+                        self.file.write("\n")
+        return self.file
+
+    def sync(self):
+        if self.sync_call and self.sync_call.active():
+            self.sync_call.cancel()
+        self.sync_call = None
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def compact(self):
+        """Rewrites the file with each commitment once (only the most
+        recent max_entries if that is set), atomically, via a
+        temporary file.
+        """
+        self.close()
+        if self.order is not None:
+            self.order = self.order[-self.max_entries:]
+            self.commitments = set(self.order)
+            commitments = self.order
+        else:
+            commitments = self.commitments
+        log.debug("Compacting {} ({} lines, {} commitments)".format(
+            self.filename, self.lines, len(commitments)))
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, "wb") as f:
+            f.write("".join(c + "\n" for c in commitments))
+            f.flush()
+            os.fsync(f.fileno())
+        if os.name == 'nt' and os.path.exists(self.filename): #pragma: no cover
+            os.remove(self.filename)
+        os.rename(tmpname, self.filename)
+        self.offset = os.path.getsize(self.filename)
+        self.lines = len(commitments)
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+
+_blacklists = {}
+
+def get_commitment_blacklist(filename="commitmentlist"):
+    """Returns the CommitmentBlacklist for filename, loading it
+    on first use.
+    """
+    path = os.path.abspath(filename)
+    if path not in _blacklists:
+        _blacklists[path] = CommitmentBlacklist(filename)
+    return _blacklists[path]
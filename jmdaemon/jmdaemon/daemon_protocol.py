@@ -3,15 +3,17 @@ from __future__ import print_function
 
 from .message_channel import MessageChannelCollection
 from .orderbookwatch import OrderbookWatch
+from .nick_verifier import NickSignatureVerifier, nick_verification_available
 from .enc_wrapper import (as_init_encryption, init_keypair, init_pubkey,
                           NaclError)
-from .protocol import (COMMAND_PREFIX, ORDER_KEYS, NICK_HASH_LENGTH,
+from .protocol import (COMMAND_PREFIX, NICK_HASH_LENGTH,
                        NICK_MAX_ENCODED, JM_VERSION, JOINMARKET_NICK_HEADER,
                        COMMITMENT_PREFIXES)
 from .irc import IRCMessageChannel
+from .commitment_blacklist import get_commitment_blacklist
 
 from jmbase.commands import *
-from jmbase import _byteify
+from jmbase import _byteify, get_metrics
 from twisted.protocols import amp
 from twisted.internet import reactor, ssl
 from twisted.internet.protocol import ServerFactory
@@ -21,7 +23,9 @@ from twisted.python import failure, log
 import json
 import threading
 import os
+import random
 import copy
+from collections import OrderedDict, deque
 from functools import wraps
 
 """Joinmarket application protocol control flow.
@@ -66,19 +70,11 @@ def check_utxo_blacklist(commitment, persist=False):
     If flagged, persist the usage of this commitment to the above file.
     """
     #TODO format error checking?
-    fname = "commitmentlist"
-    if os.path.isfile(fname):
-        with open(fname, "rb") as f:
-            blacklisted_commitments = [x.strip() for x in f.readlines()]
-    else:
-        blacklisted_commitments = []
-    if commitment in blacklisted_commitments:
+    blacklist = get_commitment_blacklist()
+    if commitment in blacklist:
         return False
     elif persist:
-        blacklisted_commitments += [commitment]
-        with open(fname, "wb") as f:
-            f.write('\n'.join(blacklisted_commitments))
-            f.flush()
+        blacklist.add(commitment)
     #If the commitment is new and we are *not* persisting, nothing to do
     #(we only add it to the list on sending io_auth, which represents actual
     #usage).
@@ -88,6 +84,28 @@ class JMProtocolError(Exception):
     pass
 
 class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
+    #Nick signing and verification requests to the client are sent in
+    #batches, of those made within this many seconds, or as soon as
+    #there are msgsig_batch_max of them.
+    msgsig_batch_window = 0.02
+    msgsig_batch_max = 200
+    #!orderbook requests received within this many seconds are answered
+    #together; if there are at least orderbook_reannounce_min of them on
+    #a message channel, by one public announcement there, rather than
+    #by a privmsg to each requester.
+    orderbook_response_window = 1.0
+    orderbook_reannounce_min = 3
+    #If the client sets maker_timeout_min_sec, stage 1 ends at the latest
+    #after stage1_timeout_factor times the stage1_timeout_quantile of the
+    #recent times taken by makers to answer !fill with !ioauth, within
+    #maker_timeout_min_sec and maker_timeout_sec; until stage1_min_samples
+    #responses have been seen, after maker_timeout_sec. It ends earlier
+    #if all makers respond.
+    stage1_timeout_quantile = 0.9
+    stage1_timeout_factor = 2.0
+    stage1_min_samples = 10
+    stage1_max_samples = 200
+    clock = reactor
 
     def __init__(self, factory):
         self.factory = factory
@@ -99,7 +117,24 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
         self.role = "TAKER"
         self.crypto_boxes = {}
         self.sig_lock = threading.Lock()
+        self.msgsig_requests = []
+        self.msgsig_verify_requests = []
+        self.msgsig_flush = None
+        #set in on_JM_INIT if the client asks for verification in the daemon
+        self.nick_sig_verifier = None
+        self.orderbook_requests = OrderedDict()
+        self.orderbook_flush = None
+        self.set_offerlist([])
+        #the nicks seen offering, kept by makers in place of the orderbook
+        self.offer_counterparties = set()
         self.active_orders = {}
+        #timings of the protocol stages, per counterparty
+        self.metrics = get_metrics()
+        self.maker_timeout_min_sec = None
+        self.accept_commitment_broadcasts = True
+        self.stage1_start = None
+        self.stage1_timeout = None
+        self.maker_response_times = deque(maxlen=self.stage1_max_samples)
 
     def checkClientResponse(self, response):
         """A generic check of client acceptance; any failure
@@ -120,7 +155,10 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
 
     @JMInit.responder
     def on_JM_INIT(self, bcsource, network, irc_configs, minmakers,
-                   maker_timeout_sec):
+                   maker_timeout_sec, verify_nick_sigs=None,
+                   hedge_privmsgs=None, maker_timeout_min_sec=None,
+                   accept_commitment_broadcasts=None, max_privmsg_size=None,
+                   max_partial_privmsgs=None, partial_privmsg_timeout=None):
         """Reads in required configuration from client for a new
         session; feeds back joinmarket messaging protocol constants
         (required for nick creation).
@@ -128,7 +166,17 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
         one is shutdown in preparation.
         """
         self.maker_timeout_sec = int(maker_timeout_sec)
+        self.maker_timeout_min_sec = maker_timeout_min_sec
+        self.accept_commitment_broadcasts = (
+            accept_commitment_broadcasts is not False)
         self.minmakers = int(minmakers)
+        if not verify_nick_sigs:
+            self.nick_sig_verifier = None
+        elif not nick_verification_available():
+            log.msg("jmbitcoin is not installed, nick signatures will be "
+                    "verified by the client.")
+        elif not self.nick_sig_verifier:
+            self.nick_sig_verifier = NickSignatureVerifier()
         irc_configs = json.loads(irc_configs)
         #(bitcoin) network only referenced in channel name construction
         self.network = network
@@ -159,6 +207,14 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
                                               self.on_commitment_seen,
                                               self.on_commitment_transferred)
             self.mcc.set_daemon(self)
+        self.mcc.hedge_privmsgs = bool(hedge_privmsgs)
+        limits = dict((k, v) for k, v in [
+            ('max_privmsg_size', max_privmsg_size),
+            ('max_partial_privmsgs', max_partial_privmsgs),
+            ('partial_privmsg_timeout', partial_privmsg_timeout)]
+                      if v is not None)
+        for mc in self.mcc.mchannels:
+            mc.set_privmsg_limits(limits)
         d = self.callRemote(JMInitProto,
                             nick_hash_length=NICK_HASH_LENGTH,
                             nick_max_encoded=NICK_MAX_ENCODED,
@@ -191,8 +247,13 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
         if self.role == "TAKER":
             self.mcc.pubmsg(COMMAND_PREFIX + "orderbook")
         elif self.role == "MAKER":
-            self.offerlist = json.loads(initdata)
-            self.mcc.announce_orders(self.offerlist)
+            #makers only need the counterparties of the orderbook (see
+            #transfer_commitment); not keeping it matters when a daemon
+            #serves many of them
+            self.on_disconnect()
+            self.set_offerlist(json.loads(initdata))
+            self.mcc.announce_orders(self.offerlist,
+                                     orderlines=self.get_offerlines())
         self.jm_state = 1
         return {'accepted': True}
 
@@ -209,19 +270,39 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
             self.mcc.on_verified_privmsg(nick, fullmsg, hostid)
         return {'accepted': True}
 
+    @JMMsgSignatureBatch.responder
+    def on_JM_MSGSIGNATURE_BATCH(self, signatures):
+        for s in signatures:
+            self.on_JM_MSGSIGNATURE(s['nick'], s['cmd'], s['msg_to_return'],
+                                    s['hostid'])
+        return {'accepted': True}
+
+    @JMMsgSignatureVerifyBatch.responder
+    def on_JM_MSGSIGNATURE_VERIFY_BATCH(self, results):
+        for r in results:
+            self.on_JM_MSGSIGNATURE_VERIFY(r['verif_result'], r['nick'],
+                                           r['fullmsg'], r['hostid'])
+        return {'accepted': True}
+
     """Taker specific responders
     """
 
     @JMRequestOffers.responder
-    def on_JM_REQUEST_OFFERS(self):
-        """Reports the current state of the orderbook.
+    def on_JM_REQUEST_OFFERS(self, since=None):
+        """Reports the current state of the orderbook: in full,
+        or as the changes since the client's version since, if
+        they are still available.
         This call is stateless."""
-        rows = self.db.execute('SELECT * FROM orderbook;').fetchall()
-        self.orderbook = [dict([(k, o[k]) for k in ORDER_KEYS]) for o in rows]
-        log.msg("About to send orderbook of size: " + str(len(self.orderbook)))
-        string_orderbook = json.dumps(self.orderbook)
+        version, full, data = self.get_orderbook_update(since)
+        if full:
+            log.msg("About to send orderbook of size: " + str(len(data)))
+        else:
+            log.msg("About to send orderbook changes: {} new, {} "
+                    "cancelled".format(len(data['add']), len(data['cancel'])))
         d = self.callRemote(JMOffers,
-                        orderbook=string_orderbook)
+                            orderbook=data,
+                            version=version,
+                            full=full)
         self.defaultCallbacks(d)
         return {'accepted': True}
 
@@ -242,7 +323,15 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
             offer_fill_msg = " ".join([str(offer_dict["oid"]), str(amount), str(
                 self.kp.hex_pk()), str(commitment)])
             self.mcc.prepare_privmsg(nick, "fill", offer_fill_msg)
-        reactor.callLater(self.maker_timeout_sec, self.completeStage1)
+            self.metrics.mark_stage("taker", "fill", nick, first=True)
+        self.cancel_stage1_timeout()
+        self.stage1_start = self.clock.seconds()
+        timeout = self.get_stage1_timeout()
+        if timeout < self.maker_timeout_sec:
+            log.msg("Waiting at most {:.1f} seconds for makers to "
+                    "respond".format(timeout))
+        self.stage1_timeout = self.clock.callLater(timeout,
+                                                   self.completeStage1)
         self.jm_state = 2
         return {'accepted': True}
 
@@ -256,6 +345,8 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
             return {'accepted': False}
         nick_list = json.loads(nick_list)
         self.mcc.send_tx(nick_list, txhex)
+        for nick in nick_list:
+            self.metrics.mark_stage("taker", "tx", nick)
         return {'accepted': True}
 
     @JMPushTx.responder
@@ -276,7 +367,7 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
             return
         to_announce = json.loads(to_announce)
         to_cancel = json.loads(to_cancel)
-        self.offerlist = json.loads(offerlist)
+        self.set_offerlist(json.loads(offerlist))
         if len(to_cancel) > 0:
             self.mcc.cancel_orders(to_cancel)
         if len(to_announce) > 0:
@@ -303,6 +394,7 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
         msg = str(",".join(utxos.keys())) + " " + " ".join(
             [pubkey, cjaddr, changeaddr, pubkeysig])
         self.mcc.prepare_privmsg(nick, "ioauth", msg)
+        self.metrics.mark_stage("maker", "ioauth", nick)
         #In case of *blacklisted (ie already used) commitments, we already
         #broadcasted them on receipt; in case of valid, and now used commitments,
         #we broadcast them here, and not early - to avoid accidentally
@@ -323,6 +415,7 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
         sigs = _byteify(json.loads(sigs))
         for sig in sigs:
             self.mcc.prepare_privmsg(nick, "sig", sig)
+        self.metrics.mark_stage("maker", "sig", nick)
         return {"accepted": True}
 
     """Message channel callbacks
@@ -334,11 +427,88 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
         d = self.callRemote(JMUp)
         self.defaultCallbacks(d)
 
+    def on_order_seen(self, counterparty, *args):
+        if self.role == "MAKER":
+            with self.oblock:
+                self.offer_counterparties.add(counterparty)
+        else:
+            OrderbookWatch.on_order_seen(self, counterparty, *args)
+
+    def on_orders_seen(self, counterparty, offers):
+        if self.role == "MAKER":
+            with self.oblock:
+                self.offer_counterparties.add(counterparty)
+        else:
+            OrderbookWatch.on_orders_seen(self, counterparty, offers)
+
+    def on_nick_leave(self, nick):
+        with self.oblock:
+            self.offer_counterparties.discard(nick)
+        OrderbookWatch.on_nick_leave(self, nick)
+
+    def on_disconnect(self):
+        with self.oblock:
+            self.offer_counterparties.clear()
+        OrderbookWatch.on_disconnect(self)
+
+    def get_offer_counterparties(self):
+        """The nicks seen offering; for a maker, which keeps no
+        orderbook, those not seen leaving since.
+        """
+        with self.oblock:
+            if self.role == "MAKER":
+                return list(self.offer_counterparties)
+            return self.orderbook.counterparties()
+
+    def set_offerlist(self, offerlist):
+        self.offerlist = offerlist
+        #rendered on first use, see get_offerlines
+        self.offerlines = None
+
+    def get_offerlines(self):
+        if self.offerlines is None:
+            self.offerlines = MessageChannelCollection.render_orderlines(
+                self.offerlist)
+        return self.offerlines
+
     @maker_only
     def on_orderbook_requested(self, nick, mc=None):
-        """Dealt with by daemon, assuming offerlist is up to date
+        """Dealt with by daemon, assuming offerlist is up to date.
+        The response is sent after orderbook_response_window, together
+        with those to any other requests received in the meantime.
+        """
+        self.orderbook_requests[(nick, mc)] = None
+        if not self.orderbook_flush:
+            self.orderbook_flush = reactor.callLater(
+                self.orderbook_response_window, self.flush_orderbook_requests)
+
+    def flush_orderbook_requests(self):
+        """Answers the pending !orderbook requests, per message channel
+        either by privmsg to each requester, or, if there are
+        orderbook_reannounce_min or more of them, by a single
+        announcement in public.
         """
-        self.mcc.announce_orders(self.offerlist, nick, mc)
+        if self.orderbook_flush and self.orderbook_flush.active():
+            self.orderbook_flush.cancel()
+        self.orderbook_flush = None
+        requests = self.orderbook_requests
+        self.orderbook_requests = OrderedDict()
+        if not self.offerlist:
+            return
+        by_mc = OrderedDict()
+        for nick, mc in requests:
+            by_mc.setdefault(mc, []).append(nick)
+        offerlines = self.get_offerlines()
+        for mc, nicks in by_mc.items():
+            if mc is not None and len(nicks) >= self.orderbook_reannounce_min:
+                log.msg("Answering {} orderbook requests with a public "
+                        "announcement".format(len(nicks)))
+                self.mcc.announce_orders(self.offerlist, None, mc,
+                                         orderlines=offerlines)
+                continue
+            for nick in nicks:
+                self.mcc.announce_orders(self.offerlist, nick, mc,
+                                         orderlines=offerlines)
 
     @maker_only
     def on_order_fill(self, nick, oid, amount, taker_pk, commit):
@@ -356,6 +526,7 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
         """
         if nick in self.active_orders:
             log.msg("Restarting transaction for nick: " + nick)
+        self.metrics.mark_stage("maker", "fill", nick, first=True)
         if not commit[0] in COMMITMENT_PREFIXES:
             self.mcc.send_error(nick,
                                 "Unsupported commitment type: " + str(commit[0]))
@@ -392,6 +563,7 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
                                         "amount": amount,
                                         "commit": scommit}
         self.mcc.prepare_privmsg(nick, "pubkey", kp.hex_pk())
+        self.metrics.mark_stage("maker", "pubkey", nick)
 
     @maker_only
     def on_seen_auth(self, nick, commitment_revelation):
@@ -402,6 +574,7 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
 	"""
         if not nick in self.active_orders:
             return
+        self.metrics.mark_stage("maker", "auth", nick)
         ao =self.active_orders[nick]
         #ask the client to validate the commitment and prepare the utxo data
         d = self.callRemote(JMAuthReceived,
@@ -419,12 +592,7 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
 	appear in the public pit channel. If the policy is set,
 	we blacklist this commitment.
 	"""
-        if jm_single().config.has_option("POLICY", "accept_commitment_broadcasts"):
-            blacklist_add = jm_single().config.getint("POLICY",
-                                                    "accept_commitment_broadcasts")
-        else:
-            blacklist_add = 0
-        if blacklist_add > 0:
+        if self.accept_commitment_broadcasts:
             #just add if necessary, ignore return value.
             check_utxo_blacklist(commitment, persist=True)
             log.msg("Received commitment broadcast by other maker: " + str(
@@ -457,13 +625,14 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
             return
         #we send a copy of the entire "active_orders" entry except the cryptobox,
         #so make a temporary copy
+        self.metrics.mark_stage("maker", "tx", nick)
         ao = copy.deepcopy(self.active_orders[nick])
         del ao["crypto_box"]
         del ao["kp"]
         d = self.callRemote(JMTXReceived,
                             nick=nick,
                             txhex=txhex,
-                            offer=json.dumps(ao))
+                            offer=ao)
         self.defaultCallbacks(d)
 
     @taker_only
@@ -474,6 +643,7 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
         if nick not in self.active_orders.keys():
             log.msg("Counterparty not part of this transaction. Ignoring")
             return
+        self.metrics.mark_stage("taker", "pubkey", nick)
         try:
             self.crypto_boxes[nick] = [maker_pk, as_init_encryption(
                 self.kp, init_pubkey(maker_pk))]
@@ -482,6 +652,7 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
             self.mcc.send_error(nick, "invalid nacl pubkey: " + maker_pk)
             return
         self.mcc.prepare_privmsg(nick, "auth", str(self.revelation))
+        self.metrics.mark_stage("taker", "auth", nick)
 
     @taker_only
     def on_ioauth(self, nick, utxo_list, auth_pub, cj_addr, change_addr,
@@ -493,9 +664,15 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
         if nick not in self.active_orders.keys():
             print("Got an unexpected ioauth from nick: " + str(nick))
             return
+        self.metrics.mark_stage("taker", "ioauth", nick)
+        if nick not in self.ioauth_data:
+            #late responses count too, so that a short timeout does not
+            #only see the makers that beat it
+            self.maker_response_times.append(
+                self.clock.seconds() - self.stage1_start)
         self.ioauth_data[nick] = [utxo_list, auth_pub, cj_addr, change_addr,
                                   btc_sig, self.crypto_boxes[nick][0]]
-        if self.ioauth_data.keys() == self.active_orders.keys():
+        if set(self.ioauth_data) == set(self.active_orders):
             #Finish early if we got all
             self.respondToIoauths(True)
 
@@ -503,6 +680,7 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
     def on_sig(self, nick, sig):
         """Pass signature through to Taker.
         """
+        self.metrics.mark_stage("taker", "sig", nick)
         d = self.callRemote(JMSigReceived,
                         nick=nick,
                         sig=sig)
@@ -523,28 +701,63 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
         duplication is so that the client does not need to know the
         message syntax.
         """
-        with self.sig_lock:
-            d = self.callRemote(JMRequestMsgSig,
-                            nick=str(nick),
-                            cmd=str(cmd),
-                            msg=str(msg),
-                            msg_to_be_signed=str(msg_to_be_signed),
-                            hostid=str(hostid))
-            self.defaultCallbacks(d)
+        self.queue_msgsig_request(self.msgsig_requests,
+                                  {'nick': str(nick),
+                                   'cmd': str(cmd),
+                                   'msg': str(msg),
+                                   'msg_to_be_signed': str(msg_to_be_signed),
+                                   'hostid': str(hostid)})
 
     def request_signature_verify(self, msg, fullmsg, sig, pubkey, nick, hashlen,
                                  max_encoded, hostid):
+        #requests already queued for the client are answered first, to
+        #keep the order of messages
+        if self.nick_sig_verifier and not self.msgsig_verify_requests:
+            with self.metrics.timer("nick_sig_verify"):
+                verif_result = self.nick_sig_verifier.verify(
+                    msg, sig, pubkey, nick, hashlen, max_encoded)
+            self.on_JM_MSGSIGNATURE_VERIFY(verif_result, nick, fullmsg, hostid)
+            return
+        self.queue_msgsig_request(self.msgsig_verify_requests,
+                                  {'msg': msg,
+                                   'fullmsg': fullmsg,
+                                   'sig': sig,
+                                   'pubkey': pubkey,
+                                   'nick': nick,
+                                   'hashlen': hashlen,
+                                   'max_encoded': max_encoded,
+                                   'hostid': hostid})
+
+    def queue_msgsig_request(self, queue, request):
         with self.sig_lock:
-            d = self.callRemote(JMRequestMsgSigVerify,
-                                msg=msg,
-                                fullmsg=fullmsg,
-                                sig=sig,
-                                pubkey=pubkey,
-                                nick=nick,
-                                hashlen=hashlen,
-                                max_encoded=max_encoded,
-                                hostid=hostid)
-            self.defaultCallbacks(d)
+            queue.append(request)
+            if len(queue) < self.msgsig_batch_max:
+                if not self.msgsig_flush:
+                    self.msgsig_flush = reactor.callLater(
+                        self.msgsig_batch_window, self.flush_msgsig_requests)
+                return
+        self.flush_msgsig_requests()
+
+    def flush_msgsig_requests(self):
+        """Send all queued signing and verification requests to
+        the client; the responses come back in the same order in
+        on_JM_MSGSIGNATURE_BATCH and on_JM_MSGSIGNATURE_VERIFY_BATCH.
+        """
+        with self.sig_lock:
+            if self.msgsig_flush and self.msgsig_flush.active():
+                self.msgsig_flush.cancel()
+            self.msgsig_flush = None
+            sign_requests = self.msgsig_requests
+            verify_requests = self.msgsig_verify_requests
+            self.msgsig_requests = []
+            self.msgsig_verify_requests = []
+            for batch in split_amplist(sign_requests):
+                d = self.callRemote(JMRequestMsgSigBatch, requests=batch)
+                self.defaultCallbacks(d)
+            for batch in split_amplist(verify_requests):
+                d = self.callRemote(JMRequestMsgSigVerifyBatch,
+                                    requests=batch)
+                self.defaultCallbacks(d)
 
     def init_connections(self, nick):
         """Sets up message channel connections
@@ -566,13 +779,10 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
         """Send this commitment via privmsg to one (random)
 	other maker.
 	"""
-        crow = self.db.execute(
-                        'SELECT DISTINCT counterparty FROM orderbook ORDER BY ' +
-                        'RANDOM() LIMIT 1;'
-                    ).fetchone()
-        if crow is None:
+        counterparties = self.get_offer_counterparties()
+        if not counterparties:
             return
-        counterparty = crow['counterparty']
+        counterparty = random.choice(counterparties)
         #TODO de-hardcode hp2
         log.msg("Sending commitment to: " + str(counterparty))
         self.mcc.prepare_privmsg(counterparty, 'hp2', commit)
@@ -593,14 +803,20 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
             #do nothing
             return
         self.jm_state = 3
+        self.cancel_stage1_timeout()
         if not accepted:
             #use ioauth data field to return the list of non-responsive makers
             nonresponders = [x for x in self.active_orders.keys() if x not
                              in self.ioauth_data.keys()]
+        #count the makers that did not respond in time, whether or not
+        #enough others did
+        for nick in self.active_orders:
+            if nick not in self.ioauth_data:
+                self.metrics.increment("taker stage1_timeout", nick)
         ioauth_data = self.ioauth_data if accepted else nonresponders
         d = self.callRemote(JMFillResponse,
                                 success=accepted,
-                                ioauth_data = json.dumps(ioauth_data))
+                                ioauth_data=ioauth_data)
         if not accepted:
             #Client simply accepts failure TODO
             self.defaultCallbacks(d)
@@ -610,11 +826,39 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
             d.addCallback(self.checkUtxosAccepted)
             d.addErrback(self.defaultErrback)
 
+    def get_stage1_timeout(self):
+        """Returns the time in seconds to wait for makers' !ioauth
+        responses; see stage1_timeout_quantile.
+        """
+        times = self.maker_response_times
+        if (self.maker_timeout_min_sec is None or
+                len(times) < self.stage1_min_samples):
+            return self.maker_timeout_sec
+        times = sorted(times)
+        q = times[int(self.stage1_timeout_quantile * (len(times) - 1))]
+        return max(self.maker_timeout_min_sec,
+                   min(self.maker_timeout_sec,
+                       q * self.stage1_timeout_factor))
+
+    def cancel_stage1_timeout(self):
+        if self.stage1_timeout and self.stage1_timeout.active():
+            self.stage1_timeout.cancel()
+        self.stage1_timeout = None
+
     def completeStage1(self):
         """Timeout of stage 1 requests;
         either send success + ioauth data if enough makers,
         else send failure to client.
+        If an adapted timeout passes without enough makers, waits on
+        for them until maker_timeout_sec.
         """
+        self.stage1_timeout = None
+        remaining = self.stage1_start + self.maker_timeout_sec - \
+            self.clock.seconds()
+        if len(self.ioauth_data) < self.minmakers and remaining > 0:
+            self.stage1_timeout = self.clock.callLater(remaining,
+                                                       self.completeStage1)
+            return
         response = True if len(self.ioauth_data.keys()) >= self.minmakers else False
         self.respondToIoauths(response)
 
@@ -1,13 +1,14 @@
 from __future__ import absolute_import, print_function
 
 #TODO: SSL support (can it be done without back-end openssl?)
-from twisted.internet import reactor, protocol
+from twisted.internet import reactor, protocol, task
 from twisted.internet.endpoints import TCP4ClientEndpoint
 from twisted.application.internet import ClientService
 from twisted.internet.ssl import ClientContextFactory
 from twisted.words.protocols import irc
 from twisted.internet.error import (ConnectionLost, ConnectionAborted,
                                     ConnectionClosed, ConnectionDone)
+from collections import deque, OrderedDict
 from jmdaemon.message_channel import MessageChannel
 from jmbase.support import get_log, chunks
 from txsocksx.client import SOCKS5ClientEndpoint
@@ -42,6 +43,154 @@ def get_config_irc_channel(chan_name, btcnet):
         channel += "-test"
     return channel
 
+#Priority classes of outbound lines, highest priority first.
+#IRC protocol lines (PING, PONG, JOIN, NICK..) are sent ahead of all
+#joinmarket messages, and messages negotiating a transaction ahead of
+#orderbook traffic and commitment gossip.
+PRIORITY_CONTROL, PRIORITY_TX, PRIORITY_DEFAULT, PRIORITY_ORDERBOOK = range(4)
+PRIORITY_NAMES = ["control", "tx", "default", "orderbook"]
+tx_commands = encrypted_commands + ["fill", "pubkey", "push", "error"]
+orderbook_commands = (["orderbook", "cancel"] + offername_list +
+                      commitment_broadcast_list)
+
+def get_command_priority(cmd):
+    if cmd in tx_commands:
+        return PRIORITY_TX
+    if cmd in orderbook_commands:
+        return PRIORITY_ORDERBOOK
+    return PRIORITY_DEFAULT
+
+
+def pack_orderlines(header, orderlines, max_len=MAX_PRIVMSG_LEN):
+    """Returns the lines, each of header followed by as many of
+    orderlines as fit within max_len, and a ' ~' trailer, that
+    announce all of orderlines in order. An orderline too long to fit
+    on any line is sent on its own.
+    """
+    lines = []
+    current = []
+    length = len(header) + 2
+    for orderline in orderlines:
+        if current and length + len(orderline) > max_len:
+            lines.append(header + ''.join(current) + ' ~')
+            current = []
+            length = len(header) + 2
+        current.append(orderline)
+        length += len(orderline)
+    if current:
+        lines.append(header + ''.join(current) + ' ~')
+    return lines
+
+
+class OutboundScheduler(object):
+    """Paces the lines written to one IRC connection with a token
+    bucket: up to burst lines may be sent at once, and then rate lines
+    per second. Queued lines are sent in order of priority class (see
+    PRIORITY_NAMES), and in order of queueing within a class.
+    Lines are queued as messages: once the first line of a message has
+    been sent, no line of another message to the same destination is
+    sent before its last, so that chunked privmsgs are not interleaved.
+    """
+
+    def __init__(self, write, rate, burst, clock=reactor):
+        self.write = write
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.last_refill = clock.seconds()
+        #one queue per priority class of [destination, deque of lines];
+        #only the message at the head of a queue can be partly sent.
+        self.queues = [deque() for _ in PRIORITY_NAMES]
+        self.partial = {}
+        self.queued = [0] * len(PRIORITY_NAMES)
+        self.max_queued = [0] * len(PRIORITY_NAMES)
+        self.sent = [0] * len(PRIORITY_NAMES)
+        self.drain_call = None
+
+    def push(self, lines, priority=PRIORITY_DEFAULT, destination=None):
+        """Queue the lines of one message; destination is
+        the nick or channel it is sent to, if any.
+        """
+        if not lines:
+            return
+        self.queues[priority].append([destination, deque(lines)])
+        self.queued[priority] += len(lines)
+        self.max_queued[priority] = max(self.max_queued[priority],
+                                        self.queued[priority])
+        if not self.drain_call:
+            self.drain()
+
+    def refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def next_line(self):
+        """Removes and returns the next line to be sent, with its
+        priority class, or (None, None) if nothing is queued.
+        """
+        for priority, queue in enumerate(self.queues):
+            if not queue:
+                continue
+            message = queue[0]
+            blocking = self.partial.get(message[0])
+            if blocking is not None and blocking[1] is not message:
+                #finish the message already being sent to this destination
+                priority, message = blocking
+                queue = self.queues[priority]
+            line = message[1].popleft()
+            self.queued[priority] -= 1
+            self.sent[priority] += 1
+            if message[1]:
+                if message[0] is not None:
+                    self.partial[message[0]] = (priority, message)
+            else:
+                queue.popleft()
+                self.partial.pop(message[0], None)
+            return line, priority
+        return None, None
+
+    def drain(self):
+        self.drain_call = None
+        self.refill()
+        while self.tokens >= 1:
+            line, priority = self.next_line()
+            if line is None:
+                return
+            self.tokens -= 1
+            self.write(line)
+        if any(self.queued):
+            self.drain_call = self.clock.callLater(
+                (1 - self.tokens) / self.rate, self.drain)
+
+    def stop(self):
+        """Discard all queued lines.
+        """
+        if self.drain_call and self.drain_call.active():
+            self.drain_call.cancel()
+        self.drain_call = None
+        for queue in self.queues:
+            queue.clear()
+        self.partial = {}
+        self.queued = [0] * len(PRIORITY_NAMES)
+
+    def queue_depths(self):
+        """Returns the number of lines waiting to be sent,
+        by priority class name.
+        """
+        return dict(zip(PRIORITY_NAMES, self.queued))
+
+    def get_stats(self):
+        """Returns, by priority class name, a dict of the number
+        of lines queued, the most ever queued and the number sent.
+        """
+        return dict((name, {'queued': self.queued[i],
+                            'max_queued': self.max_queued[i],
+                            'sent': self.sent[i]})
+                    for i, name in enumerate(PRIORITY_NAMES))
+
 class TxIRCFactory(protocol.ReconnectingClientFactory):
     def __init__(self, wrapper):
         self.wrapper = wrapper
@@ -94,6 +243,8 @@ class IRCMessageChannel(MessageChannel):
         self.password = password
         
         self.tx_irc_client = None
+        #overriding txIRC_Client's limits on privmsg reassembly
+        self.privmsg_limits = {}
         #TODO can be configuration var, how long between reconnect attempts:
         self.reconnect_interval = 10
     #implementation of abstract base class methods;
@@ -120,9 +271,26 @@ class IRCMessageChannel(MessageChannel):
         self.tx_irc_client._announce_orders(offerlist)
     #end ABC impl.
 
+    def get_outbound_stats(self):
+        """Outbound queue metrics of the current connection (see
+        OutboundScheduler.get_stats), or None if not connected.
+        """
+        if not self.tx_irc_client or not self.tx_irc_client.scheduler:
+            return None
+        return self.tx_irc_client.scheduler.get_stats()
+
     def set_tx_irc_client(self, txircclt):
         self.tx_irc_client = txircclt
 
+    def set_privmsg_limits(self, limits):
+        """Sets the limits on reassembly of privmsgs (attributes of
+        txIRC_Client, by name) for this and any later connection.
+        """
+        self.privmsg_limits = limits
+        if self.tx_irc_client:
+            for k, v in limits.items():
+                setattr(self.tx_irc_client, k, v)
+
     def build_irc(self):
         """The main starting method that creates a protocol object
         according to the config variables, ready for whenever
@@ -163,15 +331,32 @@ class IRCMessageChannel(MessageChannel):
 
 class txIRC_Client(irc.IRCClient, object):
     """
-    lineRate is a class variable in the superclass used to limit
-    messages / second.  heartbeat is what you'd think.
+    Outbound lines are paced by an OutboundScheduler, in place of the
+    superclass's lineRate queue, with line_rate lines per second after
+    an initial burst of up to line_burst lines.
+    heartbeat is what you'd think.
     """
     #In previous implementation, 450 bytes per second over the last 4 seconds
     #was used as the rate limiter/throttle parameter.
-    #Since we still have max_privmsg_len = 450, that corresponds to a lineRate
-    #value of 1.0 (seconds). Bumped to 1.3 here for breathing room.
-    lineRate = 1.3
+    #Since we still have max_privmsg_len = 450, that corresponds to a rate
+    #of 1 line per second. Reduced to 1 per 1.3s here for breathing room.
+    lineRate = None
+    line_rate = 1 / 1.3
+    line_burst = 3
     heartbeatinterval = 60
+    scheduler = None
+    #Limits on reassembly of chunked privmsgs: at most max_privmsg_size
+    #bytes per message, and partial messages from at most
+    #max_partial_privmsgs nicks (the least recently active are dropped
+    #first); a partial message is dropped if no chunk of it is received
+    #for partial_privmsg_timeout seconds. The defaults here are
+    #overridden by those of the wrapper (see set_privmsg_limits), from
+    #the client's [MESSAGING] config. An encrypted !tx of a standard
+    #transaction (at most 100kB) is under 200kB.
+    max_privmsg_size = 400000
+    max_partial_privmsgs = 500
+    partial_privmsg_timeout = 60
+    clock = reactor
 
     def __init__(self, wrapper):
         self.wrapper = wrapper
@@ -179,7 +364,14 @@ class txIRC_Client(irc.IRCClient, object):
         self.nickname = self.wrapper.nick
         self.password = self.wrapper.password
         self.hostname = self.wrapper.serverport[0]
-        self.built_privmsg = {}
+        for k, v in self.wrapper.privmsg_limits.items():
+            setattr(self, k, v)
+        #nick : [list of chunks, total length, time of last chunk],
+        #in order of last chunk received
+        self.built_privmsg = OrderedDict()
+        self.privmsg_evictor = None
+        self.packed_offerlist = None
+        self.packed_lines = None
         # todo: build pong timeout watchdot
 
     def irc_unknown(self, prefix, command, params):
@@ -190,20 +382,37 @@ class txIRC_Client(irc.IRCClient, object):
         pass
 
     def connectionMade(self):
+        self.scheduler = OutboundScheduler(self._reallySendLine,
+                                           self.line_rate, self.line_burst)
+        self.privmsg_evictor = task.LoopingCall(self.evict_stale_privmsgs)
+        self.privmsg_evictor.clock = self.clock
+        self.privmsg_evictor.start(self.partial_privmsg_timeout, now=False)
         return irc.IRCClient.connectionMade(self)
 
     def connectionLost(self, reason=protocol.connectionDone):
+        if self.scheduler:
+            self.scheduler.stop()
+        if self.privmsg_evictor and self.privmsg_evictor.running:
+            self.privmsg_evictor.stop()
         if self.wrapper.on_disconnect:
             reactor.callLater(0.0, self.wrapper.on_disconnect, self.wrapper)
         return irc.IRCClient.connectionLost(self, reason)
 
-    def send(self, send_to, msg):
+    def sendLine(self, line):
+        #IRC protocol lines from the superclass
+        self.scheduler.push([line], PRIORITY_CONTROL)
+
+    def send(self, send_to, msgs, priority=PRIORITY_DEFAULT):
+        """Queue the lines msgs as one message to send_to.
+        """
         # todo: use proper twisted IRC support (encoding + sendCommand)
-        omsg = 'PRIVMSG %s :' % (send_to,) + msg
-        self.sendLine(omsg.encode('ascii'))
+        lines = [('PRIVMSG %s :' % (send_to,) + msg).encode('ascii')
+                 for msg in msgs]
+        self.scheduler.push(lines, priority, send_to)
 
     def _pubmsg(self, message):
-        self.send(self.channel, message)
+        cmd = message[1:].split(' ')[0]
+        self.send(self.channel, [message], get_command_priority(cmd))
 
     def _privmsg(self, nick, cmd, message):
         header = "PRIVMSG " + nick + " :"
@@ -213,11 +422,13 @@ class txIRC_Client(irc.IRCClient, object):
             message_chunks = chunks(message, max_chunk_len)
         else:
             message_chunks = [message]
+        msgs = []
         for m in message_chunks:
             trailer = ' ~' if m == message_chunks[-1] else ' ;'
             if m == message_chunks[0]:
                 m = COMMAND_PREFIX + cmd + ' ' + m
-            self.send(nick, m + trailer)
+            msgs.append(m + trailer)
+        self.send(nick, msgs, get_command_priority(cmd))
 
     def _announce_orders(self, offerlist):
         """This publishes orders to the pit and to
@@ -237,16 +448,15 @@ class txIRC_Client(irc.IRCClient, object):
         Order announce in private is handled by privmsg/_privmsg
         using chunking, no longer using this function.
         """
-        header = 'PRIVMSG ' + self.channel + ' :'
-        offerlines = []
-        for i, offer in enumerate(offerlist):
-            offerlines.append(offer)
-            line = header + ''.join(offerlines) + ' ~'
-            if len(line) > MAX_PRIVMSG_LEN or i == len(offerlist) - 1:
-                if i < len(offerlist) - 1:
-                    line = header + ''.join(offerlines[:-1]) + ' ~'
-                self.sendLine(line)
-                offerlines = [offerlines[-1]]        
+        #the packed lines are kept for as long as the same offerlist
+        #object (cached by MessageChannelCollection) is announced.
+        if offerlist is not self.packed_offerlist:
+            header = 'PRIVMSG ' + self.channel + ' :'
+            self.packed_lines = pack_orderlines(header, offerlist)
+            self.packed_offerlist = offerlist
+        for line in self.packed_lines:
+            #each line is a complete message
+            self.scheduler.push([line], PRIORITY_ORDERBOOK)
     # ---------------------------------------------
     # general callbacks from superclass
     # ---------------------------------------------
@@ -276,26 +486,33 @@ class txIRC_Client(irc.IRCClient, object):
             # todo: kludge - we need this elsewhere. rearchitect!!
             self.from_to = (nick, sent_to)
             if sent_to == self.wrapper.nick:
-                if nick not in self.built_privmsg:
+                #removed from the message buffer while it is updated;
+                #it is put back, as the most recent, if not complete
+                built = self.built_privmsg.pop(nick, None)
+                if built is None:
                     if message[0] != COMMAND_PREFIX:
                         wlog('bad command ', message[0])
                         return
-    
                     # new message starting
-                    cmd_string = message[1:].split(' ')[0]
-                    self.built_privmsg[nick] = [cmd_string, message[:-2]]
-                else:
-                    self.built_privmsg[nick][1] += message[:-2]
+                    built = [[], 0, None]
+                chunk = message[:-2]
+                built[0].append(chunk)
+                built[1] += len(chunk)
+                if built[1] > self.max_privmsg_size:
+                    wlog('WARNING', 'dropping privmsg from: ' + nick +
+                         ', it is larger than max_privmsg_size (' +
+                         str(self.max_privmsg_size) + ')')
+                    return
                 if message[-1] == ';':
-                    pass
+                    built[2] = self.clock.seconds()
+                    self.built_privmsg[nick] = built
+                    while len(self.built_privmsg) > self.max_partial_privmsgs:
+                        dropped = self.built_privmsg.popitem(last=False)[0]
+                        wlog('WARNING', 'dropping partial privmsg from: ' +
+                             dropped + ', over max_partial_privmsgs')
                 elif message[-1] == '~':
-                    parsed = self.built_privmsg[nick][1]
-                    # wipe the message buffer waiting for the next one
-                    del self.built_privmsg[nick]
-                    self.__on_privmsg(nick, parsed)
-                else:
-                    # drop the bad nick
-                    del self.built_privmsg[nick]
+                    self.__on_privmsg(nick, ''.join(built[0]))
+                #otherwise, drop the bad nick's message
             elif sent_to == self.channel:
                 self.__on_pubmsg(nick, message)
             else:
@@ -303,6 +520,19 @@ class txIRC_Client(irc.IRCClient, object):
         except:
             wlog('unable to parse privmsg, msg: ', message)
 
+    def evict_stale_privmsgs(self):
+        """Drop partial privmsgs with no chunk received for
+        partial_privmsg_timeout seconds.
+        """
+        cutoff = self.clock.seconds() - self.partial_privmsg_timeout
+        while self.built_privmsg:
+            nick, built = next(self.built_privmsg.iteritems())
+            if built[2] > cutoff:
+                break
+            wlog('WARNING', 'dropping partial privmsg from: ' + nick +
+                 ', nothing received for partial_privmsg_timeout')
+            del self.built_privmsg[nick]
+
     def action(self, user, channel, msg):
         pass
         #wlog('unhandled action: ', user, channel, msg)
@@ -2,7 +2,9 @@
 from __future__ import print_function
 import abc
 import base64
+import hashlib
 import threading
+from collections import OrderedDict
 from jmdaemon import (
     encrypt_encode, decode_decrypt, COMMAND_PREFIX, ORDER_KEYS,
     NICK_HASH_LENGTH, NICK_MAX_ENCODED, JM_VERSION, JOINMARKET_NICK_HEADER,
@@ -10,9 +12,15 @@ from jmdaemon import (
     offername_list, public_commands, private_commands)
 from jmbase.support import get_log
 from functools import wraps
+from twisted.internet import reactor
 
 log = get_log()
 
+#Privmsgs sent over every channel a counterparty is seen on, if
+#MessageChannelCollection.hedge_privmsgs is set; these are the
+#steps of a coinjoin negotiation, where one slow channel delays all.
+hedged_commands = ["fill", "auth", "ioauth", "pubkey", "tx", "sig"]
+
 
 class CJPeerError(StandardError):
     pass
@@ -30,6 +38,29 @@ class MChannelThread(threading.Thread):
         self.mc.run()
 
 
+class ChannelLatency(object):
+    """Moving average of the response times of one message channel.
+    """
+    #weight of each new sample in the average
+    alpha = 0.2
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.last = None
+
+    def add(self, latency):
+        self.count += 1
+        self.last = latency
+        if self.mean is None:
+            self.mean = latency
+        else:
+            self.mean += self.alpha * (latency - self.mean)
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'last': self.last}
+
+
 class MessageChannelCollection(object):
     """Class which encapsulates a set of
     message channels. Maintains state about active
@@ -49,8 +80,17 @@ class MessageChannelCollection(object):
     Callback chain is in some cases extended with an extra
     layer, e.g. to manage a "connected" state across all
     encapsulated message channels.
+    If hedge_privmsgs is set, the privmsgs of a coinjoin negotiation
+    (hedged_commands) are instead sent on every channel on which the
+    counterparty is seen; the channel it responds on fastest becomes
+    its active channel.
     """
 
+    clock = reactor
+    #limits on the record of received privmsgs; see on_verified_privmsg
+    received_window = 300
+    max_received = 10000
+
     def check_privmsg(func):
         """decorator to check if private messages
         are correctly activated
@@ -110,6 +150,20 @@ class MessageChannelCollection(object):
         #control access
         self.mc_lock = threading.Lock()
         self.nick=None
+        #if set, hedged_commands are sent on all channels the nick is
+        #seen on; see prepare_privmsg.
+        self.hedge_privmsgs = False
+        #nick : (time sent, channels responded on) for the last hedged
+        #privmsg to each nick
+        self.hedges_pending = {}
+        self.channel_latency = dict((mc, ChannelLatency())
+                                    for mc in self.mchannels)
+        #digests of hedged_commands privmsgs received in the last
+        #received_window seconds, to drop copies received on other channels
+        self.received = OrderedDict()
+        #(orderlines, privmsg (cmd, msg)) of the last pre-rendered
+        #orderlines announced, see get_announcement
+        self.announcement = (None, None)
 
     def set_nick(self, nick):
         if nick != self.nick:
@@ -237,10 +291,77 @@ class MessageChannelCollection(object):
             log.info("Failed to send message to: " + str(nick) + \
                           "; cannot find on any message channel.")
             return
-        msg_to_be_signed = message + str(hostid)
+        hostids = [hostid]
+        if self.hedge_privmsgs and cmd in hedged_commands:
+            #the signature commits to the channel, so one is needed for each
+            hostids += [mc.hostid for mc in self.get_hedge_channels(nick)
+                        if mc.hostid != hostid]
+            self.hedges_pending[nick] = (self.clock.seconds(), set())
+        for hostid in hostids:
+            msg_to_be_signed = message + str(hostid)
+            self.daemon.request_signed_message(nick, cmd, message,
+                                               msg_to_be_signed, hostid)
+
+    def get_hedge_channels(self, nick):
+        return [mc for mc in self.available_channels()
+                if nick in self.nicks_seen[mc]]
+
+    def get_preferred_channel(self, nick):
+        """Returns the channel nick is seen on with the lowest
+        average response time, or None if there are no response
+        times for any of them.
+        """
+        timed = [(self.channel_latency[mc].mean, mc)
+                 for mc in self.get_hedge_channels(nick)
+                 if self.channel_latency[mc].mean is not None]
+        if not timed:
+            return None
+        return min(timed, key=lambda x: x[0])[1]
+
+    def record_response(self, nick, mc):
+        """Records, once per channel, the time from the last hedged
+        privmsg to nick to the arrival of a response on channel mc,
+        and makes the fastest channel the active one for nick.
+        """
+        if nick not in self.hedges_pending:
+            return
+        sent, responded = self.hedges_pending[nick]
+        if mc in responded:
+            return
+        responded.add(mc)
+        self.channel_latency[mc].add(self.clock.seconds() - sent)
+        preferred = self.get_preferred_channel(nick)
+        if preferred:
+            self.active_channels[nick] = preferred
+
+    def get_latency_stats(self):
+        """Returns the response time statistics of each message channel,
+        as a dict of count, mean and last, keyed by channel hostid.
+        """
+        return dict((mc.hostid, self.channel_latency[mc].to_dict())
+                    for mc in self.mchannels)
 
-        self.daemon.request_signed_message(nick, cmd, message, msg_to_be_signed,
-                                           hostid)
+    def is_duplicate(self, nick, message):
+        """Returns True if the verified privmsg message, of one of
+        hedged_commands, has already been received from nick (on any
+        channel) in the last received_window seconds.
+        """
+        cmd = message[1:].split(' ', 1)[0]
+        if cmd not in hedged_commands:
+            return False
+        #the signature, and the pubkey before it, are not part of the copy
+        #that is the same on all channels.
+        body = message.rsplit(' ', 2)[0]
+        key = hashlib.sha256(nick + ' ' + body).digest()
+        now = self.clock.seconds()
+        while self.received and (
+                len(self.received) >= self.max_received or
+                next(self.received.itervalues()) < now - self.received_window):
+            self.received.popitem(last=False)
+        if key in self.received:
+            return True
+        self.received[key] = now
+        return False
 
     def privmsg(self, nick, cmd, message, mc=None):
         """Send a message to a specific counterparty,
@@ -271,32 +392,59 @@ class MessageChannelCollection(object):
                           "; cannot find on any message channel.")
             return
 
-    def announce_orders(self, orderlist, nick=None, new_mc=None):
+    @staticmethod
+    def render_orderlines(orderlist):
+        """Returns the lines announcing each order in orderlist.
+        """
+        order_keys = ['oid', 'minsize', 'maxsize', 'txfee', 'cjfee']
+        return [COMMAND_PREFIX + order['ordertype'] + ' ' + ' '.join(
+            [str(order[k]) for k in order_keys]) for order in orderlist]
+
+    def get_announcement(self, orderlist, orderlines=None):
+        """Returns (orderlines, (cmd, msg)): the lines announcing
+        orderlist in public, and the privmsg announcing it to one
+        counterparty. orderlines, if set, is orderlist as rendered by
+        render_orderlines (such as the daemon's cached offer lines);
+        the privmsg made from it is then reused for as long as the
+        same lines are announced.
+        """
+        if orderlines is None:
+            orderlines = self.render_orderlines(orderlist)
+            cache = False
+        elif orderlines is self.announcement[0]:
+            return self.announcement
+        else:
+            cache = True
+        #in order to use privmsg, we must set "cmd" to be the first command
+        #in the first orderline, and the rest are treated like a message.
+        privmsg = None
+        if orderlines:
+            privmsg = (orderlist[0]['ordertype'],
+                       orderlines[0].split(' ', 1)[1] + ''.join(orderlines[1:]))
+        if cache:
+            self.announcement = (orderlines, privmsg)
+        return orderlines, privmsg
+
+    def announce_orders(self, orderlist, nick=None, new_mc=None,
+                        orderlines=None):
         """Send orders defined in list orderlist either
         to the shared public channel (pit), on all
-        message channels, if nick=None,
+        message channels (or only new_mc, if set), if nick=None,
         or to an individual counterparty nick, as
         privmsg, on a specific mc.
+        orderlines, if set, is orderlist as rendered by render_orderlines.
         """
-        order_keys = ['oid', 'minsize', 'maxsize', 'txfee', 'cjfee']
-        orderlines = []
-        for order in orderlist:
-            orderlines.append(COMMAND_PREFIX + order['ordertype'] + \
-                    ' ' + ' '.join([str(order[k]) for k in order_keys]))
         if new_mc is not None and new_mc not in self.available_channels():
             log.info(
                 "Tried to announce orders on an unavailable message channel.")
             return
+        orderlines, privmsg = self.get_announcement(orderlist, orderlines)
         if nick is None:
-            for mc in self.available_channels():
+            for mc in [new_mc] if new_mc else self.available_channels():
                 mc.announce_orders(orderlines)
         else:
             #we are sending to one cp, so privmsg
-            #in order to use privmsg, we must set "cmd" to be the first command
-            #in the first orderline, and the rest are treated like a message.
-            cmd = orderlist[0]['ordertype']
-            msg = ' '.join(orderlines[0].split(' ')[1:])
-            msg += ''.join(orderlines[1:])
+            cmd, msg = privmsg
             if new_mc:
                 self.prepare_privmsg(nick, cmd, msg, mc=new_mc)
             else:
@@ -529,19 +677,37 @@ class MessageChannelCollection(object):
             self.on_order_seen(counterparty, oid, ordertype, minsize, maxsize,
                                txfee, cjfee)
 
+    def on_orders_seen_trigger(self, mc, counterparty, offers):
+        """As on_order_seen_trigger, for a list of offers
+        (oid, ordertype, minsize, maxsize, txfee, cjfee) received
+        in one message.
+        """
+        self.nicks_seen[mc].add(counterparty)
+        self.active_channels[counterparty] = mc
+        if self.on_orders_seen:
+            self.on_orders_seen(counterparty, offers)
+        elif self.on_order_seen:
+            for o in offers:
+                self.on_order_seen(counterparty, *o)
+
     # orderbook watcher commands
     def register_orderbookwatch_callbacks(self,
                                           on_order_seen=None,
-                                          on_order_cancel=None):
+                                          on_order_cancel=None,
+                                          on_orders_seen=None):
         """Special cases:
         on_order_seen: use it as a trigger for presence of nick.
         on_order_cancel: what happens if cancel/modify in one place
         but not another? TODO
+        on_orders_seen: optional, called instead of on_order_seen for
+        messages consisting only of offers, with the list of them.
         """
         self.on_order_seen = on_order_seen
+        self.on_orders_seen = on_orders_seen
         for mc in self.mchannels:
             mc.register_orderbookwatch_callbacks(self.on_order_seen_trigger,
-                                                 on_order_cancel)
+                                                 on_order_cancel,
+                                                 self.on_orders_seen_trigger)
 
     def on_orderbook_requested_trigger(self, nick, mc):
         """Update nicks_seen state to reflect presence of
@@ -581,6 +747,13 @@ class MessageChannelCollection(object):
             log.warn("Channel on which privmsg was received is now inactive; "
                      "continuing to process this message")
         mc = matched_channels[0]
+        self.record_response(nick, mc)
+        if self.is_duplicate(nick, message):
+            #a hedged privmsg, already received on another channel
+            log.debug("Dropping copy of privmsg from " + nick + " on " +
+                      str(hostid))
+            self.on_privmsg(nick, mc)
+            return
         mc.on_verified_privmsg(nick, message)
 
     def on_privmsg(self, nick, mchan):
@@ -616,6 +789,7 @@ class MessageChannel(object):
         # orderbook watch functions
         self.on_order_seen = None
         self.on_order_cancel = None
+        self.on_orders_seen = None
         # taker functions
         self.on_error = None
         self.on_pubkey = None
@@ -699,9 +873,11 @@ class MessageChannel(object):
     # orderbook watcher commands
     def register_orderbookwatch_callbacks(self,
                                           on_order_seen=None,
-                                          on_order_cancel=None):
+                                          on_order_cancel=None,
+                                          on_orders_seen=None):
         self.on_order_seen = on_order_seen
         self.on_order_cancel = on_order_cancel
+        self.on_orders_seen = on_orders_seen
 
     # taker commands
     def register_taker_callbacks(self,
@@ -756,6 +932,28 @@ class MessageChannel(object):
                 return True
         return False
 
+    def check_for_offer_list(self, nick, commands):
+        """If a message consists only of offers, as multi-offer
+        announcements do, pass them all to on_orders_seen in one call
+        and return True; otherwise return False, and the commands are
+        to be processed one by one.
+        """
+        if not self.on_orders_seen:
+            return False
+        offers = []
+        for command in commands:
+            _chunks = command.split(" ")
+            if _chunks[0] not in offername_list:
+                return False
+            if len(_chunks) < 6:
+                log.debug('index error parsing chunks, possibly malformed'
+                          'offer by other party. No user action required.')
+                continue
+            offers.append((_chunks[1], _chunks[0]) + tuple(_chunks[2:6]))
+        if offers:
+            self.on_orders_seen(self, nick, offers)
+        return True
+
     def check_for_commitments(self, nick, _chunks, private=False):
         """If a commitment message is found in a pubmsg, trigger
         callback on_commitment_seen, if as a privmsg, trigger
@@ -829,6 +1027,8 @@ class MessageChannel(object):
         #DOS vector: repeated !orderbook requests, see #298.
         if commands.count('orderbook') > 1:
             return
+        if self.check_for_offer_list(nick, commands):
+            return
         for command in commands:
             _chunks = command.split(" ")
             if self.check_for_orders(nick, _chunks):
@@ -888,6 +1088,8 @@ class MessageChannel(object):
             self.on_privmsg_trigger(nick, self)
         #strip sig from message for processing, having verified
         message = " ".join(message[1:].split(" ")[:-2])
+        if self.check_for_offer_list(nick, message.split(COMMAND_PREFIX)):
+            return
         for command in message.split(COMMAND_PREFIX):
             _chunks = command.split(" ")
 
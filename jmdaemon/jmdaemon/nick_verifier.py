@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+from __future__ import print_function
+"""Verification of nick signatures on inbound privmsgs within the
+daemon, as an alternative to a round trip to the client for each
+message (see JMDaemonServerProtocol.request_signature_verify).
+Requires the jmbitcoin package, which the daemon does not otherwise
+depend on; see nick_verification_available.
+"""
+import base64
+import binascii
+import hashlib
+from collections import OrderedDict
+
+from jmbase.support import get_log
+
+try:
+    import secp256k1
+    import jmbitcoin as btc
+except ImportError: #pragma: no cover
+    btc = None
+
+log = get_log()
+
+
+def nick_verification_available():
+    return btc is not None
+
+
+class NickSignatureVerifier(object):
+    """Checks that a privmsg is signed by pubkey, and that pubkey
+    is bound to the sender's nick, as in
+    JMClientProtocol.verify_nick_message.
+    Keeps a bounded LRU of recently verified (pubkey, message hash, sig)
+    tuples, so that retransmitted and duplicate messages are not verified
+    again, and an LRU of parsed pubkeys, so that the messages of one
+    counterparty only parse its key once.
+    """
+
+    def __init__(self, max_verified=10000, max_pubkeys=2000):
+        if not nick_verification_available():
+            raise ImportError("Nick signature verification in the "
+                              "daemon requires jmbitcoin")
+        self.max_verified = max_verified
+        self.max_pubkeys = max_pubkeys
+        self.verified = OrderedDict()
+        #(pubkey, hashlen) : (secp256k1 pubkey or None, encoded nick hash)
+        self.pubkeys = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _lru_get(cache, key):
+        value = cache.pop(key, None)
+        if value is not None:
+            cache[key] = value
+        return value
+
+    @staticmethod
+    def _lru_put(cache, key, value, maxsize):
+        cache[key] = value
+        while len(cache) > maxsize:
+            cache.popitem(last=False)
+
+    def get_pubkey(self, pubkey, hashlen):
+        """Returns (parsed pubkey, or None if invalid, base58 nick hash).
+        """
+        key = (pubkey, hashlen)
+        entry = self._lru_get(self.pubkeys, key)
+        if entry is None:
+            try:
+                parsed = secp256k1.PublicKey(pubkey=binascii.unhexlify(pubkey),
+                                             raw=True, ctx=btc.ctx)
+            except Exception:
+                parsed = None
+            #as for the client, the nick commits to the hex pubkey string
+            nick_pkh_raw = hashlib.sha256(pubkey).digest()[:hashlen]
+            entry = (parsed, btc.changebase(nick_pkh_raw, 256, 58))
+            self._lru_put(self.pubkeys, key, entry, self.max_pubkeys)
+        return entry
+
+    def verify_sig(self, msg, sig, parsed_pubkey):
+        try:
+            sigobj = parsed_pubkey.ecdsa_deserialize(base64.b64decode(sig))
+            return parsed_pubkey.ecdsa_verify(btc.message_sig_hash(str(msg)),
+                                              sigobj, raw=True)
+        except Exception:
+            return False
+
+    def verify(self, msg, sig, pubkey, nick, hashlen, max_encoded):
+        """Returns True if sig is a valid signature of msg by pubkey,
+        and pubkey hashes to nick.
+        """
+        parsed, nick_hash = self.get_pubkey(pubkey, hashlen)
+        nick_stripped = nick[2:2 + max_encoded]
+        #strip right padding
+        nick_unpadded = ''.join([x for x in nick_stripped if x != 'O'])
+        if nick_unpadded != nick_hash:
+            log.debug("Nick hash check failed, expected: " + str(nick_unpadded)
+                      + ", got: " + str(nick_hash))
+            return False
+        if parsed is None:
+            log.debug("Invalid nick pubkey, ignoring.")
+            return False
+        key = (pubkey, hashlib.sha256(msg).digest(), sig)
+        if self._lru_get(self.verified, key):
+            self.hits += 1
+            return True
+        self.misses += 1
+        if not self.verify_sig(msg, sig, parsed):
+            log.debug("nick signature verification failed, ignoring.")
+            return False
+        self._lru_put(self.verified, key, True, self.max_verified)
+        return True
@@ -9,9 +9,11 @@ import sys
 import time
 import threading
 import json
+import itertools
+from collections import deque
 from decimal import InvalidOperation, Decimal
 
-from jmdaemon.protocol import JM_VERSION
+from jmdaemon.protocol import JM_VERSION, ORDER_KEYS
 from jmbase.support import get_log, joinmarket_alert, DUST_THRESHOLD
 log = get_log()
 
@@ -20,23 +22,178 @@ class JMTakerError(Exception):
     pass
 
 
+class Offer(object):
+    """A single validated offer in the orderbook. Offers are
+    not modified once created; a new offer replaces an old one.
+    """
+    __slots__ = ORDER_KEYS
+
+    def __init__(self, counterparty, oid, ordertype, minsize, maxsize,
+                 txfee, cjfee):
+        self.counterparty = counterparty
+        self.oid = oid
+        self.ordertype = ordertype
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.txfee = txfee
+        self.cjfee = cjfee
+
+    def __eq__(self, other):
+        return isinstance(other, Offer) and all(
+            getattr(self, k) == getattr(other, k) for k in ORDER_KEYS)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def to_tuple(self):
+        return tuple(getattr(self, k) for k in ORDER_KEYS)
+
+    def to_dict(self):
+        return dict((k, getattr(self, k)) for k in ORDER_KEYS)
+
+
+class Orderbook(object):
+    """Offers indexed by counterparty and then by oid.
+    Not thread safe; OrderbookWatch serializes access.
+    """
+
+    def __init__(self):
+        self.offers = {}
+
+    def __len__(self):
+        return sum(len(x) for x in self.offers.itervalues())
+
+    def __iter__(self):
+        for offers in self.offers.itervalues():
+            for offer in offers.itervalues():
+                yield offer
+
+    def get(self, counterparty, oid):
+        return self.offers.get(counterparty, {}).get(oid)
+
+    def counterparties(self):
+        return self.offers.keys()
+
+    def add(self, offer):
+        self.offers.setdefault(offer.counterparty, {})[offer.oid] = offer
+
+    def remove(self, counterparty, oid):
+        """Returns the removed offer, or None if there was none.
+        """
+        offers = self.offers.get(counterparty)
+        if offers is None:
+            return None
+        offer = offers.pop(oid, None)
+        if not offers:
+            del self.offers[counterparty]
+        return offer
+
+    def remove_counterparty(self, counterparty):
+        """Returns the oids of the removed offers.
+        """
+        return self.offers.pop(counterparty, {}).keys()
+
+    def clear(self):
+        self.offers = {}
+
+
+#Orderbook versions are drawn from one counter for the whole process, so
+#a version number from one orderbook (or from before a reset) is never
+#mistaken for a point in another's change log.
+_orderbook_versions = itertools.count(1)
+
+
 class OrderbookWatch(object):
+    #Number of orderbook changes retained for incremental delivery,
+    #see get_orderbook_update.
+    max_orderbook_changes = 20000
 
     def set_msgchan(self, msgchan):
         self.msgchan = msgchan
         self.msgchan.register_orderbookwatch_callbacks(self.on_order_seen,
-                                                       self.on_order_cancel)
+                                                       self.on_order_cancel,
+                                                       self.on_orders_seen)
         self.msgchan.register_channel_callbacks(
             self.on_welcome, self.on_set_topic, None, self.on_disconnect,
             self.on_nick_leave, None)
 
-        self.dblock = threading.Lock()
-        con = sqlite3.connect(":memory:", check_same_thread=False)
-        con.row_factory = sqlite3.Row
-        self.db = con.cursor()
-        self.db.execute("CREATE TABLE orderbook(counterparty TEXT, "
-                        "oid INTEGER, ordertype TEXT, minsize INTEGER, "
-                        "maxsize INTEGER, txfee INTEGER, cjfee TEXT);")
+        self.oblock = threading.Lock()
+        self.orderbook = Orderbook()
+        #sqlite copy of the orderbook, only created if the db attribute
+        #is used (by ob-watcher), see get_sql_view.
+        self.sql_view = None
+        self.sql_view_version = None
+        self.reset_orderbook_changes()
+
+    @property
+    def db(self):
+        return self.get_sql_view()
+
+    def get_sql_view(self):
+        """Returns a sqlite cursor for a copy of the orderbook, as
+        table orderbook(counterparty, oid, ordertype, minsize, maxsize,
+        txfee, cjfee), brought up to date with the orderbook on each call.
+        """
+        with self.oblock:
+            if self.sql_view is None:
+                con = sqlite3.connect(":memory:", check_same_thread=False)
+                con.row_factory = sqlite3.Row
+                self.sql_view = con.cursor()
+                self.sql_view.execute(
+                    "CREATE TABLE orderbook(counterparty TEXT, "
+                    "oid INTEGER, ordertype TEXT, minsize INTEGER, "
+                    "maxsize INTEGER, txfee INTEGER, cjfee TEXT);")
+            if self.sql_view_version != self.ob_version:
+                self.sql_view.execute('DELETE FROM orderbook;')
+                self.sql_view.executemany(
+                    'INSERT INTO orderbook VALUES(?, ?, ?, ?, ?, ?, ?);',
+                    (o.to_tuple() for o in self.orderbook))
+                self.sql_view_version = self.ob_version
+            return self.sql_view
+
+    def reset_orderbook_changes(self):
+        """Start a new version history; replicas of the orderbook held
+        by clients at any earlier version will be sent a full snapshot.
+        """
+        #the changes log holds (version, (counterparty, oid), offer) with
+        #offer None for a removal; it is complete for every version after
+        #ob_changes_from.
+        self.ob_version = next(_orderbook_versions)
+        self.ob_changes_from = self.ob_version
+        self.ob_changes = deque()
+
+    def _record_change(self, counterparty, oid, offer=None):
+        """Must be called with oblock held.
+        """
+        self.ob_version = next(_orderbook_versions)
+        self.ob_changes.append((self.ob_version, (counterparty, oid), offer))
+        while len(self.ob_changes) > self.max_orderbook_changes:
+            self.ob_changes_from = self.ob_changes.popleft()[0]
+
+    def get_orderbook_update(self, since=None):
+        """Returns (version, full, data) for the current orderbook.
+        If since is the version of a replica of this orderbook, and all
+        changes after it are still held, full is False and data is
+        {'add': [orders], 'cancel': [[counterparty, oid], ..]}, the net
+        changes since that version, where 'add' replaces any order with
+        the same counterparty and oid. Otherwise full is True and data
+        is the list of all orders.
+        Orders are dicts with keys ORDER_KEYS.
+        """
+        with self.oblock:
+            if since is not None and \
+                    self.ob_changes_from <= since <= self.ob_version:
+                latest = {}
+                for version, key, offer in reversed(self.ob_changes):
+                    if version <= since:
+                        break
+                    latest.setdefault(key, offer)
+                return (self.ob_version, False,
+                        {'add': [o.to_dict() for o in latest.values() if o],
+                         'cancel': [list(k) for k, o in latest.items()
+                                    if o is None]})
+            return (self.ob_version, True,
+                    [o.to_dict() for o in self.orderbook])
 
     @staticmethod
     def on_set_topic(newtopic):
@@ -57,20 +214,22 @@ class OrderbookWatch(object):
                 print('=' * 60)
                 joinmarket_alert[0] = alert
 
-    def on_order_seen(self, counterparty, oid, ordertype, minsize, maxsize,
-                      txfee, cjfee):
+    def _add_offer(self, counterparty, oid, ordertype, minsize, maxsize,
+                   txfee, cjfee):
+        """Validate and store an offer, replacing any with the same
+        counterparty and oid. Must be called with oblock held.
+        """
+        old = offer = None
         try:
-            self.dblock.acquire(True)
             if int(oid) < 0 or int(oid) > sys.maxint:
                 log.debug("Got invalid order ID: " + oid + " from " +
                           counterparty)
                 return
+            oid = int(oid)
             # delete orders eagerly, so in case a buggy maker sends an
             # invalid offer, we won't accidentally !fill based on the ghost
             # of its previous message.
-            self.db.execute(
-                ("DELETE FROM orderbook WHERE counterparty=? "
-                 "AND oid=?;"), (counterparty, oid))
+            old = self.orderbook.remove(counterparty, oid)
             # now validate the remaining fields
             if int(minsize) < 0 or int(minsize) > 21 * 10**14:
                 log.debug("Got invalid minsize: {} from {}".format(
@@ -102,29 +261,48 @@ class OrderbookWatch(object):
                     log.debug("Got non integer coinjoin fee: " + str(cjfee) +
                               " for an absoffer from " + counterparty)
                     return
-            self.db.execute(
-                'INSERT INTO orderbook VALUES(?, ?, ?, ?, ?, ?, ?);',
-                (counterparty, oid, ordertype, minsize, maxsize, txfee,
-                 str(Decimal(cjfee))))  # any parseable Decimal is a valid cjfee
+            offer = Offer(counterparty, oid, ordertype, int(minsize),
+                          int(maxsize), int(txfee),
+                          str(Decimal(cjfee)))  # any parseable Decimal is a valid cjfee
+            self.orderbook.add(offer)
         except InvalidOperation:
             log.debug("Got invalid cjfee: " + cjfee + " from " + counterparty)
         except Exception as e:
-            log.debug("Error parsing order " + oid + " from " + counterparty)
+            log.debug("Error parsing order " + str(oid) + " from " +
+                      counterparty)
             log.debug("Exception was: " + repr(e))
         finally:
-            self.dblock.release()
+            #re-announcements of unchanged offers, the bulk of the
+            #replies to !orderbook, are not changes.
+            if old != offer:
+                self._record_change(counterparty, oid, offer)
+
+    def on_order_seen(self, counterparty, oid, ordertype, minsize, maxsize,
+                      txfee, cjfee):
+        with self.oblock:
+            self._add_offer(counterparty, oid, ordertype, minsize, maxsize,
+                            txfee, cjfee)
+
+    def on_orders_seen(self, counterparty, offers):
+        """As on_order_seen, for a list of offers from one counterparty
+        (as announced in a single message), each of the form
+        (oid, ordertype, minsize, maxsize, txfee, cjfee).
+        """
+        with self.oblock:
+            for o in offers:
+                self._add_offer(counterparty, *o)
 
     def on_order_cancel(self, counterparty, oid):
-        with self.dblock:
-            self.db.execute(
-                ("DELETE FROM orderbook WHERE "
-                 "counterparty=? AND oid=?;"), (counterparty, oid))
+        with self.oblock:
+            if self.orderbook.remove(counterparty, int(oid)):
+                self._record_change(counterparty, int(oid))
 
     def on_nick_leave(self, nick):
-        with self.dblock:
-            self.db.execute('DELETE FROM orderbook WHERE counterparty=?;',
-                            (nick,))
+        with self.oblock:
+            for oid in self.orderbook.remove_counterparty(nick):
+                self._record_change(nick, oid)
 
     def on_disconnect(self):
-        with self.dblock:
-            self.db.execute('DELETE FROM orderbook;')
+        with self.oblock:
+            self.orderbook.clear()
+            self.reset_orderbook_changes()
@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+from __future__ import print_function
+'''Benchmark of rendering and packing a maker's offers into IRC
+lines, as done for every announcement and !orderbook response.
+Not collected by pytest; run directly:
+
+    python bench_announce.py [number of announcements]
+'''
+import sys
+import time
+from jmdaemon.message_channel import MessageChannelCollection
+from jmdaemon.irc import pack_orderlines, MAX_PRIVMSG_LEN
+
+header = 'PRIVMSG #joinmarket-pit :'
+
+
+def make_offers(n):
+    return [{'ordertype': 'swreloffer', 'oid': i, 'minsize': 27300,
+             'maxsize': 1000000000 + i, 'txfee': 0, 'cjfee': '0.00025'}
+            for i in range(n)]
+
+
+def pack_orderlines_quadratic(header, offerlist):
+    """The packing previously done in txIRC_Client._announce_orders.
+    """
+    lines = []
+    offerlines = []
+    for i, offer in enumerate(offerlist):
+        offerlines.append(offer)
+        line = header + ''.join(offerlines) + ' ~'
+        if len(line) > MAX_PRIVMSG_LEN or i == len(offerlist) - 1:
+            if i < len(offerlist) - 1:
+                line = header + ''.join(offerlines[:-1]) + ' ~'
+            lines.append(line)
+            offerlines = [offerlines[-1]]
+    return lines
+
+
+def announce_uncached(mcc, offers):
+    orderlines, privmsg = mcc.get_announcement(offers)
+    return pack_orderlines(header, orderlines)
+
+
+def announce_quadratic(mcc, offers):
+    orderlines = mcc.render_orderlines(offers)
+    return pack_orderlines_quadratic(header, orderlines)
+
+
+class PackedCache(object):
+    """As txIRC_Client._announce_orders.
+    """
+    packed_offerlist = None
+    #as the daemon's get_offerlines
+    offerlines = None
+
+    def announce(self, mcc, offers):
+        if self.offerlines is None:
+            self.offerlines = mcc.render_orderlines(offers)
+        orderlines, privmsg = mcc.get_announcement(offers, self.offerlines)
+        if orderlines is not self.packed_offerlist:
+            self.packed_lines = pack_orderlines(header, orderlines)
+            self.packed_offerlist = orderlines
+        return self.packed_lines
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for n in [20, 50, 200]:
+        offers = make_offers(n)
+        mcc = MessageChannelCollection([])
+        for label, announce in [("previous", announce_quadratic),
+                                ("linear", announce_uncached),
+                                ("cached", PackedCache().announce)]:
+            st = time.time()
+            for _ in range(runs):
+                lines = announce(mcc, offers)
+            elapsed = time.time() - st
+            print("{} offers, {}: {} lines, {:.1f} announcements/s".format(
+                n, label, len(lines), runs / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+from __future__ import print_function
+'''Tests of the maker's commitment blacklist.'''
+
+import os
+
+from twisted.internet import task
+
+from jmdaemon.commitment_blacklist import CommitmentBlacklist
+
+
+def commitment(i):
+    return "%064x" % i
+
+
+def get_blacklist(tmpdir, max_entries=None):
+    clock = task.Clock()
+    bl = CommitmentBlacklist(str(tmpdir.join("commitmentlist")),
+                             max_entries=max_entries)
+    bl.clock = clock
+    return bl, clock
+
+
+def test_load_and_add(tmpdir):
+    #as written by older versions: duplicates, no final newline
+    f = tmpdir.join("commitmentlist")
+    f.write("\n".join([commitment(i) for i in [1, 2, 1, 1, 1, 1, 1, 3]]))
+    bl, clock = get_blacklist(tmpdir)
+    assert len(bl) == 3
+    assert commitment(1) in bl and commitment(4) not in bl
+    #the duplicates were compacted away
+    assert sorted(f.read().split()) == [commitment(i) for i in [1, 2, 3]]
+    assert f.read().endswith("\n")
+    assert not bl.add(commitment(2))
+    assert bl.add(commitment(4))
+    assert commitment(4) in bl
+    assert f.read().split()[-1] == commitment(4)
+    #fsync'ed once, later, for all adds in the meantime
+    assert bl.sync_call.active()
+    call = bl.sync_call
+    bl.add(commitment(5))
+    assert bl.sync_call is call
+    clock.advance(bl.sync_delay)
+    assert bl.sync_call is None
+    bl.close()
+    assert len(CommitmentBlacklist(str(f)).commitments) == 5
+
+
+def test_legacy_append(tmpdir):
+    f = tmpdir.join("commitmentlist")
+    f.write(commitment(1) + "\n" + commitment(2))
+    bl, clock = get_blacklist(tmpdir)
+    bl.add(commitment(3))
+    bl.close()
+    assert f.read().split("\n") == [commitment(i) for i in [1, 2, 3]] + [""]
+
+
+def test_other_writers(tmpdir):
+    f = tmpdir.join("commitmentlist")
+    bl, clock = get_blacklist(tmpdir)
+    assert commitment(1) not in bl
+    bl.add(commitment(1))
+    #appended by another process
+    with open(str(f), "ab") as other:
+        other.write(commitment(2) + "\n")
+    assert commitment(2) in bl
+    bl.add(commitment(3))
+    #rewritten by another process (such as an older version)
+    bl.close()
+    f.write(commitment(4))
+    assert commitment(4) in bl
+    assert commitment(1) not in bl
+    assert len(bl) == 1
+
+
+def test_partial_append(tmpdir):
+    f = tmpdir.join("commitmentlist")
+    f.write(commitment(1) + "\n")
+    bl, clock = get_blacklist(tmpdir)
+    #another process is halfway through appending
+    with open(str(f), "ab") as other:
+        other.write(commitment(2)[:30])
+        other.flush()
+        assert commitment(2) not in bl
+        assert commitment(2)[:30] not in bl
+        other.write(commitment(2)[30:] + "\n")
+    assert commitment(2) in bl
+    assert len(bl) == 2 and bl.lines == 2
+    bl.add(commitment(3))
+    bl.close()
+    assert f.read().split("\n") == [commitment(i) for i in [1, 2, 3]] + [""]
+
+
+def test_max_entries(tmpdir):
+    f = tmpdir.join("commitmentlist")
+    f.write("".join(commitment(i) + "\n" for i in range(10)))
+    bl, clock = get_blacklist(tmpdir, max_entries=4)
+    #trimmed to the most recent on loading
+    assert [commitment(i) in bl for i in [5, 6, 9]] == [False, True, True]
+    assert f.read().split() == [commitment(i) for i in range(6, 10)]
+    for i in range(10, 14):
+        bl.add(commitment(i))
+    assert len(bl) == 8
+    bl.add(commitment(14))
+    assert len(bl) == 4
+    assert f.read().split() == [commitment(i) for i in range(11, 15)]
+    assert not os.path.exists(str(f) + ".tmp")
+    assert commitment(9) not in bl
@@ -100,7 +100,6 @@ class JMTestClientProtocol(JMBaseProtocol):
         return {'accepted': True}
     
     def maketx(self, ioauth_data):
-        ioauth_data = json.loads(ioauth_data)
         nl = ioauth_data.keys()
         d = self.callRemote(JMMakeTx,
                             nick_list= json.dumps(nl),
@@ -108,7 +107,7 @@ class JMTestClientProtocol(JMBaseProtocol):
         self.defaultCallbacks(d)
 
     @JMOffers.responder
-    def on_JM_OFFERS(self, orderbook):
+    def on_JM_OFFERS(self, orderbook, version=None, full=None):
         if end_early:
             return {'accepted': True}
         jlog.debug("JMOFFERS" + str(orderbook))
@@ -169,6 +168,30 @@ class JMTestClientProtocol(JMBaseProtocol):
         self.defaultCallbacks(d)
         return {'accepted': True}
 
+    @JMRequestMsgSigBatch.responder
+    def on_JM_REQUEST_MSGSIG_BATCH(self, requests):
+        show_receipt("JMREQUESTMSGSIGBATCH", requests)
+        d = self.callRemote(JMMsgSignatureBatch,
+                            signatures=[{'nick': r['nick'],
+                                         'cmd': r['cmd'],
+                                         'msg_to_return': "xxxcreatedsigxx",
+                                         'hostid': r['hostid']}
+                                        for r in requests])
+        self.defaultCallbacks(d)
+        return {'accepted': True}
+
+    @JMRequestMsgSigVerifyBatch.responder
+    def on_JM_REQUEST_MSGSIG_VERIFY_BATCH(self, requests):
+        show_receipt("JMREQUESTMSGSIGVERIFYBATCH", requests)
+        d = self.callRemote(JMMsgSignatureVerifyBatch,
+                            results=[{'verif_result': True,
+                                      'nick': r['nick'],
+                                      'fullmsg': r['fullmsg'],
+                                      'hostid': r['hostid']}
+                                     for r in requests])
+        self.defaultCallbacks(d)
+        return {'accepted': True}
+
 class JMTestClientProtocolFactory(protocol.ClientFactory):
     protocol = JMTestClientProtocol
         
@@ -202,17 +225,21 @@ class JMDaemonTestServerProtocol(JMDaemonServerProtocol):
         self.on_error("dummy error")
 
     @JMRequestOffers.responder
-    def on_JM_REQUEST_OFFERS(self):
+    def on_JM_REQUEST_OFFERS(self, since=None):
         for o in t_orderbook:
             #counterparty, oid, ordertype, minsize, maxsize,txfee, cjfee):
             self.on_order_seen(o["counterparty"], o["oid"], o["ordertype"],
                                  o["minsize"], o["maxsize"],
                                  o["txfee"], o["cjfee"])
-        return super(JMDaemonTestServerProtocol, self).on_JM_REQUEST_OFFERS()
+        return super(JMDaemonTestServerProtocol, self).on_JM_REQUEST_OFFERS(
+            since)
         
     @JMInit.responder
     def on_JM_INIT(self, bcsource, network, irc_configs, minmakers,
-                   maker_timeout_sec):
+                   maker_timeout_sec, verify_nick_sigs=None,
+                   hedge_privmsgs=None, maker_timeout_min_sec=None,
+                   accept_commitment_broadcasts=None, max_privmsg_size=None,
+                   max_partial_privmsgs=None, partial_privmsg_timeout=None):
         self.maker_timeout_sec = int(maker_timeout_sec)
         self.minmakers = int(minmakers)
         mcs = [DummyMC(None)]
@@ -321,3 +348,192 @@ class TestJMDaemonProtoInit(unittest.TestCase):
     def _called_by_deffered(self):
         global end_early
         end_early = False
+
+
+class AnnounceRecorder(object):
+    def __init__(self):
+        self.announced = []
+
+    def announce_orders(self, orderlist, nick=None, new_mc=None,
+                        orderlines=None):
+        self.announced.append((nick, new_mc, orderlines))
+
+
+def test_orderbook_request_coalescing():
+    daemon = JMDaemonServerProtocol(None)
+    daemon.role = "MAKER"
+    daemon.mcc = AnnounceRecorder()
+    daemon.set_offerlist(t_orderbook[:2])
+    offerlines = daemon.get_offerlines()
+    assert offerlines == MessageChannelCollection.render_orderlines(
+        t_orderbook[:2])
+    assert daemon.get_offerlines() is offerlines
+    #requests are answered after the window; repeats are answered once
+    for nick in ["J5a", "J5b", "J5a"]:
+        daemon.on_orderbook_requested(nick, "mc1")
+    for nick in ["J5c", "J5d", "J5e", "J5c"]:
+        daemon.on_orderbook_requested(nick, "mc2")
+    assert daemon.mcc.announced == []
+    daemon.flush_orderbook_requests()
+    assert daemon.orderbook_flush is None
+    assert daemon.mcc.announced == [("J5a", "mc1", offerlines),
+                                    ("J5b", "mc1", offerlines),
+                                    (None, "mc2", offerlines)]
+    #a changed offerlist is rendered again
+    daemon.set_offerlist(t_orderbook[2:4])
+    daemon.on_orderbook_requested("J5a", "mc1")
+    daemon.flush_orderbook_requests()
+    assert daemon.mcc.announced[-1] == (
+        "J5a", "mc1",
+        MessageChannelCollection.render_orderlines(t_orderbook[2:4]))
+    #nothing is sent without offers, or by a taker
+    daemon.set_offerlist([])
+    daemon.on_orderbook_requested("J5a", "mc1")
+    daemon.flush_orderbook_requests()
+    daemon.role = "TAKER"
+    daemon.on_orderbook_requested("J5a", "mc1")
+    assert daemon.orderbook_flush is None
+    assert len(daemon.mcc.announced) == 4
+
+
+class PrivmsgRecorder(object):
+    def __init__(self):
+        self.sent = []
+
+    def prepare_privmsg(self, nick, cmd, message):
+        self.sent.append((nick, cmd))
+
+
+def get_stage1_daemon(maker_timeout_min_sec=None):
+    from twisted.internet import defer
+    from jmdaemon import init_keypair
+    daemon = JMDaemonServerProtocol(None)
+    daemon.clock = task.Clock()
+    daemon.mcc = PrivmsgRecorder()
+    daemon.kp = init_keypair()
+    daemon.maker_timeout_sec = 60
+    daemon.maker_timeout_min_sec = maker_timeout_min_sec
+    daemon.minmakers = 2
+    daemon.fill_responses = []
+    def callRemote(command, **kwargs):
+        daemon.fill_responses.append((kwargs['success'],
+                                      kwargs['ioauth_data']))
+        return defer.succeed({'accepted': True})
+    daemon.callRemote = callRemote
+    return daemon
+
+
+def fill(daemon, nicks):
+    daemon.jm_state = 1
+    offers = dict((n, {"oid": 0}) for n in nicks)
+    assert daemon.on_JM_FILL(1000000, "commit", "rev",
+                             json.dumps(offers))['accepted']
+    for n in nicks:
+        daemon.crypto_boxes[n] = ["maker_pk", None]
+
+
+def ioauth(daemon, nick):
+    daemon.on_ioauth(nick, ["utxo"], "auth_pub", "cj_addr", "change_addr",
+                     "btc_sig")
+
+
+def test_stage1_completion():
+    daemon = get_stage1_daemon()
+    nicks = ["J5a", "J5b", "J5c"]
+    fill(daemon, nicks)
+    assert sorted(daemon.mcc.sent) == [(n, "fill") for n in nicks]
+    #stage 1 ends as soon as every maker has responded
+    for i, n in enumerate(nicks):
+        daemon.clock.advance(1)
+        ioauth(daemon, n)
+        assert len(daemon.fill_responses) == (1 if i == 2 else 0)
+    assert daemon.fill_responses[0][0]
+    assert sorted(daemon.fill_responses[0][1]) == nicks
+    assert daemon.jm_state == 4
+    #and its timeout is cancelled, so cannot end a later stage 1 early
+    assert not daemon.clock.getDelayedCalls()
+    fill(daemon, nicks)
+    daemon.clock.advance(59)
+    ioauth(daemon, "J5a")
+    assert len(daemon.fill_responses) == 1
+    daemon.clock.advance(1)
+    success, nonresponders = daemon.fill_responses[-1]
+    assert not success and sorted(nonresponders) == ["J5b", "J5c"]
+    assert list(daemon.maker_response_times) == [1, 2, 3, 59]
+
+
+def test_adaptive_stage1_timeout():
+    daemon = get_stage1_daemon(maker_timeout_min_sec=5)
+    nicks = ["J5a", "J5b"]
+    #until there are enough response times, maker_timeout_sec is used
+    daemon.maker_response_times.extend([2] * (daemon.stage1_min_samples - 1))
+    assert daemon.get_stage1_timeout() == 60
+    daemon.maker_response_times.append(4)
+    #else a multiple of their 90th percentile, within the limits
+    assert daemon.get_stage1_timeout() == 5
+    daemon.maker_response_times.extend([10] * 10)
+    assert daemon.get_stage1_timeout() == 20
+    daemon.maker_response_times.extend([100] * 10)
+    assert daemon.get_stage1_timeout() == 60
+    daemon.maker_response_times.clear()
+    daemon.maker_response_times.extend([4] * 20)
+    #with enough makers by the adapted timeout, stage 1 ends then
+    fill(daemon, nicks + ["J5slow"])
+    daemon.clock.advance(2)
+    ioauth(daemon, "J5a")
+    ioauth(daemon, "J5b")
+    daemon.clock.advance(5.9)
+    assert not daemon.fill_responses
+    daemon.clock.advance(0.1)
+    assert daemon.fill_responses[0][0]
+    assert sorted(daemon.fill_responses[0][1]) == nicks
+    #the late maker's response time is still recorded
+    daemon.clock.advance(10)
+    ioauth(daemon, "J5slow")
+    assert daemon.maker_response_times[-1] == 18
+    assert len(daemon.fill_responses) == 1
+    #without enough makers, it waits on until maker_timeout_sec
+    daemon.maker_response_times.extend([4] * 20)
+    fill(daemon, nicks)
+    ioauth(daemon, "J5a")
+    daemon.clock.advance(8)
+    assert len(daemon.fill_responses) == 1
+    daemon.clock.advance(30)
+    ioauth(daemon, "J5b")
+    assert daemon.fill_responses[-1][0]
+    assert not daemon.clock.getDelayedCalls()
+    #or fails then
+    fill(daemon, nicks)
+    ioauth(daemon, "J5a")
+    daemon.clock.advance(60)
+    assert daemon.fill_responses[-1] == (False, ["J5b"])
+
+
+class CallbackMC(object):
+    def register_orderbookwatch_callbacks(self, *callbacks):
+        pass
+
+    def register_channel_callbacks(self, *callbacks):
+        pass
+
+
+def test_maker_keeps_no_orderbook():
+    daemon = JMDaemonServerProtocol(None)
+    OrderbookWatch.set_msgchan(daemon, CallbackMC())
+    offer = ["0", "swreloffer", "27300", "100000000", "0", "0.0002"]
+    daemon.on_order_seen("J5a", *offer)
+    assert len(daemon.orderbook) == 1
+    daemon.role = "MAKER"
+    daemon.on_disconnect()
+    daemon.on_order_seen("J5a", *offer)
+    daemon.on_orders_seen("J5b", [offer])
+    assert len(daemon.orderbook) == 0
+    #but the makers seen are, for forwarding commitments
+    assert sorted(daemon.get_offer_counterparties()) == ["J5a", "J5b"]
+    daemon.mcc = PrivmsgRecorder()
+    daemon.on_nick_leave("J5a")
+    daemon.transfer_commitment("ab" * 32)
+    assert daemon.mcc.sent == [("J5b", "hp2")]
+    daemon.on_disconnect()
+    daemon.transfer_commitment("ab" * 32)
+    assert len(daemon.mcc.sent) == 1
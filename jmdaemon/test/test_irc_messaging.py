@@ -36,7 +36,7 @@ def on_connect(x):
     print('simulated on-connect')
 def on_welcome(mc):
     print('simulated on-welcome')
-    mc.tx_irc_client.lineRate = 0.2
+    mc.tx_irc_client.scheduler.rate = 5.0
     if mc.nick == "irc_publisher":
         d = task.deferLater(reactor, 3.0, junk_pubmsgs, mc)
         d.addCallback(junk_longmsgs)
@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+from __future__ import absolute_import, print_function
+'''Tests of reassembly of chunked privmsgs received over IRC.'''
+
+from twisted.internet import task
+from twisted.test import proto_helpers
+
+from jmdaemon.irc import txIRC_Client
+
+
+class DummyWrapper(object):
+    channel = "#joinmarket-pit"
+    nick = "J5me"
+    password = None
+    serverport = ("localhost", 6667)
+    on_disconnect = None
+
+    def __init__(self, privmsg_limits={}):
+        self.received = []
+        self.privmsg_limits = privmsg_limits
+
+    def on_privmsg(self, nick, message):
+        self.received.append((nick, message))
+
+
+def get_client(**limits):
+    wrapper = DummyWrapper(limits)
+    client = txIRC_Client(wrapper)
+    client.clock = task.Clock()
+    client.makeConnection(proto_helpers.StringTransport())
+    return client, wrapper
+
+
+def send_chunks(client, nick, chunks):
+    for c in chunks:
+        client.handle_privmsg(nick + "!user@host", "J5me", c)
+
+
+def test_reassembly():
+    client, wrapper = get_client()
+    chunks = ["!tx " + "a" * 400 + " ;"] + ["b" * 400 + " ;"] * 100 + ["c ~"]
+    send_chunks(client, "J5taker", chunks[:-1])
+    #interleaved with a message from another nick
+    send_chunks(client, "J5other", ["!pubkey x ;", "y ~"])
+    send_chunks(client, "J5taker", chunks[-1:])
+    assert wrapper.received == [
+        ("J5other", "!pubkey xy"),
+        ("J5taker", "!tx " + "a" * 400 + "b" * 40000 + "c")]
+    assert not client.built_privmsg
+    #a continuation with no start, and a bad trailer, are dropped
+    send_chunks(client, "J5taker", ["bbb ;", "!tx a ;", "b x"])
+    send_chunks(client, "J5taker", ["!fill 1 ~"])
+    assert wrapper.received[-1] == ("J5taker", "!fill 1")
+    assert len(wrapper.received) == 3
+
+
+def test_reassembly_limits():
+    client, wrapper = get_client(max_privmsg_size=1000,
+                                 max_partial_privmsgs=3,
+                                 partial_privmsg_timeout=60)
+    #oversized messages are dropped
+    send_chunks(client, "J5big", ["!tx " + "a" * 400 + " ;"] +
+                ["b" * 400 + " ;"] * 2 + ["c ~"])
+    assert not wrapper.received
+    assert not client.built_privmsg
+    #the least recently active partial message is dropped first
+    for i in range(3):
+        send_chunks(client, "J5nick" + str(i), ["!orderbook ;"])
+    send_chunks(client, "J5nick0", ["x ;"])
+    send_chunks(client, "J5nick3", ["!orderbook ;"])
+    assert list(client.built_privmsg) == ["J5nick2", "J5nick0", "J5nick3"]
+    #stale partial messages are dropped
+    client.clock.advance(40)
+    send_chunks(client, "J5nick0", ["y ;"])
+    client.clock.advance(30)
+    assert list(client.built_privmsg) == ["J5nick0"]
+    send_chunks(client, "J5nick0", ["z ~"])
+    assert wrapper.received == [("J5nick0", "!orderbookxyz")]
+    client.connectionLost(None)
+    assert not client.privmsg_evictor.running
@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+from __future__ import absolute_import, print_function
+'''Tests of pacing and prioritisation of outbound IRC lines.'''
+
+from twisted.internet import task
+
+from jmdaemon.irc import (OutboundScheduler, get_command_priority,
+                          PRIORITY_CONTROL, PRIORITY_TX, PRIORITY_DEFAULT,
+                          PRIORITY_ORDERBOOK)
+
+
+def get_scheduler(rate=1.0, burst=2):
+    clock = task.Clock()
+    written = []
+    return OutboundScheduler(written.append, rate, burst, clock), clock, written
+
+
+def test_command_priority():
+    for cmd in ["ioauth", "sig", "tx", "pubkey", "fill", "auth"]:
+        assert get_command_priority(cmd) == PRIORITY_TX
+    for cmd in ["orderbook", "reloffer", "swabsoffer", "cancel", "hp2"]:
+        assert get_command_priority(cmd) == PRIORITY_ORDERBOOK
+    assert get_command_priority("unknown") == PRIORITY_DEFAULT
+
+
+def test_token_bucket():
+    s, clock, written = get_scheduler(rate=2.0, burst=3)
+    for i in range(10):
+        s.push(["line" + str(i)])
+    #the burst is sent at once, then rate lines per second
+    assert written == ["line0", "line1", "line2"]
+    assert s.queue_depths()["default"] == 7
+    clock.advance(0.5)
+    assert len(written) == 4
+    clock.advance(1.0)
+    assert len(written) == 6
+    #tokens do not accumulate beyond the burst
+    clock.advance(10)
+    assert len(written) == 9
+    clock.advance(0.5)
+    assert written == ["line" + str(i) for i in range(10)]
+    clock.advance(100)
+    for i in range(5):
+        s.push(["more" + str(i)])
+    assert len(written) == 13
+    stats = s.get_stats()["default"]
+    assert stats == {'queued': 2, 'max_queued': 7, 'sent': 13}
+
+
+def test_priorities():
+    s, clock, written = get_scheduler(rate=1.0, burst=1)
+    s.push(["first"], PRIORITY_ORDERBOOK)
+    for i in range(3):
+        s.push(["offers" + str(i)], PRIORITY_ORDERBOOK, "#joinmarket")
+    s.push(["hp2"], PRIORITY_ORDERBOOK, "#joinmarket")
+    s.push(["ioauth"], PRIORITY_TX, "J5taker")
+    s.push(["PONG"], PRIORITY_CONTROL)
+    s.push(["sig"], PRIORITY_TX, "J5taker")
+    clock.pump([1] * 10)
+    assert written == ["first", "PONG", "ioauth", "sig", "offers0", "offers1",
+                       "offers2", "hp2"]
+    assert s.queue_depths() == {"control": 0, "tx": 0, "default": 0,
+                                "orderbook": 0}
+
+
+def test_chunked_messages_not_interleaved():
+    s, clock, written = get_scheduler(rate=1.0, burst=1)
+    s.push(["!orderbook a ;", "b ;", "c ~"], PRIORITY_ORDERBOOK, "J5taker")
+    assert written == ["!orderbook a ;"]
+    #a higher priority message to the same nick must wait for the rest
+    #of the chunked message; lines of its class queued behind it wait too.
+    s.push(["!pubkey x ~"], PRIORITY_TX, "J5taker")
+    s.push(["!ioauth y ~"], PRIORITY_TX, "J5other")
+    clock.pump([1] * 10)
+    assert written == ["!orderbook a ;", "b ;", "c ~", "!pubkey x ~",
+                       "!ioauth y ~"]
+    assert not s.partial
+
+
+def test_stop():
+    s, clock, written = get_scheduler(rate=1.0, burst=1)
+    s.push(["a", "b", "c"], PRIORITY_TX, "J5taker")
+    s.stop()
+    clock.advance(10)
+    assert written == ["a"]
+    assert not any(s.queue_depths().values())
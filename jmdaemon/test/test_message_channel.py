@@ -5,6 +5,7 @@ from __future__ import absolute_import
 import pytest
 from jmdaemon import (JMDaemonServerProtocolFactory, MessageChannelCollection)
 from jmdaemon.message_channel import MChannelThread
+from jmdaemon.irc import pack_orderlines, MAX_PRIVMSG_LEN
 from jmdaemon.orderbookwatch import OrderbookWatch
 from jmdaemon.daemon_protocol import JMDaemonServerProtocol
 from jmdaemon.protocol import (COMMAND_PREFIX, ORDER_KEYS, NICK_HASH_LENGTH,
@@ -154,7 +155,12 @@ def test_setup_mc():
     #is the last it was seen on:
     dmcs[0].on_privmsg(cp1, "!reloffer 0 4000 5000 100 0.2 abc def")
     dmcs[1].on_privmsg(cp1, "!reloffer 0 4000 5000 100 0.2 abc def")
+    #multiple offers in one message are added together
+    dmcs[1].on_privmsg(cp1, "!reloffer 1 4000 5000 100 0.2!absoffer 2 4000 "
+                       "5000 100 300 abc def")
     time.sleep(0.5)
+    assert sorted((o.oid, o.ordertype) for o in ob.orderbook) == [
+        (0, "reloffer"), (1, "reloffer"), (2, "absoffer")]
     #send back a response
     mcc.privmsg(cp1, "fill", "0")
     #trigger failure to find nick in privmsg
@@ -331,6 +337,111 @@ def test_setup_mc():
     mcc.on_nick_leave_trigger(cps[1], dmcs[2])
     mcc.shutdown()
 
+def test_announcement_cache():
+    mcc = MessageChannelCollection([DummyMessageChannel(None)])
+    orderlines, (cmd, msg) = mcc.get_announcement(t_orderbook[:3])
+    assert orderlines == [
+        "!" + o['ordertype'] + " " + " ".join(str(o[k]) for k in [
+            'oid', 'minsize', 'maxsize', 'txfee', 'cjfee'])
+        for o in t_orderbook[:3]]
+    assert cmd == t_orderbook[0]['ordertype']
+    assert "!" + cmd + " " + msg == "".join(orderlines)
+    #only the privmsgs of pre-rendered orderlines are cached
+    assert mcc.get_announcement(t_orderbook[:3])[0] is not orderlines
+    cached = mcc.get_announcement(t_orderbook[:3], orderlines)
+    assert cached[0] is orderlines
+    assert mcc.get_announcement(t_orderbook[:3], orderlines)[1] is cached[1]
+    other = MessageChannelCollection.render_orderlines(t_orderbook[3:5])
+    assert mcc.get_announcement(t_orderbook[3:5], other)[1][0] == \
+        t_orderbook[3]['ordertype']
+
+class RecordingMC(DummyMessageChannel):
+    def __init__(self, hostid):
+        DummyMessageChannel.__init__(self, None, hostid=hostid)
+        self.verified = []
+
+    def on_verified_privmsg(self, nick, message):
+        self.verified.append((nick, message))
+
+
+class SignRecorder(object):
+    def __init__(self):
+        self.requests = []
+
+    def request_signed_message(self, nick, cmd, msg, msg_to_be_signed, hostid):
+        self.requests.append((nick, cmd, msg_to_be_signed, hostid))
+
+    def get_crypto_box_from_nick(self, nick):
+        return None
+
+
+def test_hedged_privmsgs():
+    from twisted.internet import task
+    mcs = [RecordingMC("host" + str(i)) for i in range(3)]
+    mcc = MessageChannelCollection(mcs)
+    mcc.clock = task.Clock()
+    daemon = SignRecorder()
+    mcc.set_daemon(daemon)
+    for mc in mcs:
+        mcc.on_connect_trigger(mc)
+    cp = make_valid_nick(1)
+    mcc.see_nick(cp, mcs[0])
+    mcc.see_nick(cp, mcs[2])
+    mcc.active_channels[cp] = mcs[0]
+    #without hedging, privmsgs use the active channel
+    mcc.prepare_privmsg(cp, "fill", "0 100000 abc P123")
+    assert [r[3] for r in daemon.requests] == ["host0"]
+    mcc.hedge_privmsgs = True
+    daemon.requests = []
+    #one signature, on that channel's hostid, for each channel cp is seen on
+    mcc.prepare_privmsg(cp, "fill", "0 100000 abc P123")
+    assert [r[3] for r in daemon.requests] == ["host0", "host2"]
+    assert [r[2] for r in daemon.requests] == [
+        "0 100000 abc P123host0", "0 100000 abc P123host2"]
+    #other commands are not hedged
+    daemon.requests = []
+    mcc.prepare_privmsg(cp, "error", "sorry")
+    assert [r[3] for r in daemon.requests] == ["host0"]
+    #the first copy of the response is processed, the rest dropped
+    mcc.clock.advance(2)
+    mcc.on_verified_privmsg(cp, "!pubkey abcd pub1 sig2", "host2")
+    mcc.clock.advance(3)
+    mcc.on_verified_privmsg(cp, "!pubkey abcd pub1 sig0", "host0")
+    assert mcs[2].verified == [(cp, "!pubkey abcd pub1 sig2")]
+    assert mcs[0].verified == []
+    #and the faster channel is preferred
+    stats = mcc.get_latency_stats()
+    assert stats["host2"] == {'count': 1, 'mean': 2, 'last': 2}
+    assert stats["host0"] == {'count': 1, 'mean': 5, 'last': 5}
+    assert stats["host1"]['count'] == 0
+    assert mcc.active_channels[cp] == mcs[2]
+    #a different message, or an unhedged command, is not a copy
+    mcc.on_verified_privmsg(cp, "!pubkey efgh pub1 sig0", "host0")
+    mcc.on_verified_privmsg(cp, "!error x pub1 sig0", "host0")
+    mcc.on_verified_privmsg(cp, "!error x pub1 sig2", "host2")
+    assert len(mcs[0].verified) == 2 and len(mcs[2].verified) == 2
+    #copies are only remembered for received_window
+    mcc.clock.advance(mcc.received_window + 1)
+    mcc.on_verified_privmsg(cp, "!pubkey abcd pub1 sig0", "host0")
+    assert len(mcs[0].verified) == 3
+
+def test_pack_orderlines():
+    header = "PRIVMSG #joinmarket :"
+    orderlines = ["!reloffer {} 27300 1000000000 0 0.0002".format(i)
+                  for i in range(40)]
+    lines = pack_orderlines(header, orderlines)
+    assert all(len(l) <= MAX_PRIVMSG_LEN for l in lines)
+    assert "".join(l[len(header):-2] for l in lines) == "".join(orderlines)
+    #each line is full: the next orderline would not have fitted
+    for line, next_line in zip(lines, lines[1:]):
+        assert len(line) + len(next_line.split("!")[1]) + 1 > MAX_PRIVMSG_LEN
+    #the last orderline is announced even when it starts a new line
+    fits = (MAX_PRIVMSG_LEN - len(header) - 2) // len(orderlines[0])
+    lines = pack_orderlines(header, orderlines[:fits + 1])
+    assert len(lines) == 2 and lines[1] == header + orderlines[fits] + " ~"
+    assert pack_orderlines(header, []) == []
+    assert pack_orderlines(header, ["!x" * 300]) == [header + "!x" * 300 + " ~"]
+
 @pytest.mark.parametrize(
     "failuretype, mcindex, wait",
     [("shutdown", 0, 1),
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+from __future__ import print_function
+'''Tests of in-daemon nick signature verification.'''
+
+import hashlib
+import os
+import binascii
+import pytest
+
+import jmbitcoin as btc
+from jmdaemon.nick_verifier import NickSignatureVerifier
+from jmdaemon.protocol import (NICK_HASH_LENGTH, NICK_MAX_ENCODED,
+                               JOINMARKET_NICK_HEADER, JM_VERSION)
+
+
+def make_nick(priv=None, pubkey=None):
+    if priv:
+        pubkey = btc.privtopub(priv)
+    nick_pkh = btc.changebase(
+        hashlib.sha256(pubkey).digest()[:NICK_HASH_LENGTH], 256, 58)
+    nick_pkh += 'O' * (NICK_MAX_ENCODED - len(nick_pkh))
+    return pubkey, JOINMARKET_NICK_HEADER + str(JM_VERSION) + nick_pkh
+
+
+def test_nick_verifier():
+    priv = binascii.hexlify(os.urandom(32)) + "01"
+    pubkey, nick = make_nick(priv)
+    other_pubkey, other_nick = make_nick(
+        binascii.hexlify(os.urandom(32)) + "01")
+    msg = "fill 0 100000 abcdef" + "hostid"
+    sig = btc.ecdsa_sign(msg, priv)
+    v = NickSignatureVerifier(max_verified=2)
+
+    def verify(msg, sig, pubkey, nick):
+        return v.verify(msg, sig, pubkey, nick, NICK_HASH_LENGTH,
+                        NICK_MAX_ENCODED)
+
+    assert verify(msg, sig, pubkey, nick)
+    assert (v.hits, v.misses) == (0, 1)
+    #a retransmit is found in the cache
+    assert verify(msg, sig, pubkey, nick)
+    assert (v.hits, v.misses) == (1, 1)
+    #the pubkey must match the nick, even for a cached signature
+    assert not verify(msg, sig, pubkey, other_nick)
+    assert not verify(msg, sig, other_pubkey, nick)
+    #bad signatures, messages and keys are rejected, not cached
+    assert not verify(msg + "x", sig, pubkey, nick)
+    assert not verify(msg, btc.ecdsa_sign(msg + "x", priv), pubkey, nick)
+    assert not verify(msg, "notbase64", pubkey, nick)
+    bad_pubkey = "05" * 33
+    assert not verify(msg, sig, bad_pubkey, make_nick(pubkey=bad_pubkey)[1])
+    assert len(v.verified) == 1
+    #the verified cache is bounded, evicting the least recently used
+    msgs = [msg + str(i) for i in range(3)]
+    for m in msgs:
+        assert verify(m, btc.ecdsa_sign(m, priv), pubkey, nick)
+    assert len(v.verified) == 2
+    assert v.misses == 7
+    #(signing is deterministic, so this is a retransmit)
+    assert verify(msgs[-1], btc.ecdsa_sign(msgs[-1], priv), pubkey, nick)
+    assert (v.hits, v.misses) == (2, 7)
+    assert verify(msgs[0], btc.ecdsa_sign(msgs[0], priv), pubkey, nick)
+    assert (v.hits, v.misses) == (2, 8)
+    #the pubkey was parsed once for all of its messages
+    assert len([k for k in v.pubkeys if k[0] == pubkey]) == 1
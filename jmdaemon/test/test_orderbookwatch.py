@@ -127,3 +127,94 @@ def test_disconnect_leave():
     
 
     
+
+def apply_update(replica, update):
+    """Apply get_orderbook_update output to a replica dict, as a taker
+    client does.
+    """
+    version, full, data = update
+    if full:
+        replica = dict(((o['counterparty'], o['oid']), o) for o in data)
+    else:
+        for cp, oid in data['cancel']:
+            replica.pop((cp, oid), None)
+        for o in data['add']:
+            replica[(o['counterparty'], o['oid'])] = o
+    return version, replica
+
+def current_orderbook(ob):
+    rows = ob.db.execute('SELECT * FROM orderbook;').fetchall()
+    return dict(((o['counterparty'], o['oid']),
+                 dict([(k, o[k]) for k in ORDER_KEYS])) for o in rows)
+
+def test_orderbook_update():
+    ob = get_ob()
+    for i in range(5):
+        ob.on_order_seen("cp" + str(i), "0", "reloffer", "3000", "4000", "2",
+                         "0.3")
+    version, replica = apply_update({}, ob.get_orderbook_update())
+    assert replica == current_orderbook(ob)
+    #nothing changed
+    assert ob.get_orderbook_update(version) == (version, False,
+                                                {'add': [], 'cancel': []})
+    #replace, cancel, add and re-add, leave
+    ob.on_order_seen("cp0", "0", "absoffer", "3000", "5000", "2", "100")
+    ob.on_order_cancel("cp1", "0")
+    ob.on_order_seen("cp5", "1", "reloffer", "3000", "4000", "2", "0.3")
+    ob.on_order_cancel("cp5", "1")
+    ob.on_order_seen("cp5", "1", "reloffer", "3000", "4000", "2", "0.4")
+    ob.on_order_seen("cp2", "3", "reloffer", "3000", "4000", "2", "0.3")
+    ob.on_nick_leave("cp2")
+    #an invalid replacement removes the old offer
+    ob.on_order_seen("cp3", "0", "reloffer", "5000", "4000", "2", "0.3")
+    #cancelling an unknown offer is not a change
+    v = ob.ob_version
+    ob.on_order_cancel("cp9", "0")
+    assert ob.ob_version == v
+    update = ob.get_orderbook_update(version)
+    assert not update[1]
+    #(cp2's offer 3 came and went since version; the replica ignores it)
+    assert sorted(update[2]['cancel']) == [["cp1", 0], ["cp2", 0],
+                                           ["cp2", 3], ["cp3", 0]]
+    assert sorted(o['counterparty'] for o in update[2]['add']) == ["cp0",
+                                                                   "cp5"]
+    version, replica = apply_update(replica, update)
+    assert replica == current_orderbook(ob)
+    #too old, or unknown, versions get a full snapshot
+    ob.max_orderbook_changes = 3
+    for i in range(4):
+        ob.on_order_seen("cp4", "0", "reloffer", "3000", "4000", "2",
+                         "0.3" + str(i))
+    update = ob.get_orderbook_update(version)
+    assert update[1]
+    assert ob.get_orderbook_update(update[0] + 1)[1]
+    version, replica = apply_update(replica, update)
+    assert replica == current_orderbook(ob)
+    #a disconnect starts a new history
+    ob.on_disconnect()
+    update = ob.get_orderbook_update(version)
+    assert update[1] and update[2] == []
+
+def test_orders_seen_bulk():
+    ob = get_ob()
+    offers = [(str(i), "reloffer", "3000", "4000", "2", "0.3")
+              for i in range(4)]
+    ob.on_orders_seen("cp0", offers + [("x", "reloffer", "3000", "4000",
+                                        "2", "0.3")])
+    assert len(ob.orderbook) == 4
+    assert ob.orderbook.get("cp0", 3).cjfee == "0.3"
+    assert sorted(ob.orderbook.counterparties()) == ["cp0"]
+    #re-announcing the same offers is not a change
+    version = ob.ob_version
+    ob.on_orders_seen("cp0", offers)
+    assert ob.ob_version == version
+    #the sql view follows the orderbook
+    assert len(ob.db.execute('SELECT * FROM orderbook;').fetchall()) == 4
+    ob.on_orders_seen("cp0", [("1", "absoffer", "3000", "4000", "2", "100")])
+    rows = ob.db.execute('SELECT * FROM orderbook WHERE oid=1;').fetchall()
+    assert [(r['ordertype'], r['cjfee']) for r in rows] == [("absoffer",
+                                                             "100")]
+    ob.on_nick_leave("cp0")
+    assert len(ob.orderbook) == 0
+    assert ob.orderbook.counterparties() == []
+    assert len(ob.db.execute('SELECT * FROM orderbook;').fetchall()) == 0
@@ -18,36 +18,41 @@ from jmclient import (
     load_program_config, jm_single, get_p2pk_vbyte, open_wallet, WalletError,
     sync_wallet, add_external_commitments, generate_podle, update_commitments,
     PoDLE, set_commitment_file, get_podle_commitments, get_utxo_info,
-    validate_utxo_data, quit, get_wallet_path)
+    validate_utxo_data, quit, get_wallet_path, import_commitments,
+    export_commitments, read_utxo_file, add_bulk_external_commitments)
 
 
-def add_ext_commitments(utxo_datas):
-    """Persist the PoDLE commitments for this utxo
-    to the commitments.json file. The number of separate
-    entries is dependent on the taker_utxo_retries entry, by
-    default 3.
+def add_ext_commitments(utxo_datas, processes=None):
+    """Persist the PoDLE commitments for these utxos
+    to the commitments store. The number of separate
+    entries per utxo is dependent on the taker_utxo_retries entry, by
+    default 3. Commitments are generated in parallel across
+    processes worker processes (default: one per cpu), and written
+    in one update once all are generated.
     """
-    def generate_single_podle_sig(u, priv, i):
-        """Make a podle entry for key priv at index i, using a dummy utxo value.
-        This calls the underlying 'raw' code based on the class PoDLE, not the
-        library 'generate_podle' which intelligently searches and updates commitments.
-        """
-        #Convert priv to hex
-        hexpriv = btc.from_wif_privkey(priv, vbyte=get_p2pk_vbyte())
-        podle = PoDLE(u, hexpriv)
-        r = podle.generate_podle(i)
-        return (r['P'], r['P2'], r['sig'],
-                r['e'], r['commit'])
-    ecs = {}
-    for u, priv in utxo_datas:
-        ecs[u] = {}
-        ecs[u]['reveal']={}
-        for j in range(jm_single().config.getint("POLICY", "taker_utxo_retries")):
-            P, P2, s, e, commit = generate_single_podle_sig(u, priv, j)
-            if 'P' not in ecs[u]:
-                ecs[u]['P']=P
-            ecs[u]['reveal'][j] = {'P2':P2, 's':s, 'e':e}
-        add_external_commitments(ecs)
+    def progress(nutxos, ncommitments, elapsed):
+        rate = ncommitments / elapsed if elapsed > 0 else 0.0
+        print "Generated commitments for %d utxos (%d commitments, %.1f/s)" % (
+            nutxos, ncommitments, rate)
+    n = add_bulk_external_commitments(utxo_datas, processes=processes,
+                                      progress=progress)
+    print "Added external commitments for %d utxos." % n
+    return n
+
+def read_utxos(parser, filename):
+    """Yields the (utxo, privkey) pairs of the csv file filename, as
+    read_utxo_file, but quits on the first line that fails to parse.
+    """
+    utxos = read_utxo_file(filename)
+    while True:
+        try:
+            u = next(utxos)
+        except StopIteration:
+            return
+        except Exception:
+            #not reporting the line, in case of privkey info
+            quit(parser, "Failed to parse utxo info in: " + filename)
+        yield u
 
 def main():
     parser = OptionParser(
@@ -127,6 +132,22 @@ def main():
         help='deletes the current list of external commitment utxos',
         default=False
         )
+    parser.add_option(
+        '--import-json',
+        action='store',
+        type='str',
+        dest='import_json',
+        help='merge the used and external commitments from a legacy format '
+        'commitments.json file into the current commitments store'
+        )
+    parser.add_option(
+        '--export-json',
+        action='store',
+        type='str',
+        dest='export_json',
+        help='write the current commitments to the given file, in the legacy '
+        'commitments.json format'
+        )
     parser.add_option(
         '-v',
         '--validate-utxos',
@@ -143,6 +164,16 @@ def main():
         help='only validate the provided utxos (file or command line), not add',
         default=False
     )
+    parser.add_option(
+        '-p',
+        '--processes',
+        action='store',
+        type='int',
+        dest='processes',
+        default=None,
+        help='number of worker processes used to generate commitments, '
+        'default one per cpu; use 1 to generate in a single process'
+    )
     parser.add_option('--fast',
                       action='store_true',
                       dest='fastsync',
@@ -171,6 +202,18 @@ def main():
         print "Commitments deleted."
         sys.exit(0)
 
+    if options.import_json or options.export_json:
+        if options.import_json:
+            if not os.path.isfile(options.import_json):
+                print "File: " + options.import_json + " not found."
+                sys.exit(0)
+            import_commitments(options.import_json)
+            print "Commitments imported from: " + options.import_json
+        if options.export_json:
+            export_commitments(options.export_json)
+            print "Commitments exported to: " + options.export_json
+        sys.exit(0)
+
     #Three options (-w, -r, -R) for loading utxo and privkey pairs from a wallet,
     #csv file or json file.
     if options.loadwallet:
@@ -186,15 +229,14 @@ def main():
                 utxo_data.append((txhex, wif))
 
     elif options.in_file:
-        with open(options.in_file, "rb") as f:
-            utxo_info = f.readlines()
-        for ul in utxo_info:
-            ul = ul.rstrip()
-            if ul:
-                u, priv = get_utxo_info(ul)
-                if not u:
-                    quit(parser, "Failed to parse utxo info: " + str(ul))
-                utxo_data.append((u, priv))
+        if not os.path.isfile(options.in_file):
+            print "File: " + options.in_file + " not found."
+            sys.exit(0)
+        #read lazily while generating, unless the utxos are to be validated
+        #first
+        utxo_data = read_utxos(parser, options.in_file)
+        if options.validate or options.vonly:
+            utxo_data = list(utxo_data)
     elif options.in_json:
         if not os.path.isfile(options.in_json):
             print "File: " + options.in_json + " not found."
@@ -225,8 +267,8 @@ def main():
         sys.exit(0)
     
     #We are adding utxos to the external list
-    assert len(utxo_data)
-    add_ext_commitments(utxo_data)
+    if not add_ext_commitments(utxo_data, processes=options.processes):
+        quit(parser, "No utxos to add, quitting")
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,9 @@
 from __future__ import absolute_import, print_function
 
 import BaseHTTPServer
+import Queue
 import SimpleHTTPServer
+import SocketServer
 import base64
 import io
 import json
@@ -9,8 +11,10 @@ import threading
 import time
 import hashlib
 import os
+import socket
 import sys
 import urllib2
+from collections import OrderedDict, deque
 from decimal import Decimal
 from optparse import OptionParser
 from twisted.internet import reactor
@@ -28,6 +32,7 @@ except:
     sys.exit(0)
 
 from jmclient import jm_single, load_program_config, get_log, calc_cj_fee, get_irc_mchannels
+from jmclient import OrderbookArchive, OrderbookArchiver
 from jmdaemon import OrderbookWatch, MessageChannelCollection, IRCMessageChannel
 #TODO this is only for base58, find a solution for a client without jmbitcoin
 import jmbitcoin as btc
@@ -49,17 +54,14 @@ sorted_rel_units = ('%', '&#8241;', 'ppm')
 rel_unit_to_factor = {'%': 100, '&#8241;': 1e4, 'ppm': 1e6}
 
 
-def calc_depth_data(db, value):
-    pass
+#The charts and tables below are rendered from rows, the offers shown
+#(as dicts, see OrderbookRenderer.get_rows).
 
-
-def create_depth_chart(db, cj_amount, args=None):
+def create_depth_chart(rows, cj_amount, args=None):
     if args is None:
         args = {}
-    rows = db.execute('SELECT * FROM orderbook;').fetchall()
-    sqlorders = [o for o in rows if o["ordertype"] in filtered_offername_list]
     orderfees = sorted([calc_cj_fee(o['ordertype'], o['cjfee'], cj_amount) / 1e8
-                        for o in sqlorders
+                        for o in rows
                         if o['minsize'] <= cj_amount <= o[
                             'maxsize']])
 
@@ -93,10 +95,10 @@ def create_depth_chart(db, cj_amount, args=None):
     return get_graph_html(fig)
 
 
-def create_size_histogram(db, args):
-    rows = db.execute('SELECT maxsize, ordertype FROM orderbook;').fetchall()
-    rows = [o for o in rows if o["ordertype"] in filtered_offername_list]
+def create_size_histogram(rows, args):
     ordersizes = sorted([r['maxsize'] / 1e8 for r in rows])
+    if not ordersizes:
+        return 'No orders'
 
     fig = plt.figure()
     scale = args.get("scale")
@@ -119,6 +121,7 @@ def create_size_histogram(db, args):
 def get_graph_html(fig):
     imbuf = io.BytesIO()
     fig.savefig(imbuf, format='png')
+    plt.close(fig)
     b64 = base64.b64encode(imbuf.getvalue())
     return '<img src="data:image/png;base64,' + b64 + '" />'
 
@@ -151,34 +154,25 @@ def order_str(s, order, btc_unit, rel_unit):
     return str(s)
 
 
-def create_orderbook_table(db, btc_unit, rel_unit):
-    result = ''
-    rows = db.execute('SELECT * FROM orderbook;').fetchall()
-    if not rows:
-        return 0, result
-    #print("len rows before filter: " + str(len(rows)))
-    rows = [o for o in rows if o["ordertype"] in filtered_offername_list]
+def create_orderbook_table(rows, btc_unit, rel_unit):
     order_keys_display = (('ordertype', ordertype_display),
                           ('counterparty', do_nothing), ('oid', order_str),
                           ('cjfee', cjfee_display), ('txfee', satoshi_to_unit),
                           ('minsize', satoshi_to_unit),
                           ('maxsize', satoshi_to_unit))
 
-    # somewhat complex sorting to sort by cjfee but with swabsoffers on top
-
-    def orderby_cmp(x, y):
-        if x['ordertype'] == y['ordertype']:
-            return cmp(Decimal(x['cjfee']), Decimal(y['cjfee']))
-        return cmp(offername_list.index(x['ordertype']),
-                   offername_list.index(y['ordertype']))
+    # sorted by cjfee, but with swabsoffers on top
+    def orderby_key(o):
+        return offername_list.index(o['ordertype']), Decimal(o['cjfee'])
 
-    for o in sorted(rows, cmp=orderby_cmp):
-        result += ' <tr>\n'
+    result = []
+    for o in sorted(rows, key=orderby_key):
+        result.append(' <tr>\n')
         for key, displayer in order_keys_display:
-            result += '  <td>' + displayer(o[key], o, btc_unit,
-                                           rel_unit) + '</td>\n'
-        result += ' </tr>\n'
-    return len(rows), result
+            result.append('  <td>' + displayer(o[key], o, btc_unit,
+                                               rel_unit) + '</td>\n')
+        result.append(' </tr>\n')
+    return len(rows), ''.join(result)
 
 
 def create_table_heading(btc_unit, rel_unit):
@@ -214,49 +208,157 @@ def create_choose_units_form(selected_btc, selected_rel):
     return choose_units_form
 
 
+class OrderbookRenderer(object):
+    """Renders the pages of the orderbook, caching each by what it
+    depends on: the orderbook version (see OrderbookWatch.ob_version),
+    the offer types shown, and the units or scale chosen. So the
+    orderbook is read, and each page rendered, once per change at most.
+
+    Charts are rendered by a thread of their own (only one, as pyplot
+    is not thread safe), not by the requests for them: while the chart
+    for the current version is being rendered, the one last rendered
+    is served.
+    """
+    max_entries = 64
+    #seconds a request waits for a chart, when there is none to serve
+    chart_timeout = 60
+
+    def __init__(self, taker):
+        self.taker = taker
+        with open('orderbook.html', 'r') as fd:
+            self.template = fd.read()
+        self.rows_lock = threading.Lock()
+        self.version = None
+        self.rows = []
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        #the last rendering of each key, by key without the version
+        self.latest = {}
+        self.pending = {}
+        self.chart_queue = Queue.Queue()
+        chart_thread = threading.Thread(target=self.render_charts,
+                                        name='ChartThread')
+        chart_thread.daemon = True
+        chart_thread.start()
+
+    def get_rows(self):
+        """Returns (version, rows), the offers of the orderbook as dicts
+        and its version, read from the orderbook only if it changed.
+        """
+        with self.rows_lock:
+            if self.version != self.taker.ob_version:
+                db = self.taker.db
+                self.rows = [dict(row) for row in
+                             db.execute('SELECT * FROM orderbook;')]
+                self.version = self.taker.sql_view_version
+            return self.version, self.rows
+
+    def _lookup(self, key):
+        with self.lock:
+            value = self.cache.pop(key, None)
+            if value is not None:
+                self.cache[key] = value
+            return value
+
+    def _store(self, key, value):
+        with self.lock:
+            self.cache[key] = value
+            self.latest[key[1:]] = value
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+
+    def get(self, key, render):
+        """Returns render(), cached by key (a tuple, starting with
+        the orderbook version).
+        """
+        value = self._lookup(key)
+        if value is None:
+            value = render()
+            self._store(key, value)
+        return value
+
+    def get_chart(self, key, render):
+        """As get, but render() is called by the chart thread; if the
+        chart for key is not rendered yet, that for an earlier version
+        is returned if there is one.
+        """
+        value = self._lookup(key)
+        if value is not None:
+            return value
+        with self.lock:
+            done = self.pending.get(key)
+            if done is None:
+                done = self.pending[key] = threading.Event()
+                self.chart_queue.put((key, render, done))
+            value = self.latest.get(key[1:])
+        if value is not None:
+            return value
+        done.wait(self.chart_timeout)
+        return self._lookup(key) or 'Chart not rendered, try again later'
+
+    def render_charts(self):
+        while True:
+            key, render, done = self.chart_queue.get()
+            try:
+                self._store(key, render())
+            except Exception as e:
+                log.error("Failed to render chart: " + repr(e))
+            with self.lock:
+                del self.pending[key]
+            done.set()
+
+    def render_page(self, replacements):
+        page = self.template
+        for key, rep in replacements.iteritems():
+            page = page.replace(key, rep)
+        return page
+
+
+def create_orderbook_obj(rows):
+    result = []
+    for row in rows:
+        o = dict(row)
+        if 'cjfee' in o:
+            o['cjfee'] = int(o['cjfee']) if o['ordertype']\
+                         == 'swabsoffer' else float(o['cjfee'])
+        result.append(o)
+    return result
+
+
+def get_counterparty_count(rows):
+    return str(len(set(o['counterparty'] for o in rows)))
+
+
 class OrderbookPageRequestHeader(SimpleHTTPServer.SimpleHTTPRequestHandler):
     def __init__(self, request, client_address, base_server):
         self.taker = base_server.taker
+        self.renderer = base_server.renderer
         self.base_server = base_server
         SimpleHTTPServer.SimpleHTTPRequestHandler.__init__(
                 self, request, client_address, base_server)
 
-    def create_orderbook_obj(self):
-        rows = self.taker.db.execute('SELECT * FROM orderbook;').fetchall()
-        if not rows:
-            return []
-
-        result = []
-        for row in rows:
-            o = dict(row)
-            if 'cjfee' in o:
-                o['cjfee'] = int(o['cjfee']) if o['ordertype']\
-                             == 'swabsoffer' else float(o['cjfee'])
-            result.append(o)
-        return result
-
-    def get_counterparty_count(self):
-        counterparties = self.taker.db.execute(
-            'SELECT DISTINCT counterparty FROM orderbook WHERE ordertype=? OR ordertype=?;',
-            filtered_offername_list).fetchall()
-        return str(len(counterparties))
-
     def do_GET(self):
         # SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
         # print 'httpd received ' + self.path + ' request'
         self.path, query = self.path.split('?', 1) if '?' in self.path else (
             self.path, '')
         args = urllib2.urlparse.parse_qs(query)
+        if self.path == '/orderbook/stream':
+            return self.stream_orderbook()
         pages = ['/', '/ordersize', '/depth', '/orderbook.json']
         if self.path not in pages:
             return
-        fd = open('orderbook.html', 'r')
-        orderbook_fmt = fd.read()
-        fd.close()
+        renderer = self.renderer
+        version, rows = renderer.get_rows()
+        offertypes = tuple(filtered_offername_list)
+        shown = [o for o in rows if o['ordertype'] in offertypes]
         alert_msg = ''
         if jm_single().joinmarket_alert[0]:
             alert_msg = '<br />JoinMarket Alert Message:<br />' + \
                         jm_single().joinmarket_alert[0]
+        #only the scale chosen matters to the charts
+        chart_args = {"scale": ["log"]} if args.get(
+            "scale", [None])[0] == "log" else {}
         if self.path == '/':
             btc_unit = args['btcunit'][
                 0] if 'btcunit' in args else sorted_units[0]
@@ -266,47 +368,60 @@ class OrderbookPageRequestHeader(SimpleHTTPServer.SimpleHTTPRequestHandler):
                 btc_unit = sorted_units[0]
             if rel_unit not in sorted_rel_units:
                 rel_unit = sorted_rel_units[0]
-            ordercount, ordertable = create_orderbook_table(
-                    self.taker.db, btc_unit, rel_unit)
-            choose_units_form = create_choose_units_form(btc_unit, rel_unit)
-            table_heading = create_table_heading(btc_unit, rel_unit)
-            replacements = {
-                'PAGETITLE': 'JoinMarket Browser Interface',
-                'MAINHEADING': 'JoinMarket Orderbook',
-                'SECONDHEADING':
-                    (str(ordercount) + ' orders found by ' +
-                     self.get_counterparty_count() + ' counterparties' + alert_msg),
-                'MAINBODY': (
-                    toggleSWform + refresh_orderbook_form + choose_units_form +
-                    table_heading + ordertable + '</table>\n')
-            }
+
+            def render():
+                ordercount, ordertable = create_orderbook_table(
+                        shown, btc_unit, rel_unit)
+                choose_units_form = create_choose_units_form(btc_unit,
+                                                             rel_unit)
+                table_heading = create_table_heading(btc_unit, rel_unit)
+                return renderer.render_page({
+                    'PAGETITLE': 'JoinMarket Browser Interface',
+                    'MAINHEADING': 'JoinMarket Orderbook',
+                    'SECONDHEADING':
+                        (str(ordercount) + ' orders found by ' +
+                         get_counterparty_count(shown) + ' counterparties' +
+                         alert_msg),
+                    'MAINBODY': (
+                        toggleSWform + refresh_orderbook_form +
+                        choose_units_form + table_heading + ordertable +
+                        '</table>\n')
+                })
+            orderbook_page = renderer.get(
+                (version, self.path, offertypes, btc_unit, rel_unit,
+                 alert_msg), render)
         elif self.path == '/ordersize':
-            replacements = {
+            orderbook_page = renderer.render_page({
                 'PAGETITLE': 'JoinMarket Browser Interface',
                 'MAINHEADING': 'Order Sizes',
                 'SECONDHEADING': 'Order Size Histogram' + alert_msg,
-                'MAINBODY': create_size_histogram(self.taker.db, args)
-            }
+                'MAINBODY': renderer.get_chart(
+                    (version, self.path, offertypes, bool(chart_args)),
+                    lambda: create_size_histogram(shown, chart_args))
+            })
         elif self.path.startswith('/depth'):
             # if self.path[6] == '?':
             #	quantity =
             cj_amounts = [10 ** cja for cja in range(4, 12, 1)]
-            mainbody = [create_depth_chart(self.taker.db, cja, args) \
-                        for cja in cj_amounts] + \
-                       ["<br/><a href='?'>linear</a>" if args.get("scale") \
-                            else "<br/><a href='?scale=log'>log scale</a>"]
-            replacements = {
+
+            def render():
+                mainbody = [create_depth_chart(shown, cja, chart_args) \
+                            for cja in cj_amounts] + \
+                           ["<br/><a href='?'>linear</a>" if chart_args \
+                                else "<br/><a href='?scale=log'>log scale</a>"]
+                return '<br />'.join(mainbody)
+            orderbook_page = renderer.render_page({
                 'PAGETITLE': 'JoinMarket Browser Interface',
                 'MAINHEADING': 'Depth Chart',
                 'SECONDHEADING': 'Orderbook Depth' + alert_msg,
-                'MAINBODY': '<br />'.join(mainbody)
-            }
+                'MAINBODY': renderer.get_chart(
+                    (version, self.path, offertypes, bool(chart_args)),
+                    render)
+            })
         elif self.path == '/orderbook.json':
-            replacements = {}
-            orderbook_fmt = json.dumps(self.create_orderbook_obj())
-        orderbook_page = orderbook_fmt
-        for key, rep in replacements.iteritems():
-            orderbook_page = orderbook_page.replace(key, rep)
+            orderbook_page = renderer.get(
+                (version, self.path),
+                lambda: json.dumps(create_orderbook_obj(rows)))
         self.send_response(200)
         if self.path.endswith('.json'):
             self.send_header('Content-Type', 'application/json')
@@ -316,6 +431,59 @@ class OrderbookPageRequestHeader(SimpleHTTPServer.SimpleHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(orderbook_page)
 
+    def send_event(self, event, data, event_id=None):
+        #(directly, as anything left in wfile when the client has gone
+        #would only fail again when the request ends)
+        self.connection.sendall(
+            'event: ' + event + '\n' +
+            ('id: ' + event_id + '\n' if event_id else '') +
+            'data: ' + json.dumps(data) + '\n\n')
+
+    def stream_orderbook(self):
+        """Streams the orderbook as server-sent events: a 'snapshot'
+        event, {"version": version, "orders": [orders]}, then an 'update'
+        event for each change, {"version": version, "add": [orders],
+        "cancel": [[counterparty, oid], ..], "leave": [nicks]}, where
+        'add' replaces any order with the same counterparty and oid, and
+        the orders of the nicks in 'leave' (which left) are in 'cancel'.
+        Orders are as in orderbook.json. A client reconnecting with the
+        last event id it saw is sent the changes since, if they are
+        still held, else a new snapshot.
+        """
+        taker = self.taker
+        if not taker.add_stream():
+            self.send_error(503, 'Too many streams')
+            return
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.flush()
+            since = taker.parse_event_id(self.headers.get('Last-Event-ID'))
+            while True:
+                version, full, data = taker.get_orderbook_update(since)
+                if full:
+                    self.send_event('snapshot', {
+                        'version': version,
+                        'orders': create_orderbook_obj(data)},
+                                    taker.get_event_id(version))
+                elif version != since:
+                    self.send_event('update', {
+                        'version': version,
+                        'add': create_orderbook_obj(data['add']),
+                        'cancel': data['cancel'],
+                        'leave': taker.get_nick_leaves(since, version)},
+                                    taker.get_event_id(version))
+                since = version
+                if not taker.wait_for_change(since, taker.stream_keepalive):
+                    #also finds clients which have gone
+                    self.connection.sendall(': keepalive\n\n')
+        except socket.error:
+            pass
+        finally:
+            taker.remove_stream()
+
     def do_POST(self):
         global filtered_offername_list
         pages = ['/shutdown', '/refreshorderbook', '/toggleSW']
@@ -342,6 +510,14 @@ class OrderbookPageRequestHeader(SimpleHTTPServer.SimpleHTTPRequestHandler):
             self.path = '/'
             self.do_GET()
 
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    """One thread per request, so that event streams do not hold up
+    other requests.
+    """
+    daemon_threads = True
+
+
 class HTTPDThread(threading.Thread):
     def __init__(self, taker, hostport):
         threading.Thread.__init__(self, name='HTTPDThread')
@@ -351,9 +527,9 @@ class HTTPDThread(threading.Thread):
 
     def run(self):
         # hostport = ('localhost', 62601)
-        httpd = BaseHTTPServer.HTTPServer(self.hostport,
-                                          OrderbookPageRequestHeader)
+        httpd = ThreadedHTTPServer(self.hostport, OrderbookPageRequestHeader)
         httpd.taker = self.taker
+        httpd.renderer = OrderbookRenderer(self.taker)
         print('\nstarted http server, visit http://{0}:{1}/\n'.format(
                 *self.hostport))
         httpd.serve_forever()
@@ -361,11 +537,92 @@ class HTTPDThread(threading.Thread):
 
 class ObBasic(OrderbookWatch):
     """Dummy orderbook watch class
-    with hooks for triggering orderbook request"""
+    with hooks for triggering orderbook request,
+    and for waking the event streams on changes"""
+    #seconds between keepalive comments on an idle event stream
+    stream_keepalive = 15
+    max_streams = 100
+    #nick leaves retained for the event streams
+    max_nick_leaves = 10000
+
     def __init__(self, msgchan, hostport):
         self.hostport = hostport
+        self.changed = threading.Condition()
+        self.streams = 0
+        #(version, nick) for each nick which left with offers
+        self.nick_leaves = deque(maxlen=self.max_nick_leaves)
+        #event ids are only meaningful to this process
+        self.stream_token = hashlib.sha256(os.urandom(16)).hexdigest()[:8]
         self.set_msgchan(msgchan)
 
+    def notify_change(self):
+        with self.changed:
+            self.changed.notify_all()
+
+    def wait_for_change(self, version, timeout):
+        """Returns whether the orderbook changed from version, waiting
+        up to timeout seconds for it to.
+        """
+        with self.changed:
+            if self.ob_version == version:
+                self.changed.wait(timeout)
+            return self.ob_version != version
+
+    def add_stream(self):
+        with self.changed:
+            if self.streams >= self.max_streams:
+                return False
+            self.streams += 1
+            return True
+
+    def remove_stream(self):
+        with self.changed:
+            self.streams -= 1
+
+    def get_event_id(self, version):
+        return self.stream_token + ':' + str(version)
+
+    def parse_event_id(self, event_id):
+        """Returns the version of an event id from get_event_id,
+        or None if it is not one of ours.
+        """
+        if not event_id:
+            return None
+        token, _, version = event_id.partition(':')
+        if token != self.stream_token or not version.isdigit():
+            return None
+        return int(version)
+
+    def get_nick_leaves(self, since, until):
+        with self.oblock:
+            return [nick for version, nick in self.nick_leaves
+                    if since < version <= until]
+
+    def on_order_seen(self, *args):
+        OrderbookWatch.on_order_seen(self, *args)
+        self.notify_change()
+
+    def on_orders_seen(self, counterparty, offers):
+        OrderbookWatch.on_orders_seen(self, counterparty, offers)
+        self.notify_change()
+
+    def on_order_cancel(self, counterparty, oid):
+        OrderbookWatch.on_order_cancel(self, counterparty, oid)
+        self.notify_change()
+
+    def on_nick_leave(self, nick):
+        #(the orderbook is only changed from the reactor thread)
+        version = self.ob_version
+        OrderbookWatch.on_nick_leave(self, nick)
+        with self.oblock:
+            if self.ob_version != version:
+                self.nick_leaves.append((self.ob_version, nick))
+        self.notify_change()
+
+    def on_disconnect(self):
+        OrderbookWatch.on_disconnect(self)
+        self.notify_change()
+
     def on_welcome(self):
         """TODO: It will probably be a bit
         simpler, and more consistent, to use
@@ -442,6 +699,21 @@ def main():
                       dest='port',
                       help='port to listen on, default=62601',
                       default=62601)
+    parser.add_option('--archive',
+                      action='store',
+                      type='string',
+                      dest='archive',
+                      default=None,
+                      help='directory in which to archive the orderbook '
+                      'over time, default none')
+    parser.add_option('--archive-interval',
+                      action='store',
+                      type='int',
+                      dest='archive_interval',
+                      default=OrderbookArchiver.interval,
+                      help='seconds between recordings of the orderbook in '
+                      'the archive, default=' +
+                      str(OrderbookArchiver.interval))
     (options, args) = parser.parse_args()
 
     hostport = (options.host, options.port)
@@ -449,6 +721,9 @@ def main():
     mcc = MessageChannelCollection(mcs)
     mcc.set_nick(get_dummy_nick())
     taker = ObBasic(mcc, hostport)
+    if options.archive:
+        OrderbookArchiver(taker, OrderbookArchive(options.archive),
+                          options.archive_interval).start()
     log.info("Starting ob-watcher")
     mcc.run()
 
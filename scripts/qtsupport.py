@@ -102,8 +102,26 @@ config_tips = {
     "hosts should be considered *highly* experimental for now, not recommended.",
     "use_ssl": "Set to 'true' to use TLS for client-daemon connection; see\n" +
     "documentation for details on how to set up certs if you use this.",
+    "verify_nick_sigs": "Set to 'false' to have the client, rather than the\n" +
+    "daemon, verify the signatures on received messages.",
+    "hedge_privmsgs": "Set to 'true' to send coinjoin messages over all\n" +
+    "configured IRC servers the counterparty is on, not just one.",
+    "max_privmsg_size": "The largest message, in bytes, accepted in parts from\n" +
+    "a counterparty; larger ones are dropped.",
+    "max_partial_privmsgs": "The most counterparties whose messages are\n" +
+    "being received in parts at once.",
+    "partial_privmsg_timeout": "Seconds to wait for the next part of a message\n" +
+    "before dropping it.",
     "history_file": "Location of the file storing transaction history",
     "segwit": "Only used for migrating legacy wallets; see documentation.",
+    "metrics_file": "File to which timings of each stage of coinjoins are\n" +
+    "written; CSV if the name ends in .csv, else JSON. Empty to disable.",
+    "metrics_interval": "Seconds between writes of the metrics_file.",
+    "metrics_port": "Local port on which to serve the coinjoin timings\n" +
+    "over HTTP. Empty to disable.",
+    "maker_timeout_min_sec": "Shortest wait for makers' responses, once\n" +
+    "the wait is adapted to how fast they have responded. Empty to\n" +
+    "always wait maker_timeout_sec.",
     "console_log_level": "one of INFO, DEBUG, WARN, ERROR; INFO is least noisy;\n" +
     "consider switching to DEBUG in case of problems.",
     "absurd_fee_per_kb": "maximum satoshis/kilobyte you are willing to pay,\n" +
@@ -122,6 +140,8 @@ config_tips = {
     "taker_utxo_amtpercent": "Global consensus parameter, do not change.\n" +
     "See documentation of use of 'commitments'.",
     "accept_commitment_broadcasts": "Not used, ignore.",
+    "utxo_reservation_sec": "As a maker, how many seconds the utxos offered to\n" +
+    "one taker are kept from other takers, unless the transaction is seen first.",
     "commit_file_location": "Location of the file that stores the commitments\n" +
     "you've used, and any external commitments you've loaded.\n" +
     "See documentation of use of 'commitments'.",
@@ -30,10 +30,11 @@ jlog = get_log()
 
 class YieldGeneratorPrivacyEnhanced(YieldGeneratorBasic):
 
-    def __init__(self, wallet, offerconfig):
+    def __init__(self, wallet, offerconfig, stats_file=None):
         self.txfee, self.cjfee_a, self.cjfee_r, self.ordertype, self.minsize \
             = offerconfig
-        super(YieldGeneratorPrivacyEnhanced, self).__init__(wallet, offerconfig)
+        super(YieldGeneratorPrivacyEnhanced, self).__init__(wallet, offerconfig,
+                                                            stats_file)
 
     def create_my_orders(self):
         mix_balance = self.wallet.get_balance_by_mixdepth()
@@ -88,6 +89,12 @@ class YieldGeneratorPrivacyEnhanced(YieldGeneratorBasic):
 
         return [order]
 
+    def offers_affected(self, old_balances, new_balances, changed):
+        # re-randomized after any change of balance, such as a coinjoin,
+        # not only of the maximum
+        return YieldGenerator.offers_affected(self, old_balances,
+                                              new_balances, changed)
+
 
 if __name__ == "__main__":
     ygmain(YieldGeneratorPrivacyEnhanced, txfee=txfee, cjfee_a=cjfee_a,
@@ -0,0 +1,6 @@
+from __future__ import absolute_import, print_function
+
+from jmclient import yield_stats_main
+
+if __name__ == "__main__":
+    print(yield_stats_main())